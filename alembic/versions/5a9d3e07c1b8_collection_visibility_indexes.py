@@ -0,0 +1,33 @@
+"""collection visibility indexes
+
+Revision ID: 5a9d3e07c1b8
+Revises: e4b7c2a91f60
+Create Date: 2026-10-16 21:52:41.603318
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "5a9d3e07c1b8"
+down_revision: Union[str, None] = "e4b7c2a91f60"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    with op.batch_alter_table("collection", schema=None) as batch_op:
+        batch_op.create_index(batch_op.f("ix_collection_owner_id"), ["owner_id"], unique=False)
+
+    with op.batch_alter_table("collectionpermission", schema=None) as batch_op:
+        batch_op.create_index(batch_op.f("ix_collectionpermission_user_id"), ["user_id"], unique=False)
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("collectionpermission", schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f("ix_collectionpermission_user_id"))
+
+    with op.batch_alter_table("collection", schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f("ix_collection_owner_id"))
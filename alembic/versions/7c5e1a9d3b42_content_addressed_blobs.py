@@ -0,0 +1,84 @@
+"""content addressed blobs
+
+Revision ID: 7c5e1a9d3b42
+Revises: 2d1058b6847b
+Create Date: 2026-10-16 20:50:12.418337
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+import sqlmodel
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "7c5e1a9d3b42"
+down_revision: Union[str, None] = "2d1058b6847b"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "blobpaperless",
+        sa.Column("hash", sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+        sa.Column("paperless_id", sa.Integer(), nullable=False),
+        sa.Column("ref_count", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("hash"),
+        sa.UniqueConstraint("paperless_id"),
+    )
+    # Documents are now the key, so several of them can point at the same Paperless-ngx document
+    op.create_table(
+        "documentpaperless_new",
+        sa.Column("doc_id", sqlmodel.sql.sqltypes.GUID(), nullable=False),
+        sa.Column("paperless_id", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(["doc_id"], ["document.id"]),
+        sa.PrimaryKeyConstraint("doc_id"),
+    )
+    op.execute(
+        "INSERT INTO documentpaperless_new (doc_id, paperless_id) "
+        "SELECT doc_id, paperless_id FROM documentpaperless WHERE doc_id IS NOT NULL"
+    )
+    op.drop_table("documentpaperless")
+    op.rename_table("documentpaperless_new", "documentpaperless")
+    with op.batch_alter_table("documentpaperless", schema=None) as batch_op:
+        batch_op.create_index(batch_op.f("ix_documentpaperless_paperless_id"), ["paperless_id"], unique=False)
+
+    # Existing uploads of documents still in use become the blobs of their content,
+    # duplicates uploaded before keep their own document
+    live = (
+        "FROM documentpaperless JOIN document ON document.id = documentpaperless.doc_id "
+        "WHERE NOT EXISTS (SELECT 1 FROM documentevent "
+        "WHERE documentevent.document_id = document.id AND documentevent.type = 'Delete')"
+    )
+    op.execute(
+        "INSERT INTO blobpaperless (hash, paperless_id, ref_count) "
+        f"SELECT document.hash, MIN(documentpaperless.paperless_id), 0 {live} GROUP BY document.hash"
+    )
+    # Each blob is referenced by the documents in use that point at its Paperless-ngx document
+    op.execute(
+        "UPDATE blobpaperless SET ref_count = ("
+        f"SELECT COUNT(*) {live} AND documentpaperless.paperless_id = blobpaperless.paperless_id)"
+    )
+
+
+def downgrade() -> None:
+    # Documents sharing a blob can't be represented anymore, only the first one keeps it
+    op.create_table(
+        "documentpaperless_old",
+        sa.Column("paperless_id", sa.Integer(), nullable=False),
+        sa.Column("doc_id", sqlmodel.sql.sqltypes.GUID(), nullable=True),
+        sa.ForeignKeyConstraint(["doc_id"], ["document.id"]),
+        sa.PrimaryKeyConstraint("paperless_id"),
+    )
+    op.execute(
+        "INSERT INTO documentpaperless_old (paperless_id, doc_id) "
+        "SELECT paperless_id, MIN(doc_id) FROM documentpaperless GROUP BY paperless_id"
+    )
+    op.drop_table("documentpaperless")
+    op.rename_table("documentpaperless_old", "documentpaperless")
+    with op.batch_alter_table("documentpaperless", schema=None) as batch_op:
+        batch_op.create_index(batch_op.f("ix_documentpaperless_doc_id"), ["doc_id"], unique=False)
+    op.drop_table("blobpaperless")
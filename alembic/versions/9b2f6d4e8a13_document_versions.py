@@ -0,0 +1,58 @@
+"""document versions
+
+Revision ID: 9b2f6d4e8a13
+Revises: 5a9d3e07c1b8
+Create Date: 2026-10-16 22:18:27.530614
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+import sqlmodel
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "9b2f6d4e8a13"
+down_revision: Union[str, None] = "5a9d3e07c1b8"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Every document with the first version of its update chain and its place in it
+CHAINS = (
+    "WITH RECURSIVE chain(id, lineage_id, version_no) AS ("
+    'SELECT id, id, 1 FROM document WHERE id NOT IN (SELECT updated_id FROM "update") '
+    "UNION ALL "
+    'SELECT "update".updated_id, chain.lineage_id, chain.version_no + 1 '
+    'FROM chain JOIN "update" ON "update".previous_id = chain.id) '
+)
+
+
+def upgrade() -> None:
+    with op.batch_alter_table("document", schema=None) as batch_op:
+        batch_op.add_column(sa.Column("lineage_id", sqlmodel.sql.sqltypes.GUID(), nullable=True))
+        batch_op.add_column(sa.Column("version_no", sa.Integer(), nullable=False, server_default="1"))
+        batch_op.add_column(sa.Column("is_current", sa.Boolean(), nullable=False, server_default="1"))
+
+    # Walk the update chains once to number their versions, the documents some update replaced are not current
+    op.execute(
+        CHAINS + "UPDATE document SET "
+        "lineage_id = (SELECT lineage_id FROM chain WHERE chain.id = document.id), "
+        "version_no = (SELECT version_no FROM chain WHERE chain.id = document.id)"
+    )
+    op.execute('UPDATE document SET is_current = 0 WHERE id IN (SELECT previous_id FROM "update")')
+
+    with op.batch_alter_table("document", schema=None) as batch_op:
+        batch_op.alter_column("lineage_id", existing_type=sqlmodel.sql.sqltypes.GUID(), nullable=False)
+        batch_op.create_index(batch_op.f("ix_document_lineage_id"), ["lineage_id"], unique=False)
+        batch_op.create_index(batch_op.f("ix_document_is_current"), ["is_current"], unique=False)
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("document", schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f("ix_document_is_current"))
+        batch_op.drop_index(batch_op.f("ix_document_lineage_id"))
+        batch_op.drop_column("is_current")
+        batch_op.drop_column("version_no")
+        batch_op.drop_column("lineage_id")
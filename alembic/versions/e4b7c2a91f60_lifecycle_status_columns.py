@@ -0,0 +1,49 @@
+"""lifecycle status columns
+
+Revision ID: e4b7c2a91f60
+Revises: 7c5e1a9d3b42
+Create Date: 2026-10-16 21:34:05.172940
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "e4b7c2a91f60"
+down_revision: Union[str, None] = "7c5e1a9d3b42"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Table, its event table and the column of the event table pointing back at it
+TABLES = [("collection", "collectionevent", "collection_id"), ("document", "documentevent", "document_id")]
+# Column, aggregate and event type it is derived from
+COLUMNS = [("created_at", "MIN", "Create"), ("deleted_at", "MIN", "Delete"), ("last_access_at", "MAX", "Access")]
+
+
+def upgrade() -> None:
+    for table, _, _ in TABLES:
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            for column, _, _ in COLUMNS:
+                batch_op.add_column(sa.Column(column, sa.DateTime(), nullable=True))
+                batch_op.create_index(batch_op.f(f"ix_{table}_{column}"), [column], unique=False)
+
+    # Fill them in from the events recorded so far
+    for table, event_table, key in TABLES:
+        for column, aggregate, event_type in COLUMNS:
+            op.execute(
+                f"UPDATE {table} SET {column} = ("
+                f"SELECT {aggregate}(timestamp) FROM {event_table} "
+                f"WHERE {event_table}.{key} = {table}.id AND {event_table}.type = '{event_type}')"
+            )
+
+
+def downgrade() -> None:
+    for table, _, _ in TABLES:
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            for column, _, _ in COLUMNS:
+                batch_op.drop_index(batch_op.f(f"ix_{table}_{column}"))
+                batch_op.drop_column(column)
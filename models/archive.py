@@ -0,0 +1,21 @@
+from enum import Enum
+
+
+class ArchiveFormat(str, Enum):
+    tar = "tar"
+    tar_gz = "tar.gz"
+    tar_zst = "tar.zst"
+
+    @property
+    def media_type(self) -> str:
+        match self:
+            case ArchiveFormat.tar_gz:
+                return "application/gzip"
+            case ArchiveFormat.tar_zst:
+                return "application/zstd"
+            case _:
+                return "application/x-tar"
+
+    @property
+    def suffix(self) -> str:
+        return "." + self.value
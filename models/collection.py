@@ -1,11 +1,11 @@
 from datetime import datetime
 from enum import Enum
-from typing import Any, Generator, List, Optional, Tuple
+from typing import Any, BinaryIO, Generator, List, Optional, Tuple
 from uuid import UUID, uuid4
 
 from sqlmodel import Field, Relationship, SQLModel
 
-from models.event import CollectionEvent, DocumentEvent, EventTypes
+from models.event import CollectionEvent, DocumentEvent
 from models.folder import Folder, FolderIntake
 from models.paperless import CollectionPaperless, DocumentPaperless
 from models.update import Update
@@ -33,6 +33,15 @@ class Document(DocumentBase, table=True):
     folder_id: UUID = Field(index=True, foreign_key="folder.id")
     collection_id: UUID = Field(index=True, foreign_key="collection.id")
     hash: str = Field(index=True)
+    # Lifecycle, mirrors the events (see storage.event.register_event) so it can be checked without loading them
+    created_at: datetime | None = Field(default=None, index=True)
+    deleted_at: datetime | None = Field(default=None, index=True)
+    last_access_at: datetime | None = Field(default=None, index=True)
+    # Versions, shared by every document of an update chain (see storage.collection.update_document),
+    # only its latest one is current
+    lineage_id: UUID = Field(default_factory=uuid4, index=True)
+    version_no: int = Field(default=1)
+    is_current: bool = Field(default=True, index=True)
 
     events: list["DocumentEvent"] = Relationship(back_populates="document")
     folder: Folder = Relationship(back_populates="documents")
@@ -48,13 +57,12 @@ class Document(DocumentBase, table=True):
     paperless: Optional["DocumentPaperless"] = Relationship(back_populates="document")
 
     def is_deleted(self) -> bool:
-        return any([event.type == EventTypes.Delete for event in self.events])
+        return self.deleted_at is not None
 
     def last_access(self) -> datetime:
-        return max(
-            [event.timestamp for event in self.events if event.type == EventTypes.Access],
-            default=datetime.max,
-        )
+        if self.last_access_at is None:
+            return datetime.max
+        return self.last_access_at
 
 
 class DocumentIntake(DocumentBase):
@@ -62,18 +70,35 @@ class DocumentIntake(DocumentBase):
     parent_folder: FolderIntake | None
 
 
-class EDocumentIntake(DocumentIntake):
+class FileDocumentIntake(DocumentBase):
+    """
+    DocumentIntake whose content stays on disk at the given path.
+    The file is only opened when the content is actually needed (e.g. when uploading it).
+    """
+
+    path: str
+    parent_folder: FolderIntake | None
+
+    def open(self) -> BinaryIO:
+        return open(self.path, "rb")
+
+    def read(self) -> bytes:
+        with self.open() as file:
+            return file.read()
+
+
+class EDocumentIntake(FileDocumentIntake):
     doc_id: UUID
 
     @staticmethod
-    def create(doc_id: UUID, intake: DocumentIntake) -> "EDocumentIntake":
+    def create(doc_id: UUID, intake: FileDocumentIntake) -> "EDocumentIntake":
         doc = EDocumentIntake(
             doc_id=doc_id,
             name=intake.name,
             size=intake.size,
             access_from_date=intake.access_from_date,
             hash=intake.hash,
-            content=intake.content,
+            path=intake.path,
             parent_folder=intake.parent_folder,
         )
         return doc
@@ -99,10 +124,14 @@ class CollectionBase(SQLModel):
 
 class Collection(CollectionBase, table=True):
     id: UUID = Field(default_factory=uuid4, primary_key=True)
-    owner_id: UUID | None = Field(default=None, foreign_key="user.id", nullable=False)
+    owner_id: UUID | None = Field(default=None, index=True, foreign_key="user.id", nullable=False)
     signature: bytes | None = Field(default=None)
     manifest: str | None = Field(default=None)
     blockchain: str | None = Field(default=None)
+    # Lifecycle, mirrors the events (see storage.event.register_event) so it can be checked without loading them
+    created_at: datetime | None = Field(default=None, index=True)
+    deleted_at: datetime | None = Field(default=None, index=True)
+    last_access_at: datetime | None = Field(default=None, index=True)
 
     folder: Folder = Relationship(back_populates="collection")
     owner: "User" = Relationship(back_populates="collections")
@@ -112,16 +141,17 @@ class Collection(CollectionBase, table=True):
     permissions: list["CollectionPermission"] = Relationship(back_populates="collection")
 
     def is_deleted(self) -> bool:
-        return any([event.type == EventTypes.Delete for event in self.events])
+        return self.deleted_at is not None
 
     def created(self) -> datetime:
-        return min([event.timestamp for event in self.events if event.type == EventTypes.Create])
+        if self.created_at is None:
+            raise ValueError("Collection has no creation event")
+        return self.created_at
 
     def last_access(self) -> datetime:
-        return max(
-            [event.timestamp for event in self.events if event.type == EventTypes.Access],
-            default=self.created(),
-        )
+        if self.last_access_at is None:
+            return self.created()
+        return self.last_access_at
 
     def can_read(self, user: User) -> bool:
         return (
@@ -144,7 +174,8 @@ class Collection(CollectionBase, table=True):
 
 class CollectionPermission(SQLModel, table=True):
     collection_id: UUID = Field(primary_key=True, foreign_key="collection.id")
-    user_id: UUID = Field(primary_key=True, foreign_key="user.id")
+    # Indexed on its own as well, the primary key only helps lookups by collection
+    user_id: UUID = Field(primary_key=True, index=True, foreign_key="user.id")
     creator_id: UUID = Field(primary_key=True, foreign_key="user.id")
     permission: Permission = Field(primary_key=True)
 
@@ -4,7 +4,12 @@ from uuid import UUID, uuid4
 from sqlmodel import Field, Relationship, SQLModel
 
 if TYPE_CHECKING:
-    from models.collection import Collection, Document, DocumentIntake
+    from models.collection import (
+        Collection,
+        Document,
+        DocumentIntake,
+        FileDocumentIntake,
+    )
 
 
 class FolderBase(SQLModel):
@@ -14,7 +19,7 @@ class FolderBase(SQLModel):
 
 # TODO: currently this is used to answer API calls, really isn't meant for that
 class FolderIntake(FolderBase):
-    children: list[Union["DocumentIntake", "FolderIntake"]] = []
+    children: list[Union["DocumentIntake", "FileDocumentIntake", "FolderIntake"]] = []
 
     def __str__(self):
         """Return tabulated string representation of the folder structure."""
@@ -0,0 +1,54 @@
+import threading
+from datetime import datetime
+from enum import Enum
+from uuid import UUID, uuid4
+
+from sqlmodel import Field, SQLModel
+
+# Counters are advanced from the hashing threads as well as the event loop
+progress_lock = threading.Lock()
+
+
+class JobStatus(str, Enum):
+    queued = "queued"
+    extracting = "extracting"
+    storing = "storing"
+    uploading = "uploading"
+    done = "done"
+    failed = "failed"
+
+
+class IngestJob(SQLModel):
+    """
+    Progress of a collection being ingested in the background.
+    Kept in memory only, jobs don't outlive the process (neither do their staged uploads).
+    """
+
+    id: UUID = Field(default_factory=uuid4)
+    name: str
+    owner_id: UUID
+    status: JobStatus = JobStatus.queued
+    collection_id: UUID | None = None
+    error: str | None = None
+    # Size of the uploaded archive
+    archive_size: int = 0
+    files_total: int | None = None
+    files_hashed: int = 0
+    files_uploaded: int = 0
+    files_verified: int = 0
+    created: datetime = Field(default_factory=datetime.now)
+    finished: datetime | None = None
+
+    def advance(self, stage: str, count: int = 1):
+        """Add to the counter of the given stage ("hashed", "uploaded" or "verified")."""
+        attribute = f"files_{stage}"
+        with progress_lock:
+            setattr(self, attribute, getattr(self, attribute) + count)
+
+    def finish(self, error: str | None = None):
+        self.status = JobStatus.failed if error is not None else JobStatus.done
+        self.error = error
+        self.finished = datetime.now()
+
+    def is_finished(self) -> bool:
+        return self.status in [JobStatus.done, JobStatus.failed]
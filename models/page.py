@@ -0,0 +1,15 @@
+from typing import Generic, TypeVar
+
+from pydantic import BaseModel
+
+T = TypeVar("T")
+
+
+class Page(BaseModel, Generic[T]):
+    """
+    One page of a listing, ordered by id.
+    next_cursor is passed back to get the following page, it is None on the last one.
+    """
+
+    items: list[T]
+    next_cursor: str | None = None
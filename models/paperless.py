@@ -11,14 +11,26 @@ if TYPE_CHECKING:
 class DocumentPaperless(SQLModel, table=True):
     """
     A document is represented by a document in Paperless-ngx.
+    Documents with the same content share the same Paperless-ngx document (see BlobPaperless).
     """
 
-    paperless_id: int = Field(primary_key=True)
-    doc_id: UUID | None = Field(default=None, index=True, foreign_key="document.id")
+    doc_id: UUID = Field(primary_key=True, foreign_key="document.id")
+    paperless_id: int = Field(index=True)
 
     document: "Document" = Relationship(back_populates="paperless")
 
 
+class BlobPaperless(SQLModel, table=True):
+    """
+    Content stored in Paperless-ngx, addressed by its SHA-256.
+    ref_count is the number of documents (DocumentPaperless) pointing at it, it is removed when that reaches zero.
+    """
+
+    hash: str = Field(primary_key=True)
+    paperless_id: int = Field(unique=True)
+    ref_count: int = Field(default=0)
+
+
 class CollectionPaperless(SQLModel, table=True):
     """
     A collection is represented by a tag in Paperless-ngx.
@@ -0,0 +1,25 @@
+from datetime import datetime
+from uuid import UUID, uuid4
+
+from sqlmodel import Field, SQLModel
+
+
+class ChunkInfo(SQLModel):
+    index: int
+    size: int
+    sha256: str
+
+
+class ChunkedUpload(SQLModel):
+    """
+    A collection archive being uploaded in numbered chunks, which can be sent in any order and resent.
+    Kept in memory only, its chunks live under TEMP_FOLDER.
+    """
+
+    id: UUID = Field(default_factory=uuid4)
+    name: str
+    owner_id: UUID
+    transaction_address: str
+    chunks: dict[int, ChunkInfo] = {}
+    created: datetime = Field(default_factory=datetime.now)
+    updated: datetime = Field(default_factory=datetime.now)
@@ -0,0 +1,23 @@
+from datetime import datetime
+from uuid import UUID, uuid4
+
+from sqlmodel import Field, SQLModel
+
+from models.job import IngestJob
+
+
+class Workspace(SQLModel):
+    """
+    Scratch directory under TEMP_FOLDER owned by a single request or job.
+    reserved is the number of bytes it counts against WORKSPACE_QUOTA_MB until it is closed.
+    Kept in memory only, the janitor removes directories it doesn't know about.
+    Workspaces given to a job don't expire while the job is running.
+    """
+
+    id: UUID = Field(default_factory=uuid4)
+    purpose: str
+    reserved: int = 0
+    created: datetime = Field(default_factory=datetime.now)
+    expires: datetime
+    job: IngestJob | None = None
+    closed: bool = False
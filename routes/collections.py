@@ -1,15 +1,30 @@
+import asyncio
 import logging
 import re
 from datetime import datetime
-from typing import Annotated, Sequence
+from typing import Annotated, AsyncIterator, Sequence
 from uuid import UUID
 
-from fastapi import APIRouter, Depends, File, Form, HTTPException, UploadFile, Response
-from fastapi.responses import FileResponse
+from fastapi import (
+    APIRouter,
+    Depends,
+    File,
+    Form,
+    Header,
+    HTTPException,
+    Request,
+    Response,
+    UploadFile,
+)
+from fastapi.responses import StreamingResponse
 from sqlmodel import Session
+from starlette.background import BackgroundTask
 
 import storage.collection as collections
+import storage.jobs as jobs
+import storage.uploads as uploads
 import storage.user as users
+from models.archive import ArchiveFormat
 from models.collection import (
     Collection,
     CollectionInfo,
@@ -17,55 +32,176 @@ from models.collection import (
     Permission,
 )
 from models.folder import FolderIntake
+from models.job import IngestJob
+from models.page import Page
+from models.upload import ChunkedUpload, ChunkInfo
 from models.user import User
 from storage.main import engine
-from utils.security import get_current_user, get_optional_user
+from utils.compression import available_formats, negotiate_format
+from utils.exceptions import IntegrityBreach
+from utils.http import attachment, file_response, not_modified, stream_response
+from utils.pagination import page_size
+from utils.security import get_current_user, get_optional_user, obfuscate_signature
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO,
                     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 
+SIGNATURE_MEDIA_TYPE = "binary/octet-stream"
+
 collections_router = APIRouter(
     prefix="/collections",
     tags=["collections"],
 )
 
 
-# Create a new collection
-@collections_router.post("/")
+# Create a new collection, ingested in the background
+@collections_router.post("/", status_code=202)
 async def create_collection(
     user: Annotated[User, Depends(get_current_user)],
     transaction_address: Annotated[str, Form()],
     file: UploadFile = File(...),
 ):
-    with Session(engine) as session:
-        name = file.filename
-        if name is None:
-            raise HTTPException(status_code=400, detail="No file name provided")
-        data = await file.read()
-        collection = await collections.create_collection(session, name, data, user, transaction_address)
-        logger.info(f"Collection created sucessfully: {collection.id}")
-        return {"message": "Collection created successfully", "uuid": collection.id}
-
+    name = file.filename
+    if name is None:
+        raise HTTPException(status_code=400, detail="No file name provided")
+    # The upload is gone once the request is over, so keep a copy for the job
+    try:
+        ws = await jobs.stage_archive(file.file, file.size or 0)
+    except OverflowError as e:
+        raise HTTPException(status_code=507, detail=str(e))
+    job = jobs.submit_staged_ingest(user, name, transaction_address, ws)
+    logger.info(f"Collection ingest queued: {job.id}")
+    return {"message": "Collection ingest started", "job_id": job.id}
+
+
+# Get the progress of a collection being ingested
+@collections_router.get("/jobs/{job_id}")
+async def get_ingest_job(
+    user: Annotated[User, Depends(get_current_user)],
+    job_id: UUID,
+) -> IngestJob:
+    job = jobs.get_job(job_id, user)
+    if job is None:
+        logger.error("Ingest job not found.")
+        raise HTTPException(status_code=404, detail="Ingest job not found")
+    return job
+
+
+# Start a resumable upload of a collection archive, sent in numbered chunks
+@collections_router.post("/uploads", status_code=201)
+async def initiate_upload(
+    user: Annotated[User, Depends(get_current_user)],
+    name: Annotated[str, Form()],
+    transaction_address: Annotated[str, Form()],
+) -> ChunkedUpload:
+    upload = await uploads.initiate_upload(user, name, transaction_address)
+    logger.info(f"Chunked upload initiated: {upload.id}")
+    return upload
 
-class RawResponse(Response):
-    media_type = "binary/octet-stream"
 
-    def render(self, content: bytes) -> bytes:
-        return bytes([b ^ 0x54 for b in content])
+# Get the chunks received so far, to know which ones still need to be sent
+@collections_router.get("/uploads/{upload_id}")
+async def get_upload(
+    user: Annotated[User, Depends(get_current_user)],
+    upload_id: UUID,
+) -> ChunkedUpload:
+    upload = uploads.get_upload(upload_id, user)
+    if upload is None:
+        logger.error("Upload not found.")
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return upload
+
+
+# Send (or resend) one chunk, the request body is its raw content
+@collections_router.put("/uploads/{upload_id}/chunks/{index}")
+async def upload_chunk(
+    user: Annotated[User, Depends(get_current_user)],
+    upload_id: UUID,
+    index: int,
+    request: Request,
+    checksum: Annotated[str, Header(alias="X-Chunk-SHA256")],
+) -> ChunkInfo:
+    upload = uploads.get_upload(upload_id, user)
+    if upload is None:
+        logger.error("Upload not found.")
+        raise HTTPException(status_code=404, detail="Upload not found")
+    try:
+        chunk = await uploads.write_chunk(upload, index, request.stream(), checksum)
+    except OverflowError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError as e:
+        raise IntegrityBreach(str(e))
+    logger.info(f"Chunk {index} of upload {upload_id} received.")
+    return chunk
+
+
+# Assemble the chunks and create the collection from them, in the background
+@collections_router.post("/uploads/{upload_id}/finalize", status_code=202)
+async def finalize_upload(
+    user: Annotated[User, Depends(get_current_user)],
+    upload_id: UUID,
+    chunk_count: int,
+):
+    upload = uploads.get_upload(upload_id, user)
+    if upload is None:
+        logger.error("Upload not found.")
+        raise HTTPException(status_code=404, detail="Upload not found")
+    try:
+        job = uploads.finalize_upload(upload, user, chunk_count)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    logger.info(f"Chunked upload {upload_id} queued for ingest: {job.id}")
+    return {"message": "Collection ingest started", "job_id": job.id}
+
+
+@collections_router.delete("/uploads/{upload_id}")
+async def abort_upload(
+    user: Annotated[User, Depends(get_current_user)],
+    upload_id: UUID,
+):
+    upload = uploads.get_upload(upload_id, user)
+    if upload is None:
+        logger.error("Upload not found.")
+        raise HTTPException(status_code=404, detail="Upload not found")
+    await uploads.abort_upload(upload)
+    logger.info(f"Chunked upload {upload_id} aborted.")
+    return {"message": "Upload aborted successfully"}
 
 
 @collections_router.get("/signature")
 async def download_signature(
     user: Annotated[User | None, Depends(get_current_user)],
     col_uuid: UUID,
-):
+    request: Request,
+) -> Response:
     with Session(engine) as session:
         col = collections.get_collection_by_id(session, col_uuid, user)
         if col is None:
             logger.error("Collection not found.")
             raise HTTPException(status_code=404, detail="Collection not found")
-        return RawResponse(content=col.signature)
+        if col.signature is None:
+            logger.error("Collection has no signature.")
+            raise HTTPException(status_code=404, detail="Collection has no signature")
+        # The signature never changes, so its hash makes a strong ETag
+        version = collections.signature_version(col)
+        etag = f'"{version}"'
+        cached = not_modified(request, etag)
+        if cached is not None:
+            return cached
+        path = await collections.signature_file(col)
+        if path is not None:
+            # Kept in the cache until it has been sent
+            release = BackgroundTask(collections.signature_cache.release, version)
+            return file_response(request, path, etag, media_type=SIGNATURE_MEDIA_TYPE, background=release)
+        encoded = await asyncio.to_thread(obfuscate_signature, col.signature)
+    return stream_response(
+        request,
+        etag,
+        len(encoded),
+        lambda start, end: iter([encoded[start : end + 1]]),
+        media_type=SIGNATURE_MEDIA_TYPE,
+    )
 
 
 # TODO: test this
@@ -73,8 +209,11 @@ async def download_signature(
 async def download_collection(
     user: Annotated[User | None, Depends(get_optional_user)],
     col_uuid: UUID,
+    request: Request,
     email: str | None = None,
-) -> FileResponse:
+    stream: bool = False,
+    format: ArchiveFormat | None = None,
+) -> Response:
     # Verify user or email is provided
     if user is None and email is None:
         logger.error("No authentication method provided.")
@@ -102,23 +241,59 @@ async def download_collection(
                 status_code=403,
                 detail="You do not have permission to access this collection",
             )
-        file_path = await collections.download_collection(session, col, db_user)
-        return FileResponse(
+        # Chosen with the format parameter, or else from the Accept header
+        fmt = format
+        if fmt is None:
+            fmt = negotiate_format(request.headers.get("accept"))
+        if fmt not in available_formats():
+            raise HTTPException(status_code=406, detail=f"Archives can't be produced as {fmt.value} here")
+        filename = col.name if fmt == ArchiveFormat.tar else col.name.split(".")[0] + fmt.suffix
+        headers = {**attachment(filename), "Vary": "Accept"}
+        if stream:
+            # The archive outlives this session, so it is generated on a session of its own
+            return StreamingResponse(
+                stream_collection(col_uuid, db_user, fmt),
+                media_type=fmt.media_type,
+                headers=headers,
+            )
+        # Resumable through Range/If-Range, the ETag only changes when the archive content does
+        file_path, version, workspace = await collections.download_collection(session, col, db_user, fmt)
+        return file_response(
+            request,
             file_path,
-            filename=col.name,
+            etag=f'"{version}"',
+            media_type=fmt.media_type,
+            headers=headers,
+            # Kept until they have been sent, archives too large for the cache only live that long
+            background=BackgroundTask(collections.release_archive, version, workspace),
         )
 
 
+async def stream_collection(col_uuid: UUID, user: User, fmt: ArchiveFormat) -> AsyncIterator[bytes]:
+    with Session(engine) as session:
+        col = collections.get_collection_by_id(session, col_uuid, user)
+        if col is None:
+            logger.error("Collection disappeared before it could be streamed.")
+            return
+        async for block in collections.stream_collection(session, col, user, fmt):
+            yield block
+
+
 # TODO - make sure it is necessary (maybe for admin purposes only)
 @collections_router.get("/")
 async def get_all_collections(
     user: Annotated[User, Depends(get_current_user)],
-) -> Sequence[Collection]:
+    cursor: str | None = None,
+    limit: int | None = None,
+) -> Page[Collection]:
     with Session(engine) as session:
         try:
-            collections_list = collections.get_collections(session, user)
+            collections_list = collections.get_collections(session, user, cursor, page_size(limit))
             logger.info("Retrieved all collections successfully.")
             return collections_list
+        except HTTPException as http_exception:
+            logger.error(f"HTTP Exception occured: {http_exception}")
+            raise http_exception
         except Exception as e:
             logger.error(f"Failed to retrieve all collections: {e}")
             raise HTTPException(
@@ -131,14 +306,21 @@ async def get_all_collections(
 @collections_router.get("/user")
 async def get_user_collections(
     user: Annotated[User, Depends(get_current_user)],
-) -> Sequence[CollectionInfo]:
+    cursor: str | None = None,
+    limit: int | None = None,
+) -> Page[CollectionInfo]:
     with Session(engine) as session:
         try:
-            user_collections = [
-                CollectionInfo.populate(col) for col in collections.get_collections_by_user(session, user)
-            ]
+            page = collections.get_collections_by_user(session, user, cursor, page_size(limit))
+            user_collections = Page(
+                items=[CollectionInfo.populate(col) for col in page.items],
+                next_cursor=page.next_cursor,
+            )
             logger.info("Retrieved user collections successfully.")
             return user_collections
+        except HTTPException as http_exception:
+            logger.error(f"HTTP Exception occured: {http_exception}")
+            raise http_exception
         except Exception as e:
             logger.error(f"Failed to retrieve user collections: {e}")
             raise HTTPException(
@@ -231,7 +413,7 @@ async def delete_collection(
                 status_code=403,
                 detail="You do not have permission to write to this collection",
             )
-        collections.delete_collection(session, col)
+        await collections.delete_collection(session, col)
         logger.info("Collection deleted successfully.")
         return {"message": "Collection deleted successfully"}
 
@@ -330,6 +512,8 @@ async def filter_documents(
     name: str | None = None,
     max_size: int | None = None,
     last_access: datetime | None = None,
+    cursor: str | None = None,
+    limit: int | None = None,
 ):
     with Session(engine) as session:
         col = collections.get_collection_by_id(session, col_uuid, user)
@@ -339,7 +523,7 @@ async def filter_documents(
         if col.owner != user:
             logger.error("User is not the owner of this collection.")
             raise HTTPException(status_code=403, detail="You are not the owner of this Collection")
-        documents = collections.filter_documents(session, col, name, max_size, last_access)
+        documents = collections.filter_documents(session, col, name, max_size, last_access, cursor, page_size(limit))
         if documents is None:
             logger.error("No documents found.")
             raise HTTPException(status_code=404, detail="No documents found")
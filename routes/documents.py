@@ -1,15 +1,20 @@
 import logging
+import mimetypes
 from sqlite3 import IntegrityError
-from typing import Annotated
+from typing import Annotated, AsyncIterator
 from uuid import UUID
 
-from fastapi import APIRouter, Depends, HTTPException, UploadFile
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, UploadFile
 from sqlmodel import Session
 
 import storage.collection as collections
+from models.event import EventTypes
 from models.user import User
+from storage.event import register_event
 from storage.main import engine
 from utils.exceptions import IntegrityBreach
+from utils.http import attachment, stream_response
+from utils.pagination import page_size
 from utils.security import get_current_user
 
 logger = logging.getLogger(__name__)
@@ -48,8 +53,11 @@ async def update_document(
                     status_code=403,
                     detail="You do not have permission to write to this collection",
                 )
+            if not doc.is_current:
+                logger.error("Document has already been updated.")
+                raise IntegrityBreach("Document update failed. Verify the document hasn't already been updated")
             data = await file.read()
-            collections.update_document(session, user, col, doc, data)
+            await collections.update_document(session, user, col, doc, data)
             if doc.next is None:
                 logger.error(f"Document update failed.")
                 raise HTTPException(status_code=500, detail="Document update failed")
@@ -94,7 +102,7 @@ async def delete_document(
             if doc not in col.documents:
                 logger.error("Document not in the specified collection.")
                 raise HTTPException(status_code=404, detail="Document not in the specified collection")
-            collections.delete_document(session, doc)
+            await collections.delete_document(session, doc)
             logger.info("Document deleted successfully.")
             return {"message": "Document deleted successfully"}
         except HTTPException as http_exception:
@@ -110,6 +118,8 @@ async def search_documents(
     user: Annotated[User, Depends(get_current_user)],
     col_uuid: UUID,
     name: str,
+    cursor: str | None = None,
+    limit: int | None = None,
 ):
     with Session(engine) as session:
         try:
@@ -120,7 +130,7 @@ async def search_documents(
             if col.owner != user:
                 logger.error("This user is not the owner of this collection.")
                 raise HTTPException(status_code=403, detail="You are not the owner of this Collection")
-            documents = collections.search_documents(session, col, name)
+            documents = collections.search_documents(session, col, name, cursor, page_size(limit))
             if documents is None:
                 logger.error("No documents found.")
                 raise HTTPException(status_code=404, detail="No documents found")
@@ -167,3 +177,52 @@ async def get_document_history(
         except Exception as e:
             logger.error(f"An unexpected error occured: {e}")
             raise HTTPException(status_code=500, detail="Internal server error")
+
+
+# Stream the content of a single document, conditional (If-None-Match) and range requests are answered
+@documents_router.get("/{doc_uuid}/content")
+async def get_document_content(
+    user: Annotated[User, Depends(get_current_user)],
+    doc_uuid: UUID,
+    request: Request,
+) -> Response:
+    with Session(engine) as session:
+        doc = collections.get_document_by_id(session, doc_uuid)
+        if doc is None or doc.is_deleted():
+            logger.error("Document not found.")
+            raise HTTPException(status_code=404, detail="Document not found")
+        col = collections.get_collection_by_id(session, doc.collection_id, user)
+        if col is None:
+            logger.error("Collection not found.")
+            raise HTTPException(status_code=404, detail="Collection not found")
+        if not col.can_read(user):
+            logger.error("This user does not have permission to read this collection.")
+            raise HTTPException(
+                status_code=403,
+                detail="You do not have permission to read this collection",
+            )
+        # Content never changes for a given hash, so it makes a strong ETag
+        etag = f'"{doc.hash}"'
+        name, size = doc.name, doc.size
+        register_event(session, doc, user, EventTypes.Access)
+        session.commit()
+    media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    return stream_response(
+        request,
+        etag,
+        size,
+        # Only fetched from storage if the client doesn't have it already
+        lambda start, end: stream_document(doc_uuid, start, end),
+        media_type=media_type,
+        headers=attachment(name),
+    )
+
+
+async def stream_document(doc_uuid: UUID, start: int, end: int) -> AsyncIterator[bytes]:
+    with Session(engine) as session:
+        doc = collections.get_document_by_id(session, doc_uuid)
+        if doc is None:
+            logger.error("Document disappeared before it could be streamed.")
+            return
+        async for chunk in collections.read_document(session, doc, start, end):
+            yield chunk
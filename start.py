@@ -12,8 +12,11 @@ import routes
 import routes.collections
 import routes.documents
 import routes.users
+import storage.collection as collections
+import storage.jobs as jobs
+import storage.workspaces as workspaces
 from models.user import User
-from storage.main import DB_URL, TEMP_FOLDER, TEST_MODE, engine
+from storage.main import DB_URL, TEMP_FOLDER, TEST_MODE, engine, store
 from utils.security import get_current_user
 
 
@@ -24,6 +27,8 @@ def on_startup():
     SQLModel.metadata.create_all(engine)
     if not os.path.exists(TEMP_FOLDER):
         os.makedirs(TEMP_FOLDER)
+    collections.archive_cache.load()
+    collections.signature_cache.load()
 
 
 def on_shutdown():
@@ -39,7 +44,13 @@ def on_shutdown():
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     on_startup()
+    await store.startup()
+    await workspaces.start_janitor()
+    await jobs.start_workers()
     yield
+    await jobs.stop_workers()
+    await workspaces.stop_janitor()
+    await store.shutdown()
     on_shutdown()
 
 
@@ -1,17 +1,71 @@
 import asyncio
+import hashlib
+import io
 import logging
+import os
+from typing import AsyncIterator, BinaryIO, Callable
+from uuid import UUID
 
-from sqlmodel import Session
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, select, update
 
-import storage.collection
 import utils.paperless as ppl
 from models.collection import Collection, Document, DocumentIntake, EDocumentIntake
-from models.paperless import CollectionPaperless, DocumentPaperless, UserPaperless
+from models.job import IngestJob
+from models.paperless import (
+    BlobPaperless,
+    CollectionPaperless,
+    DocumentPaperless,
+    UserPaperless,
+)
 from models.user import User
+from storage.main import (
+    CACHE_FOLDER,
+    CONTENT_CACHE_MB,
+    PAPERLESS_INITIAL_CONCURRENCY,
+    PAPERLESS_LATENCY_TARGET,
+    PAPERLESS_MAX_CONCURRENCY,
+    PAPERLESS_MIN_CONCURRENCY,
+    PAPERLESS_RETRIES,
+)
+from utils.cache import LRUFileCache
+from utils.concurrency import AIMDLimiter, retry
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 
+# Shared by every ingest, so concurrent collections don't overwhelm Paperless-ngx together
+upload_limiter = AIMDLimiter(
+    initial=PAPERLESS_INITIAL_CONCURRENCY,
+    minimum=PAPERLESS_MIN_CONCURRENCY,
+    maximum=PAPERLESS_MAX_CONCURRENCY,
+    latency_target=PAPERLESS_LATENCY_TARGET,
+)
+
+# Local copies of content downloaded from Paperless-ngx, addressed by hash as documents never change
+content_cache = LRUFileCache(f"{CACHE_FOLDER}/content", CONTENT_CACHE_MB * 1024 * 1024)
+
+# Length of the UUID appended to content on upload, see upload_blob
+SUFFIX_LENGTH = 36
+
+# Content being uploaded right now, concurrent ingests of the same content wait for it instead of uploading it again.
+# Only covers this process, when several processes upload the same content the hash (primary key of the blobs)
+# lets one of them register it and the others drop their copy, see upload_blob
+uploading: dict[str, asyncio.Future[None]] = {}
+
+
+async def startup():
+    """Open the shared Paperless-ngx client, connections are then reused for the life of the app."""
+    ppl.open_client()
+    logger.debug("Opened Paperless-ngx client")
+    await asyncio.to_thread(content_cache.load)
+
+
+async def shutdown():
+    """Close the shared Paperless-ngx client."""
+    await ppl.close_client()
+    logger.debug("Closed Paperless-ngx client")
+
 
 async def create_user(db: Session, user: User, **kwargs):
     """
@@ -39,33 +93,167 @@ async def create_collection(db: Session, collection: Collection, **kwargs):
     logger.debug(f"Created collection: {collection}")
 
 
-async def create_document(db: Session, document: EDocumentIntake, collection: Collection, user: User, **kwargs):
+def link_blob(session: Session, paperless_id: int, doc_ids: list[UUID]):
+    for doc_id in doc_ids:
+        session.add(DocumentPaperless(doc_id=doc_id, paperless_id=paperless_id))
+
+
+def acquire_blob(db: Session, file_hash: str, doc_ids: list[UUID]) -> int | None:
+    """
+    Point the given documents at the blob holding the given content, returning its Paperless-ngx document ID.
+    Returns None if there is no such blob yet.
+    Committed on its own right away, along with the references, so a concurrent delete never removes content
+    that is about to be used. The caller's session must not hold pending writes, as SQLite only has one writer.
     """
-    Create a document in Paperless-ngx.
+    with Session(db.get_bind()) as session:
+        # Incremented in the database, so other processes adding references at the same time aren't lost
+        statement = (
+            update(BlobPaperless)
+            .where(BlobPaperless.hash == file_hash)  # type: ignore
+            .values(ref_count=BlobPaperless.ref_count + len(doc_ids))
+        )
+        if session.exec(statement).rowcount == 0:  # type: ignore
+            return None
+        blob = session.get(BlobPaperless, file_hash)
+        if blob is None:
+            return None
+        link_blob(session, blob.paperless_id, doc_ids)
+        session.commit()
+        return blob.paperless_id
 
-    For kwargs usage, see the create_document function documentation.
+
+async def upload_blob(
+    db: Session,
+    file_hash: str,
+    title: str,
+    source: Callable[[], BinaryIO],
+    collection: Collection,
+    user: User,
+    doc_ids: list[UUID],
+    job: IngestJob | None,
+) -> int:
+    """
+    Upload content to Paperless-ngx and register it as a blob the given documents point at.
+    The ID of the first document is appended to the content, so Paperless-ngx doesn't reject it as a duplicate.
     """
+    count = len(doc_ids)
     if collection.paperless is None:
         logger.error("Given collection has no paperless representation")
         raise ValueError("Given collection has no paperless representation")
     tag_id = collection.paperless.paperless_id
     correspondent_id = user.paperless.paperless_id  # type: ignore
-    # Add UUID to avoid duplicate
-    data = document.content + str(document.doc_id).encode()
-    task_id = await ppl.create_document(
-        title=document.name,
-        document=data,
-        correspondent=correspondent_id,
-        tags=tag_id,
+
+    async def upload() -> str:
+        # Open the content only at upload time, it is streamed with the UUID sent after it to avoid duplicates
+        return await ppl.upload_document(
+            source(),
+            str(doc_ids[0]).encode(),
+            title=title,
+            correspondent=correspondent_id,
+            tags=tag_id,
+        )
+
+    # Uploading and consuming are retried separately, so a failed poll doesn't upload the document again
+    async with upload_limiter.slot():
+        task_id = await retry(upload, PAPERLESS_RETRIES, ppl.is_transient)
+        if job is not None:
+            job.advance("uploaded", count)
+        paperless_id = await retry(lambda: ppl.verify_document(task_id), PAPERLESS_RETRIES, ppl.is_transient)
+    if job is not None:
+        job.advance("verified", count)
+    try:
+        with Session(db.get_bind()) as session:
+            session.add(BlobPaperless(hash=file_hash, paperless_id=paperless_id, ref_count=count))
+            link_blob(session, paperless_id, doc_ids)
+            session.commit()
+    except IntegrityError:
+        # Another process stored the same content in the meantime, use theirs and drop this copy
+        existing = acquire_blob(db, file_hash, doc_ids)
+        if existing is None:
+            raise
+        logger.info(f"Blob {file_hash} was stored concurrently as document {existing}, dropping {paperless_id}")
+        try:
+            await delete_paperless_document(paperless_id)
+        except Exception as e:
+            logger.error(f"Could not delete document {paperless_id} from Paperless-ngx: {e!r}")
+        return existing
+    logger.debug(f"Uploaded blob {file_hash} as document {paperless_id}")
+    return paperless_id
+
+
+async def store_blob(
+    db: Session,
+    file_hash: str,
+    title: str,
+    source: Callable[[], BinaryIO],
+    collection: Collection,
+    user: User,
+    doc_ids: list[UUID],
+    job: IngestJob | None = None,
+) -> int:
+    """
+    Point the given documents at the Paperless-ngx document holding the given content, returning its ID.
+    Content is only uploaded if no blob holds it yet, otherwise the existing document is reused.
+    """
+    count = len(doc_ids)
+    while True:
+        paperless_id = acquire_blob(db, file_hash, doc_ids)
+        if paperless_id is not None:
+            logger.debug(f"Reusing blob {file_hash} (document {paperless_id}) for {count} documents")
+            if job is not None:
+                job.advance("uploaded", count)
+                job.advance("verified", count)
+            return paperless_id
+        pending = uploading.get(file_hash)
+        if pending is None:
+            break
+        # Someone else is uploading this content, wait for them and check again
+        await asyncio.shield(pending)
+    done = asyncio.get_running_loop().create_future()
+    uploading[file_hash] = done
+    try:
+        return await upload_blob(db, file_hash, title, source, collection, user, doc_ids, job)
+    finally:
+        del uploading[file_hash]
+        done.set_result(None)
+
+
+async def link_documents(
+    db: Session,
+    doc_ids: list[UUID],
+    file_hash: str,
+    title: str,
+    source: Callable[[], BinaryIO],
+    collection: Collection,
+    user: User,
+    job: IngestJob | None = None,
+):
+    """
+    Point the given documents, which all have the same content, at the blob holding it.
+    source opens the content, should it need to be uploaded.
+    """
+    await store_blob(db, file_hash, title, source, collection, user, doc_ids, job)
+
+
+async def create_document(db: Session, document: EDocumentIntake, collection: Collection, user: User, **kwargs):
+    """
+    Create a document in Paperless-ngx, unless its content is already stored there.
+
+    For kwargs usage, see the create_document function documentation.
+    If an IngestJob is given as job, its uploaded and verified counters are advanced.
+    """
+    await link_documents(
+        db, [document.doc_id], document.hash, document.name, document.open, collection, user, kwargs.get("job")
     )
-    doc_id = await ppl.verify_document(task_id)
-    doc = storage.collection.get_document_by_id(db, document.doc_id)
-    if doc is None:
-        logger.error(f"Document with id {document.doc_id} not found. Mapping is corrupted.")
-        raise ValueError(f"Document with id {document.doc_id} not found. Mapping is corrupted.")
-    doc.paperless = DocumentPaperless(paperless_id=doc_id)
-    db.add(doc)
-    logger.debug(f"Created document: {doc}")
+    logger.debug(f"Created document: {document.doc_id}")
+
+
+async def store_document(db: Session, document: Document, content: bytes, collection: Collection, user: User):
+    """
+    Store the content of a document that isn't part of an ingest (e.g. an update).
+    """
+    await link_documents(db, [document.id], document.hash, document.name, lambda: io.BytesIO(content), collection, user)
+    logger.debug(f"Stored document: {document.id}")
 
 
 async def upload_folder(
@@ -77,28 +265,134 @@ async def upload_folder(
 ):
     """
     Create all documents in Paperless-ngx.
+    Each distinct content is uploaded at most once, and only if no blob holds it already.
+    How many are in flight at once is adapted to how Paperless-ngx copes, see upload_limiter.
     """
-    futures = []
+    job = kwargs.get("job")
+    by_hash: dict[str, list[EDocumentIntake]] = {}
     for mapping in mappings:
-        futures.append(create_document(db, mapping, collection, user))
+        by_hash.setdefault(mapping.hash, []).append(mapping)
+    logger.debug(f"Storing {len(mappings)} documents with {len(by_hash)} distinct contents")
     async with asyncio.TaskGroup() as tg:
-        for future in futures:
-            tg.create_task(future)
+        for file_hash, documents in by_hash.items():
+            doc_ids = [document.doc_id for document in documents]
+            first = documents[0]
+            tg.create_task(link_documents(db, doc_ids, file_hash, first.name, first.open, collection, user, job))
     return collection
 
 
-async def download_document(db: Session, doc: Document, **kwargs) -> DocumentIntake:
+def release_blobs(db: Session, references: dict[int, int]) -> list[int]:
     """
-    Download a document from Paperless-ngx.
-    Returned DocumentIntake object has no parent_folder.
+    Drop the given number of references from each Paperless-ngx document.
+    Returns the documents nothing references anymore.
+    """
+    orphaned = []
+    with Session(db.get_bind()) as session:
+        for paperless_id, count in references.items():
+            blob = session.exec(select(BlobPaperless).where(BlobPaperless.paperless_id == paperless_id)).first()
+            if blob is None:
+                # Duplicate uploaded before blobs existed, its only document was the one released
+                orphaned.append(paperless_id)
+                continue
+            blob.ref_count -= count
+            if blob.ref_count > 0:
+                session.add(blob)
+                continue
+            session.delete(blob)
+            orphaned.append(paperless_id)
+        session.commit()
+    return orphaned
+
+
+async def delete_paperless_document(paperless_id: int):
+    async with upload_limiter.slot():
+        await retry(lambda: ppl.delete_document(paperless_id), PAPERLESS_RETRIES, ppl.is_transient)
+
+
+async def release_documents(db: Session, docs: list[Document], **kwargs):
+    """
+    Drop the references the given documents hold on their content and commit.
+    Content no document references anymore is deleted from Paperless-ngx.
     """
-    if doc.paperless is None:
+    references: dict[int, int] = {}
+    for doc in docs:
+        if doc.paperless is None:
+            continue
+        references[doc.paperless.paperless_id] = references.get(doc.paperless.paperless_id, 0) + 1
+        db.delete(doc.paperless)
+    db.commit()
+    orphaned = release_blobs(db, references)
+    logger.debug(f"Released {len(docs)} documents, deleting {len(orphaned)} unreferenced blobs")
+
+    results = await asyncio.gather(
+        *[delete_paperless_document(paperless_id) for paperless_id in orphaned], return_exceptions=True
+    )
+    for paperless_id, result in zip(orphaned, results):
+        if isinstance(result, Exception):
+            # Left behind in Paperless-ngx, but nothing points at it anymore
+            logger.error(f"Could not delete document {paperless_id} from Paperless-ngx: {result!r}")
+
+
+def find_paperless_id(db: Session, doc: Document) -> int:
+    if doc.paperless is not None:
+        return doc.paperless.paperless_id
+    blob = db.get(BlobPaperless, doc.hash)
+    if blob is None:
         logger.error("Given document has no paperless representation")
         raise ValueError("Given document has no paperless representation")
-    paperless_id = doc.paperless.paperless_id
-    content, name = await ppl.download_document(paperless_id)
-    # Remove UUID bytes from the content
-    content = content[: -len(str(doc.id).encode())]
-    name = doc.name
-    logger.debug(f"Downloaded document: {name}")
-    return DocumentIntake(name=name, content=content, size=len(content), hash=doc.hash, parent_folder=None)
+    return blob.paperless_id
+
+
+async def stream_document(db: Session, doc: Document, **kwargs) -> AsyncIterator[bytes]:
+    """
+    Stream the content of a document, from the local content cache when it holds a copy, from Paperless-ngx otherwise.
+    Content read in full from Paperless-ngx is written to the cache on the way, if it matches its hash.
+    """
+    path = await asyncio.to_thread(content_cache.lookup, doc.hash)
+    file = None
+    if path is not None:
+        try:
+            file = open(path, "rb")
+        except FileNotFoundError:
+            # Evicted in between
+            file = None
+    if file is not None:
+        logger.debug(f"Reading document from cache: {doc.name}")
+        with file:
+            while chunk := await asyncio.to_thread(file.read, ppl.DOCUMENT_CHUNK_SIZE):
+                yield chunk
+        return
+
+    paperless_id = find_paperless_id(db, doc)
+    temp = await asyncio.to_thread(content_cache.temp_path, doc.hash) if content_cache.enabled else None
+    cached = open(temp, "wb") if temp is not None else None
+    content_hash = hashlib.sha256()
+    try:
+        # The UUID added on upload is trimmed off while streaming
+        async for chunk in ppl.stream_document(paperless_id, trim=SUFFIX_LENGTH):
+            if cached is not None:
+                content_hash.update(chunk)
+                cached.write(chunk)
+            yield chunk
+        if cached is not None:
+            cached.close()
+            if content_hash.hexdigest() == doc.hash:
+                await asyncio.to_thread(content_cache.add_file, doc.hash, temp)
+            else:
+                logger.warning(f"Downloaded content does not match hash {doc.hash}, not caching it")
+        logger.debug(f"Downloaded document: {doc.name}")
+    finally:
+        # Left over when the content wasn't cached, or the stream was abandoned halfway
+        if cached is not None:
+            cached.close()
+            if temp is not None and os.path.exists(temp):
+                os.remove(temp)
+
+
+async def download_document(db: Session, doc: Document, **kwargs) -> DocumentIntake:
+    """
+    Download a document, see stream_document.
+    Returned DocumentIntake object has no parent_folder.
+    """
+    content = b"".join([chunk async for chunk in stream_document(db, doc)])
+    return DocumentIntake(name=doc.name, content=content, size=len(content), hash=doc.hash, parent_folder=None)
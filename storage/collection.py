@@ -1,13 +1,17 @@
+import asyncio
 import hashlib
-import io
 import logging
+import os
+import shutil
 import tarfile
 from datetime import datetime
-from typing import Sequence
+from typing import AsyncIterator, BinaryIO
 from uuid import UUID
 
-from sqlmodel import Session, select
+from sqlmodel import Session, or_, select
 
+import storage.workspaces as workspaces
+from models.archive import ArchiveFormat
 from models.collection import (
     Collection,
     CollectionPermission,
@@ -17,50 +21,83 @@ from models.collection import (
 )
 from models.event import DocumentEvent, EventTypes
 from models.folder import Folder, FolderIntake
+from models.job import IngestJob, JobStatus
+from models.page import Page
 from models.update import Update
 from models.user import User
+from models.workspace import Workspace
 from storage.event import register_event
 from storage.folder import (
     create_folder,
-    populate_documents,
+    extract_archive,
     recreate_structure,
+    stream_tar,
     walk_folder,
-    write_folder,
+    walk_structure,
+)
+from storage.main import (
+    ARCHIVE_CACHE_MB,
+    CACHE_FOLDER,
+    PAGE_SIZE,
+    SIGNATURE_CACHE_MB,
+    store,
 )
-from storage.main import store, TEMP_FOLDER
 from storage.user import get_user_by_id
-from utils.security import verify_manifest
+from utils.cache import LRUFileCache
+from utils.compression import compress_stream
+from utils.pagination import make_page, paginate
+from utils.security import obfuscate_signature, verify_manifest
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 
+# Archives built for downloads, keyed by the fingerprint of what they contain (see archive_fingerprint)
+archive_cache = LRUFileCache(f"{CACHE_FOLDER}/archives", ARCHIVE_CACHE_MB * 1024 * 1024)
+# Keys of the archives cached for each collection, so they can be dropped as soon as the collection changes
+archive_keys: dict[UUID, set[str]] = {}
+
+# Obfuscated signatures, keyed by the hash of the signature (signatures never change)
+signature_cache = LRUFileCache(f"{CACHE_FOLDER}/signatures", SIGNATURE_CACHE_MB * 1024 * 1024)
 
-def get_collections(db: Session, user: User) -> Sequence[Collection]:
+
+def get_collections(db: Session, user: User, cursor: str | None = None, limit: int = PAGE_SIZE) -> Page[Collection]:
     logger.debug(f"Retrieving collections for user {user.id}.")
-    statement = select(Collection)
+    # Same as Collection.can_view, the collections the user owns or was given view permission on
+    viewable = (
+        select(CollectionPermission.collection_id)
+        .where(CollectionPermission.user_id == user.id)
+        .where(CollectionPermission.permission == Permission.view)
+    )
+    # Deleted collections are left out
+    statement = (
+        select(Collection)
+        .where(Collection.deleted_at == None)  # noqa: E711
+        .where(or_(Collection.owner_id == user.id, Collection.id.in_(viewable)))  # type: ignore
+    )
+    statement = paginate(statement, Collection.id, cursor, limit)
     results = db.exec(statement)
-    collections = results.all()
-    # Remove deleted collections
-    collections = [col for col in collections if not col.is_deleted()]
-    # Verify user can view these collections
-    collections = [col for col in collections if col.can_view(user)]
-    for col in collections:
+    page = make_page(results.all(), limit, lambda col: col.id)
+    for col in page.items:
         register_event(db, col, user, EventTypes.Access)
-    logger.debug(f"Retrieved {len(collections)} collections for user {user.id}.")
-    return collections
+    logger.debug(f"Retrieved {len(page.items)} collections for user {user.id}.")
+    return page
 
 
-def get_collections_by_user(db: Session, user: User) -> Sequence[Collection]:
+def get_collections_by_user(
+    db: Session, user: User, cursor: str | None = None, limit: int = PAGE_SIZE
+) -> Page[Collection]:
     logger.debug(f"Retrieving collections owned by user {user.id}.")
-    statement = select(Collection).where(Collection.owner_id == user.id)
+    # Deleted collections are left out
+    statement = (
+        select(Collection).where(Collection.owner_id == user.id).where(Collection.deleted_at == None)  # noqa: E711
+    )
+    statement = paginate(statement, Collection.id, cursor, limit)
     results = db.exec(statement)
-    collections = results.all()
-    # Remove deleted collections
-    collections = [col for col in collections if not col.is_deleted()]
-    for col in collections:
+    page = make_page(results.all(), limit, lambda col: col.id)
+    for col in page.items:
         register_event(db, col, user, EventTypes.Access)
-    logger.debug(f"Retrieved {len(collections)} collections owned by user {user.id}.")
-    return collections
+    logger.debug(f"Retrieved {len(page.items)} collections owned by user {user.id}.")
+    return page
 
 
 def get_collection_by_id(db: Session, col_id: UUID, user: User) -> Collection | None:
@@ -91,15 +128,23 @@ def get_document_by_id(db: Session, doc_id: UUID) -> Document | None:
 async def create_collection(
     db: Session,
     name: str,
-    data: bytes,
+    archive: BinaryIO,
     user: User,
     transaction_address: str,
+    job: IngestJob | None = None,
 ) -> Collection:
+    """
+    Create a collection from a tar archive containing its signature, manifest and files.
+    When run as a background job, its progress is reported on the given IngestJob.
+    """
 
     logger.debug(f"Creating collection {name} for user {user.id}.")
 
     # Create the collection in the database
     collection = Collection(name=name)
+    if job is not None:
+        job.collection_id = collection.id
+        job.status = JobStatus.extracting
     db_folder = Folder(name=name, collection_id=collection.id)
     collection.owner = user
     collection.folder = db_folder
@@ -111,38 +156,61 @@ async def create_collection(
     await store.create_collection(db, collection, name=name)
     logger.debug(f"Collection '{name}' created in Paperless-ngx.")
 
-    # Extract tarfile containing signature, manifest and files
-    archive_name = name.split(".")[0]
-    f = io.BytesIO(data)
-    folder_name = f"{TEMP_FOLDER}/{archive_name}"
-    with tarfile.open(fileobj=f) as tar:
-        tar.extractall(folder_name, filter="data")
-    logger.debug(f"Extracted tarfile to {folder_name} successfully.")
-
-    logger.debug("Reading signature and hashes from extracted files.")
-    with open(folder_name + "/hashes.asics", "rb") as f:
-        signature = f.read()
-    collection.signature = signature
-
-    with open(folder_name + "/hashes.json", "r") as f:
-        hashes = f.read()
-    collection.manifest = hashes
-    manifest_hash = hashlib.sha256(hashes.encode()).hexdigest()
-    logger.debug("Read signature and hashes successfully.")
-
-    # Check manifest hash against the blockchain event
-    logger.debug("Verifying manifest hash against the blockchain event.")
-    if not verify_manifest(manifest_hash, transaction_address):
-        logger.error("Manifest hash does not match the transaction address.")
-        raise AssertionError("Manifest hash does not match the transaction address")
-
-    logger.debug("Walking the folder structure and creating it in the database.")
-    root = walk_folder(folder_name + "/archive", user)
-    # Create the folder structure in the database
-    mappings = create_folder(db, root, db_folder)
-    # Ingest the documents into Paperless-ngx
-    logger.debug("Uploading documents into Paperless-ngx.")
-    await store.upload_folder(db, mappings, collection, user)
+    # Extracted files stay in a workspace of their own until they are uploaded, reserved as they are extracted.
+    # Nothing is waited for: the archive itself already holds room that is only given back once the job is over
+    ws = await workspaces.open_workspace(f"ingest of {name}", job=job)
+    loop = asyncio.get_running_loop()
+    try:
+        # Extract tarfile containing signature, manifest and files, member by member off the event loop
+        archive_name = name.split(".")[0]
+        folder_name = f"{workspaces.workspace_path(ws)}/{archive_name}"
+        documents_folder = os.path.normpath(folder_name + "/archive") + os.sep
+
+        def on_hashed(path: str):
+            # Only documents count towards progress, the signature and manifest are not in files_total
+            if job is not None and path.startswith(documents_folder):
+                job.advance("hashed")
+
+        def on_extracting(size: int):
+            # Called from the extracting thread, the quota is kept by the event loop
+            grow = workspaces.adjust_reservation(ws, size)
+            asyncio.run_coroutine_threadsafe(grow, loop).result()
+
+        file_hashes = await asyncio.to_thread(extract_archive, archive, folder_name, on_hashed, on_extracting)
+        logger.debug(f"Extracted tarfile to {folder_name} successfully.")
+
+        logger.debug("Reading signature and hashes from extracted files.")
+        with open(folder_name + "/hashes.asics", "rb") as f:
+            signature = f.read()
+        collection.signature = signature
+
+        with open(folder_name + "/hashes.json", "r") as f:
+            hashes = f.read()
+        collection.manifest = hashes
+        manifest_hash = hashlib.sha256(hashes.encode()).hexdigest()
+        logger.debug("Read signature and hashes successfully.")
+
+        # Check manifest hash against the blockchain event
+        logger.debug("Verifying manifest hash against the blockchain event.")
+        if not verify_manifest(manifest_hash, transaction_address):
+            logger.error("Manifest hash does not match the transaction address.")
+            raise ValueError("Manifest hash does not match the transaction address")
+
+        logger.debug("Walking the folder structure and creating it in the database.")
+        root = await asyncio.to_thread(walk_folder, folder_name + "/archive", user, file_hashes)
+        # Create the folder structure in the database
+        if job is not None:
+            job.status = JobStatus.storing
+        # Large structures take a while to insert, which would hold up every other request on the event loop
+        mappings = await asyncio.to_thread(create_folder, db, root, db_folder, True)
+        # Ingest the documents into Paperless-ngx
+        logger.debug("Uploading documents into Paperless-ngx.")
+        if job is not None:
+            job.files_total = len(mappings)
+            job.status = JobStatus.uploading
+        await store.upload_folder(db, mappings, collection, user, job=job)
+    finally:
+        await workspaces.close_workspace(ws)
 
     db.add(collection)
     db.commit()
@@ -157,7 +225,7 @@ def get_collection_hierarchy(db: Session, col: Collection, user: User) -> Folder
     return structure
 
 
-def update_document(db: Session, user: User, col: Collection, doc: Document, file: bytes):
+async def update_document(db: Session, user: User, col: Collection, doc: Document, file: bytes):
     logger.debug(f"Updating document {doc.id} in collection {col.id} by user {user.id}.")
     file_hash = hashlib.sha256(file).hexdigest()
     new_document = Document(
@@ -167,41 +235,83 @@ def update_document(db: Session, user: User, col: Collection, doc: Document, fil
         collection_id=col.id,
         access_from_date=doc.access_from_date,
         hash=file_hash,
+        lineage_id=doc.lineage_id,
+        version_no=doc.version_no + 1,
     )
+    # Stored before anything is written here, as blobs are counted on a session of their own
+    # (the user usually comes from the session that authenticated them, so it is merged into this one first)
+    await store.store_document(db, new_document, file, col, db.merge(user))
     update = Update(user_id=user.id, previous_id=doc.id, updated_id=new_document.id)
     db.add(update)
     db.add(new_document)
+    doc.is_current = False
+    db.add(doc)
     db.commit()
+    invalidate_archive(col.id)
     logger.debug(f"Document {doc.id} updated successfully in collection {col.id} by user {user.id}.")
     return doc
 
 
-def delete_document(db: Session, doc: Document):
+async def read_document(db: Session, doc: Document, start: int, end: int) -> AsyncIterator[bytes]:
+    """Yield the content of the document from storage, from byte start to byte end (both included)."""
+    logger.debug(f"Reading bytes {start}-{end} of document {doc.id}.")
+    position = 0
+    stream = store.stream_document(db, doc)
+    try:
+        async for chunk in stream:
+            chunk_end = position + len(chunk)
+            if chunk_end > start:
+                # Copied out of the view, as responses only accept bytes (storage may hand out memoryviews)
+                yield bytes(memoryview(chunk)[max(0, start - position) : end + 1 - position])
+            position = chunk_end
+            if position > end:
+                break
+    finally:
+        await stream.aclose()
+
+
+async def delete_document(db: Session, doc: Document):
     logger.debug(f"Deleting document {doc.id} from collection {doc.collection_id}.")
     register_event(db, doc, doc.collection.owner, EventTypes.Delete)
+    await store.release_documents(db, [doc])
     db.commit()
+    invalidate_archive(doc.collection_id)
     logger.debug(f"Document {doc.id} deleted successfully from collection {doc.collection_id}.")
     return True
 
 
-def delete_collection(db: Session, col: Collection):
+async def delete_collection(db: Session, col: Collection):
     logger.debug(f"Deleting collection {col.id}.")
     register_event(db, col, col.owner, EventTypes.Delete)
+    # Documents deleted before already let go of their content
+    await store.release_documents(db, [doc for doc in col.documents if not doc.is_deleted()])
     db.commit()
+    invalidate_archive(col.id)
     logger.debug(f"Collection {col.id} deleted successfully.")
     return True
 
 
-def search_documents(db: Session, col: Collection, name: str) -> list[Document] | None:
+def search_documents(
+    db: Session, col: Collection, name: str, cursor: str | None = None, limit: int = PAGE_SIZE
+) -> Page[Document] | None:
     logger.debug(f"Searching for documents with name {name} in collection {col.id}.")
-    docs = [doc for doc in col.documents if doc.name == name and doc.next is None]
-    for doc in docs:
+    # Only the latest version of each document
+    statement = (
+        select(Document)
+        .where(Document.collection_id == col.id)
+        .where(Document.name == name)
+        .where(Document.is_current == True)  # noqa: E712
+    )
+    statement = paginate(statement, Document.id, cursor, limit)
+    results = db.exec(statement)
+    page = make_page(results.all(), limit, lambda doc: doc.id)
+    for doc in page.items:
         register_event(db, doc, col.owner, EventTypes.Access)
-    if len(docs) == 0:
+    if len(page.items) == 0:
         logger.warning(f"No documents found with name {name} in collection {col.id}.")
         return None
-    logger.debug(f"Found {len(docs)} documents with name {name} in collection {col.id}.")
-    return docs
+    logger.debug(f"Found {len(page.items)} documents with name {name} in collection {col.id}.")
+    return page
 
 
 def filter_documents(
@@ -210,7 +320,9 @@ def filter_documents(
     name: str | None,
     max_size: int | None,
     last_access: datetime | None,
-):
+    cursor: str | None = None,
+    limit: int = PAGE_SIZE,
+) -> Page[Document]:
     logger.debug(f"Filtering documents in collection {col.id}.")
     statement = select(Document).where(Document.collection_id == col.id)
     if name is not None:
@@ -219,42 +331,187 @@ def filter_documents(
     if max_size is not None:
         logger.debug(f"Applying max size filter: {max_size}.")
         statement = statement.where(Document.size <= max_size)
-    results = db.exec(statement)
-    documents = results.all()
     if last_access is not None:
         logger.debug(f"Applying last access filter: {last_access}.")
-        documents = [doc for doc in documents if doc.last_access() >= last_access]
-    for doc in documents:
+        # Never accessed counts as accessed last at the end of time (see Document.last_access)
+        statement = statement.where(
+            or_(Document.last_access_at >= last_access, Document.last_access_at == None)  # noqa: E711
+        )
+    statement = paginate(statement, Document.id, cursor, limit)
+    results = db.exec(statement)
+    page = make_page(results.all(), limit, lambda doc: doc.id)
+    for doc in page.items:
         register_event(db, doc, col.owner, EventTypes.Access)
-    logger.debug(f"Filtered {len(documents)} documents in collection {col.id}.")
-    return documents
+    logger.debug(f"Filtered {len(page.items)} documents in collection {col.id}.")
+    return page
 
 
 def get_document_history(db: Session, doc: Document) -> list[Update | DocumentEvent]:
     logger.debug(f"Retrieving history for document {doc.id}.")
-    events = []
-    while doc.next is not None:
-        events.append(doc.next)
-        events.extend(doc.events)
-        doc = doc.next.new
+    # The updates from this version on and the events of the versions they replaced
+    versions = (
+        select(Document.id)
+        .where(Document.lineage_id == doc.lineage_id)
+        .where(Document.version_no >= doc.version_no)
+        .where(Document.is_current == False)  # noqa: E712
+    )
+    events: list[Update | DocumentEvent] = []
+    events.extend(db.exec(select(Update).where(Update.previous_id.in_(versions))).all())  # type: ignore
+    events.extend(db.exec(select(DocumentEvent).where(DocumentEvent.document_id.in_(versions))).all())  # type: ignore
     events.sort(key=lambda x: x.timestamp, reverse=True)
     logger.debug(f"History retrieved successfully for document {doc.id}.")
     return events
 
 
-async def download_collection(db: Session, col: Collection, user: User) -> str:
-    logger.debug(f"Downloading collection {col.id} by user {user.id}.")
-    structure = recreate_structure(db, col.folder, user)
-    structure = await populate_documents(db, structure)
+def signature_version(col: Collection) -> str:
+    """SHA-256 of the signature of the collection, hashed from the row so nothing is kept per collection."""
+    if col.signature is None:
+        raise ValueError("Collection has no signature")
+    return hashlib.sha256(col.signature).hexdigest()
+
+
+async def signature_file(col: Collection) -> str | None:
+    """
+    Path of the obfuscated signature of the collection, encoded once and then served from the signature cache.
+    The entry is pinned until signature_cache.release is called with the signature version, once it has been sent.
+    None when it can't be cached, the caller then has to encode it with obfuscate_signature.
+    """
+    version = signature_version(col)
+    path = await asyncio.to_thread(signature_cache.lookup, version, True)
+    if path is not None:
+        return path
+    if col.signature is None or not signature_cache.enabled:
+        return None
 
-    folder_path = f"{TEMP_FOLDER}/{col.name}"
-    write_folder(structure, folder_path)
-    with open(folder_path + ".tar", "wb") as tar:
-        with tarfile.open(fileobj=tar, mode="w") as tar:
-            tar.add(folder_path, arcname=col.name)
+    def encode() -> str | None:
+        if not signature_cache.put(version, obfuscate_signature(col.signature), pin=True):
+            return None
+        return signature_cache.path(version)
+
+    return await asyncio.to_thread(encode)
+
+
+def archive_fingerprint(col: Collection, structure: FolderIntake) -> str:
+    """
+    Identify the archive of a structure from recreate_structure by its folders and the path, ID and hash of every
+    current document, in the order they are written to the archive.
+    Updating, deleting or renaming a document (or renaming the collection) changes it.
+    """
+    fingerprint = hashlib.sha256(str(col.id).encode())
+    for path, item in walk_structure(structure, col.name):
+        entry = f"{path}\0{item.id}\0{item.hash}" if isinstance(item, Document) else f"{path}/"
+        fingerprint.update(b"\n" + entry.encode())
+    return fingerprint.hexdigest()
+
+
+def archive_mtime(col: Collection) -> int:
+    """Modification time given to every member of the archive, fixed so rebuilding it gives the same bytes."""
+    return int(col.created().timestamp())
+
+
+def invalidate_archive(col_id: UUID):
+    """Drop the cached archives of the collection, if any."""
+    keys = archive_keys.pop(col_id, set())
+    for key in keys:
+        archive_cache.discard(key)
+    if len(keys) > 0:
+        logger.debug(f"Dropped {len(keys)} cached archives of collection {col_id}.")
+
+
+def remember_archive(col_id: UUID, fingerprint: str, key: str):
+    """Record the archive cached for the collection, dropping those of its previous versions."""
+    keys = archive_keys.setdefault(col_id, set())
+    for stale in [known for known in keys if not known.startswith(fingerprint)]:
+        keys.discard(stale)
+        archive_cache.discard(stale)
+    keys.add(key)
+
+
+def archive_blocks(db: Session, col: Collection, structure: FolderIntake, fmt: ArchiveFormat) -> AsyncIterator[bytes]:
+    return compress_stream(stream_tar(db, structure, col.name, archive_mtime(col)), fmt)
+
+
+async def download_collection(
+    db: Session, col: Collection, user: User, fmt: ArchiveFormat = ArchiveFormat.tar
+) -> tuple[str, str, Workspace | None]:
+    """
+    Build the archive of the collection in the given format, returning its path and its version
+    (see archive_fingerprint, each format is a version of its own).
+    Archives are cached until the collection changes, so repeated downloads are served from the same file.
+    The same version always gives the same bytes, even if the archive has to be built again.
+    Cached archives are pinned and archives that can't be cached are left in a workspace,
+    either way release_archive must be called once they have been sent.
+    """
+    logger.debug(f"Downloading collection {col.id} as {fmt.value} by user {user.id}.")
+    structure = recreate_structure(db, col.folder, user)
+    fingerprint = archive_fingerprint(col, structure)
+    key = f"{fingerprint}-{fmt.name}"
+    cached = await asyncio.to_thread(archive_cache.lookup, key, True)
+    if cached is not None:
+        logger.debug(f"Collection {col.id} served from the archive cache to user {user.id}.")
+        return cached, key, None
+
+    ws = None
+    if archive_cache.enabled:
+        path = await asyncio.to_thread(archive_cache.temp_path, key)
+    else:
+        ws = await workspaces.open_workspace(f"download of {col.id}", reserve=archive_estimate(structure))
+        path = f"{workspaces.workspace_path(ws)}/archive{fmt.suffix}"
+    try:
+        with open(path, "wb") as archive:
+            async for block in archive_blocks(db, col, structure, fmt):
+                archive.write(block)
+        if archive_cache.enabled:
+            if await asyncio.to_thread(archive_cache.add_file, key, path, True):
+                remember_archive(col.id, fingerprint, key)
+                path = archive_cache.path(key)
+            else:
+                # Larger than the whole cache, served once from a workspace
+                ws = await workspaces.open_workspace(f"download of {col.id}", reserve=os.path.getsize(path))
+                moved = f"{workspaces.workspace_path(ws)}/archive{fmt.suffix}"
+                await asyncio.to_thread(shutil.move, path, moved)
+                path = moved
+    except BaseException:
+        if os.path.exists(path):
+            os.remove(path)
+        if ws is not None:
+            await workspaces.close_workspace(ws)
+        raise
 
     logger.debug(f"Collection {col.id} downloaded successfully by user {user.id}.")
-    return folder_path + ".tar"
+    return path, key, ws
+
+
+async def release_archive(key: str, ws: Workspace | None):
+    """Let go of an archive from download_collection once it has been sent."""
+    if ws is not None:
+        await workspaces.close_workspace(ws)
+    else:
+        await asyncio.to_thread(archive_cache.release, key)
+
+
+def archive_estimate(structure: FolderIntake) -> int:
+    """Size of the uncompressed tar of a structure from recreate_structure, close enough to reserve room for it."""
+    size = 2 * tarfile.RECORDSIZE
+    for _, item in walk_structure(structure, structure.name):
+        size += tarfile.BLOCKSIZE
+        if isinstance(item, Document):
+            size += item.size + tarfile.BLOCKSIZE
+    return size
+
+
+async def stream_collection(
+    db: Session, col: Collection, user: User, fmt: ArchiveFormat = ArchiveFormat.tar
+) -> AsyncIterator[bytes]:
+    """
+    Same archive as download_collection, generated while the documents are fetched from storage.
+    The session must stay open until the stream is exhausted.
+    """
+    logger.debug(f"Streaming collection {col.id} as {fmt.value} to user {user.id}.")
+    structure = recreate_structure(db, col.folder, user)
+    async for block in archive_blocks(db, col, structure, fmt):
+        yield block
+    logger.debug(f"Collection {col.id} streamed successfully to user {user.id}.")
 
 
 def allow_read(db: Session, user: User, col: Collection, creator: User):
@@ -366,5 +623,6 @@ def update_collection_name(db: Session, col: Collection, user: User, name: str):
     col.name = name
     db.add(col)
     db.commit()
+    invalidate_archive(col.id)
     logger.debug(f"Collection {col.id} name updated successfully by user {user.id}.")
     return col
@@ -1,4 +1,5 @@
 import logging
+from datetime import datetime
 
 from sqlmodel import Session
 
@@ -10,6 +11,19 @@ logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 
 
+def update_status(col_or_doc: Collection | Document, event_type: EventTypes, timestamp: datetime):
+    """Keep the lifecycle columns in line with the events, the first creation and deletion count."""
+    match event_type:
+        case EventTypes.Create:
+            if col_or_doc.created_at is None:
+                col_or_doc.created_at = timestamp
+        case EventTypes.Delete:
+            if col_or_doc.deleted_at is None:
+                col_or_doc.deleted_at = timestamp
+        case EventTypes.Access:
+            col_or_doc.last_access_at = timestamp
+
+
 def register_event(db: Session, col_or_doc: Collection | Document, user: User, event_type: EventTypes):
     logger.debug(
         f"Registering event of type '{event_type}' for {'Collection' if isinstance(col_or_doc, Collection) else 'Document'} by user {user.id}"
@@ -25,6 +39,8 @@ def register_event(db: Session, col_or_doc: Collection | Document, user: User, e
     else:
         event = DocumentEvent(user_id=user.id, type=event_type, document_id=col_or_doc.id)
     db.add(event)
+    update_status(col_or_doc, event_type, event.timestamp)
+    db.add(col_or_doc)
     logger.info(
         f"Event of type '{event_type}' registered successfully for {'Collection' if isinstance(col_or_doc, Collection) else 'Document'} with ID '{col_or_doc.id}' by user '{user.id}'."
     )
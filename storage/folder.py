@@ -1,64 +1,204 @@
+import asyncio
 import hashlib
 import logging
 import os
+import tarfile
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, AsyncIterator, BinaryIO, Callable, Iterator
+from uuid import UUID, uuid4
 
-from sqlmodel import Session
+from sqlmodel import Session, insert, select
 
-from models.collection import Document, DocumentIntake, EDocumentIntake
-from models.event import EventTypes
+from models.collection import (
+    Document,
+    DocumentIntake,
+    EDocumentIntake,
+    FileDocumentIntake,
+)
+from models.event import DocumentEvent, EventTypes
 from models.folder import Folder, FolderIntake
 from models.user import User
 from storage.event import register_event
-from storage.main import store
+from storage.main import DOWNLOAD_CONCURRENCY, HASH_WORKERS, store
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 
+# Size of the blocks read from an incoming archive stream and its members
+ARCHIVE_CHUNK_SIZE = 1024 * 1024
+
+# Rows written per INSERT statement when creating a folder structure in bulk
+BULK_INSERT_BATCH = 5000
+
+# Shared by every ingest, so hashing never uses more than HASH_WORKERS cores
+hash_pool = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="hash")
+
+
+def load_tree(db: Session, collection_id: UUID) -> tuple[list[Folder], list[Document], set[UUID]]:
+    """
+    Every folder and the latest version of every document of a collection, with the lineages that had a version deleted.
+    Three queries whatever the size of the tree, instead of one for every relationship walked.
+    """
+    folders = db.exec(select(Folder).where(Folder.collection_id == collection_id)).all()
+    documents = db.exec(
+        select(Document).where(Document.collection_id == collection_id).where(Document.is_current == True)  # noqa: E712
+    ).all()
+    deleted = db.exec(
+        select(Document.lineage_id)
+        .where(Document.collection_id == collection_id)
+        .where(Document.deleted_at != None)  # noqa: E711
+    ).all()
+    return list(folders), list(documents), set(deleted)
+
 
 def recreate_structure(db: Session, root: Folder, user: User) -> FolderIntake:
-    """Recreate the FolderIntake structure from the structure in the database."""
+    """
+    Recreate the FolderIntake structure from the structure in the database.
+    Children are sorted by name (as walk_folder does), so the same structure always comes out in the same order.
+    """
     logger.debug(f"Recreating structure for folder '{root.name}' from database.")
-    root_folder = FolderIntake(name=root.name)
-    for child in root.sub_folders:
-        root_folder.children.append(recreate_structure(db, child, user))
-    for doc in root.documents:
-        deleted = False
-        if doc.is_deleted():
-            deleted = True
-        # Travel until the last update, if any is deleted, the document is considered deleted
-        while doc.next is not None and not deleted:
-            if doc.is_deleted():
-                deleted = True
-            doc = doc.next.new
+    folders, documents, deleted = load_tree(db, root.collection_id)  # type: ignore
+    sub_folders: dict[UUID | None, list[Folder]] = {}
+    for folder in folders:
+        sub_folders.setdefault(folder.parent_id, []).append(folder)
+    latest: dict[UUID, list[Document]] = {}
+    for doc in documents:
         register_event(db, doc, user, EventTypes.Access)
-        if not deleted:
+        # If any version is deleted, the document is considered deleted
+        if doc.lineage_id not in deleted:
+            latest.setdefault(doc.folder_id, []).append(doc)
+
+    def build(folder: Folder) -> FolderIntake:
+        intake = FolderIntake(name=folder.name)
+        # Rows come back in whatever order the database keeps them, the ID settles documents sharing a name
+        children = sub_folders.get(folder.id, []) + latest.get(folder.id, [])
+        for child in sorted(children, key=lambda item: (item.name, str(item.id))):
             # TODO: This is the worst way to do this, literally wrong object type but it works
-            root_folder.children.append(doc)  # type: ignore
+            intake.children.append(build(child) if isinstance(child, Folder) else child)  # type: ignore
+        return intake
+
+    root_folder = build(root)
     logger.debug(f"Recreated structure for folder '{root.name}' from database successfully.")
     return root_folder
 
 
-async def populate_documents(db: Session, root: FolderIntake) -> FolderIntake:
+def walk_structure(root: FolderIntake, path: str) -> Iterator[tuple[str, FolderIntake | Document]]:
     """
-    Populate DocumentIntake objects with their actual content.
+    Yield every folder and document of a structure from recreate_structure in tree order, with its path.
+    The root itself comes first, under the given path.
     """
-    logger.debug(f"Populating documents for folder '{root.name}'.")
-    new_root = FolderIntake(name=root.name)
+    yield path, root
     for child in root.children:
+        child_path = f"{path}/{child.name}"
         if isinstance(child, FolderIntake):
-            folder = await populate_documents(db, child)
-            new_root.children.append(folder)
+            yield from walk_structure(child, child_path)
         # TODO: Tied to the wrong implementation above, but might as well take advantage of it
         elif isinstance(child, Document):
-            new_doc = await store.download_document(db, child)
-            new_root.children.append(new_doc)
-        elif isinstance(child, DocumentIntake):
+            yield child_path, child
+        else:
             logger.error("DocumentIntake objects should not be in the root of the FolderIntake structure.")
             raise TypeError("Please only call this with a FolderIntake from recreate_structure")
+
+
+async def fetch_documents(db: Session, docs: list[Document]) -> AsyncIterator[DocumentIntake]:
+    """
+    Download the given documents from storage, yielding them in the same order.
+    Up to DOWNLOAD_CONCURRENCY downloads run ahead of the consumer, so at most that many documents are held at once.
+    """
+    window: deque[asyncio.Task[DocumentIntake]] = deque()
+    try:
+        for doc in docs:
+            window.append(asyncio.create_task(store.download_document(db, doc)))
+            if len(window) >= DOWNLOAD_CONCURRENCY:
+                yield await window.popleft()
+        while len(window) > 0:
+            yield await window.popleft()
+    finally:
+        # Consumer gave up (or a download failed), don't leave the rest running
+        for task in window:
+            task.cancel()
+
+
+async def populate_documents(db: Session, root: FolderIntake) -> FolderIntake:
+    """
+    Populate DocumentIntake objects with their actual content.
+    Documents are fetched concurrently (see fetch_documents), the returned structure keeps the original order.
+    """
+    logger.debug(f"Populating documents for folder '{root.name}'.")
+    docs = [item for _, item in walk_structure(root, root.name) if isinstance(item, Document)]
+    fetched = [doc async for doc in fetch_documents(db, docs)]
+    new_root = fill_structure(root, iter(fetched))
     logger.debug(f"Documents populated for folder '{root.name}' successfully.")
     return new_root
 
 
+def fill_structure(root: FolderIntake, fetched: Iterator[DocumentIntake]) -> FolderIntake:
+    """Copy the structure, replacing its documents with the fetched ones, which must be in tree order."""
+    new_root = FolderIntake(name=root.name)
+    for child in root.children:
+        if isinstance(child, FolderIntake):
+            new_root.children.append(fill_structure(child, fetched))
+        else:
+            new_root.children.append(next(fetched))
+    return new_root
+
+
+def tar_header(name: str, size: int, mtime: int, is_dir: bool = False) -> bytes:
+    """Build the tar header block(s) of a member, PAX extended headers are added for long or non-ASCII names."""
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = mtime
+    if is_dir:
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+    else:
+        info.mode = 0o644
+    return info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+
+
+async def stream_folder(db: Session, root: FolderIntake, path: str, mtime: int) -> AsyncIterator[bytes]:
+    """
+    Yield the tar members of a structure from recreate_structure, under the given path.
+    Documents are fetched a few at a time ahead of the member being written (see fetch_documents),
+    and dropped once they have been yielded.
+    """
+    entries = list(walk_structure(root, path))
+    fetched = fetch_documents(db, [item for _, item in entries if isinstance(item, Document)])
+    try:
+        for entry_path, item in entries:
+            if isinstance(item, FolderIntake):
+                yield tar_header(entry_path, 0, mtime, is_dir=True)
+                continue
+            doc = await anext(fetched)
+            yield tar_header(entry_path, len(doc.content), mtime)
+            yield doc.content
+            remainder = len(doc.content) % tarfile.BLOCKSIZE
+            if remainder > 0:
+                yield tarfile.NUL * (tarfile.BLOCKSIZE - remainder)
+    finally:
+        await fetched.aclose()
+
+
+async def stream_tar(db: Session, root: FolderIntake, arcname: str, mtime: int) -> AsyncIterator[bytes]:
+    """
+    Generate an uncompressed tar archive of a structure from recreate_structure on the fly.
+    Nothing is written to disk and only a few documents are held in memory at a time.
+    Every member gets the given mtime, so the same structure always gives the same bytes.
+    """
+    logger.debug(f"Streaming folder '{root.name}' as '{arcname}'.")
+    written = 0
+    async for block in stream_folder(db, root, arcname, mtime):
+        written += len(block)
+        yield block
+    # End of archive marker, padded to a whole record like tarfile does
+    end = 2 * tarfile.BLOCKSIZE
+    end += -(written + end) % tarfile.RECORDSIZE
+    yield tarfile.NUL * end
+    logger.debug(f"Streamed folder '{root.name}' successfully, {written + end} bytes.")
+
+
 def write_folder(root: FolderIntake, path: str):
     """Write the FolderIntake structure to the given path."""
     logger.debug(f"Writing folder '{root.name}' to path '{path}'.")
@@ -71,42 +211,126 @@ def write_folder(root: FolderIntake, path: str):
                 file.write(child.content)
 
 
-# TODO: saving all file content in memory is not a good idea
-def walk_folder(root: str, user: User) -> FolderIntake:
-    """Walk through the given root path and create a tree of FolderIntake and DocumentIntake objects."""
+def extract_archive(
+    archive: BinaryIO,
+    path: str,
+    on_hashed: Callable[[str], None] | None = None,
+    on_extracting: Callable[[int], None] | None = None,
+) -> dict[str, str]:
+    """
+    Extract a (possibly compressed) tar stream into the given path, one member at a time.
+    The chunks of each regular file are hashed on the hashing pool while they are written, so the archive
+    is never held in memory nor read back, and hashing runs on another core while the stream is decompressed.
+    Returns a mapping of the extracted file paths to their SHA-256 hex digest, in archive order.
+    on_hashed is called with the path of every file that has been hashed.
+    on_extracting is called with the size of every file before it is written, it may raise to stop the extraction.
+    """
+    logger.debug(f"Extracting archive stream to '{path}'.")
+    os.makedirs(path, exist_ok=True)
+    hashes: dict[str, str] = {}
+    with tarfile.open(fileobj=archive, mode="r|*", bufsize=ARCHIVE_CHUNK_SIZE) as tar:
+        for member in tar:
+            if not member.isfile():
+                tar.extract(member, path, filter="data")
+                continue
+            # Same sanity checks extractall applies with the "data" filter
+            member = tarfile.data_filter(member, path)
+            target = os.path.normpath(os.path.join(path, member.name))
+            if on_extracting is not None:
+                on_extracting(member.size)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            source = tar.extractfile(member)
+            if source is None:
+                logger.error(f"Could not read member '{member.name}' from the archive.")
+                raise ValueError(f"Could not read member '{member.name}' from the archive")
+            file_hash = hashlib.sha256()
+            # At most one chunk is being hashed while the next one is read, so memory stays bounded
+            hashing: Future[None] | None = None
+            with open(target, "wb") as file:
+                while chunk := source.read(ARCHIVE_CHUNK_SIZE):
+                    if hashing is not None:
+                        hashing.result()
+                    hashing = hash_pool.submit(file_hash.update, chunk)
+                    file.write(chunk)
+            if hashing is not None:
+                hashing.result()
+            hashes[target] = file_hash.hexdigest()
+            if on_hashed is not None:
+                on_hashed(target)
+    logger.debug(f"Extracted {len(hashes)} files to '{path}' successfully.")
+    return hashes
+
+
+def hash_file(path: str) -> str:
+    """Compute the SHA-256 hex digest of the file at the given path, reading it in fixed-size chunks."""
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(ARCHIVE_CHUNK_SIZE):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def hash_files(paths: list[str]) -> dict[str, str]:
+    """Hash the given files in parallel on the hashing pool. Returns a mapping of each path to its hex digest."""
+    logger.debug(f"Hashing {len(paths)} files with {HASH_WORKERS} workers.")
+    return dict(zip(paths, hash_pool.map(hash_file, paths)))
+
+
+def walk_folder(root: str, user: User, hashes: dict[str, str] | None = None) -> FolderIntake:
+    """
+    Walk through the given root path and create a tree of FolderIntake and FileDocumentIntake objects.
+    File content is left on disk, hashes already computed during extraction (see extract_archive) are reused,
+    the remaining files are hashed in parallel before the tree is built.
+    """
     logger.debug(f"Walking through folder '{root}'.")
+    hashes = dict(hashes or {})
+    missing = []
+    for dir_path, _, file_names in os.walk(root):
+        for file_name in file_names:
+            file_path = os.path.normpath(os.path.join(dir_path, file_name))
+            if file_path not in hashes:
+                missing.append(file_path)
+    hashes.update(hash_files(missing))
+    folder = build_folder(root, user, hashes)
+    logger.debug(f"Walked through folder '{root}' successfully.")
+    return folder
+
+
+def build_folder(root: str, user: User, hashes: dict[str, str]) -> FolderIntake:
+    """Create the tree for the given root path, items are sorted by name so the tree is deterministic."""
     name = os.path.basename(root)
     folder = FolderIntake(name=name)
-    for item in os.listdir(root):
+    for item in sorted(os.listdir(root)):
         item_path = os.path.join(root, item)
         if os.path.isdir(item_path):
-            folder.children.append(walk_folder(item_path, user))
+            folder.children.append(build_folder(item_path, user, hashes))
         else:
-            content = open(item_path, "rb").read()
-            file_hash = hashlib.sha256(content).hexdigest()
+            file_hash = hashes[os.path.normpath(item_path)]
             folder.children.append(
-                DocumentIntake(
+                FileDocumentIntake(
                     name=item,
                     size=os.path.getsize(item_path),
-                    content=content,
+                    path=item_path,
                     hash=file_hash,
                     parent_folder=folder,
                 )
             )
-    logger.debug(f"Walked through folder '{root}' successfully.")
     return folder
 
 
-def create_folder(db: Session, root: FolderIntake, db_root: Folder) -> list[EDocumentIntake]:
+def create_folder(db: Session, root: FolderIntake, db_root: Folder, bulk: bool = False) -> list[EDocumentIntake]:
     """
     Creates Folder and Document structures in the database from the given root FolderIntake object.
     Returns a mapping of the DocumentIntake objects to their corresponding Document objects in the database.
+    With bulk, the rows are written with batched inserts instead of through the ORM (see create_folder_bulk).
     """
     logger.debug(f"Creating folder '{root.name}' in the database.")
     root_id = db_root.id
     if root_id is None:
         logger.error("Root folder must have an ID to create a folder structure.")
         raise ValueError("Could not create root folder")
+    if bulk:
+        return create_folder_bulk(db, root, db_root)
     children = root.children
     parents = [db_root] * len(children)
     mapping: list[EDocumentIntake] = []
@@ -138,3 +362,73 @@ def create_folder(db: Session, root: FolderIntake, db_root: Folder) -> list[EDoc
     db.commit()
     logger.debug(f"Created folder '{root.name}' in the database successfully.")
     return mapping
+
+
+def insert_rows(db: Session, table: Any, rows: list[dict]):
+    """Insert the given rows into the table with executemany, BULK_INSERT_BATCH rows at a time."""
+    for start in range(0, len(rows), BULK_INSERT_BATCH):
+        db.execute(insert(table), rows[start : start + BULK_INSERT_BATCH])
+
+
+def create_folder_bulk(db: Session, root: FolderIntake, db_root: Folder) -> list[EDocumentIntake]:
+    """
+    Same as create_folder, but the Folder, Document and DocumentEvent rows are built as plain dictionaries
+    with their IDs generated upfront, then written with executemany inserts.
+    This skips the ORM bookkeeping, which dominates ingest time for large collections.
+    The relationships of db_root are not updated, it has to be refreshed to see the new rows.
+    """
+    collection = db_root.collection
+    owner_id = collection.owner.id
+    # The root folder and collection have to exist before rows referencing them are inserted
+    db.flush()
+    now = datetime.now()
+    folders: list[dict] = []
+    documents: list[dict] = []
+    events: list[dict] = []
+    mapping: list[EDocumentIntake] = []
+    # Folders are visited before their children, so parents are always inserted first
+    stack: list[tuple[FolderIntake, UUID]] = [(root, db_root.id)]
+    while len(stack) > 0:
+        folder, folder_id = stack.pop()
+        for child in folder.children:
+            if isinstance(child, FolderIntake):
+                child_id = uuid4()
+                folders.append(
+                    {"id": child_id, "name": child.name, "collection_id": collection.id, "parent_id": folder_id}
+                )
+                stack.append((child, child_id))
+            else:
+                doc_id = uuid4()
+                documents.append(
+                    {
+                        "id": doc_id,
+                        "name": child.name,
+                        "size": child.size,
+                        "access_from_date": child.access_from_date,
+                        "hash": child.hash,
+                        "folder_id": folder_id,
+                        "collection_id": collection.id,
+                        "created_at": now,
+                        "lineage_id": doc_id,
+                        "version_no": 1,
+                        "is_current": True,
+                    }
+                )
+                events.append(
+                    {
+                        "id": uuid4(),
+                        "user_id": owner_id,
+                        "document_id": doc_id,
+                        "type": EventTypes.Create,
+                        "timestamp": now,
+                    }
+                )
+                mapping.append(EDocumentIntake.create(doc_id, child))
+    insert_rows(db, Folder, folders)
+    insert_rows(db, Document, documents)
+    insert_rows(db, DocumentEvent, events)
+    db.commit()
+    logger.debug(
+        f"Created folder '{root.name}' in the database in bulk: {len(folders)} folders, {len(documents)} documents."
+    )
+    return mapping
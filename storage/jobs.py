@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import os
+import shutil
+from datetime import datetime, timedelta
+from typing import Awaitable, BinaryIO, Callable
+from uuid import UUID
+
+from sqlmodel import Session
+
+import storage.collection as collections
+import storage.workspaces as workspaces
+from models.job import IngestJob, JobStatus
+from models.user import User
+from models.workspace import Workspace
+from storage.main import INGEST_WORKERS, JOB_RETENTION_MINUTES, engine
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+# Opens the archive of a job once a worker picks it up
+ArchiveSource = Callable[[], BinaryIO]
+# Run once a job is over, e.g. to close the workspace holding its archive
+Cleanup = Callable[[], Awaitable[None]]
+
+jobs: dict[UUID, IngestJob] = {}
+queue: asyncio.Queue[tuple[IngestJob, User, str, ArchiveSource, Cleanup | None]] = asyncio.Queue()
+workers: list[asyncio.Task] = []
+
+# Reported on jobs that failed for reasons the client can't act upon
+INGEST_FAILED = "Ingest failed, the collection could not be created"
+
+
+def staged_path(ws: Workspace) -> str:
+    return f"{workspaces.workspace_path(ws)}/archive"
+
+
+async def stage_archive(archive: BinaryIO, size: int = 0) -> Workspace:
+    """
+    Copy an incoming archive of (about) size bytes into a workspace of its own, so it outlives the request
+    and counts against the workspace quota until its job is over. Returns the workspace, see staged_path.
+    """
+    ws = await workspaces.open_workspace("staged archive", reserve=size)
+    path = staged_path(ws)
+
+    def copy():
+        with open(path, "wb") as file:
+            shutil.copyfileobj(archive, file, 1024 * 1024)
+
+    try:
+        await asyncio.to_thread(copy)
+        # The size given is only a hint (it may be unknown), the reservation follows what was written
+        await workspaces.adjust_reservation(ws, os.path.getsize(path) - ws.reserved)
+    except BaseException:
+        await workspaces.close_workspace(ws)
+        raise
+    logger.debug(f"Staged archive to '{path}'.")
+    return ws
+
+
+def submit_ingest(
+    user: User,
+    name: str,
+    transaction_address: str,
+    source: ArchiveSource,
+    cleanup: Cleanup | None = None,
+    size: int = 0,
+) -> IngestJob:
+    """
+    Queue the creation of a collection from the archive given by source, which is size bytes long.
+    cleanup is awaited once the job is over, whether it succeeded or not.
+    """
+    prune_jobs()
+    job = IngestJob(name=name, owner_id=user.id, archive_size=size)
+    jobs[job.id] = job
+    queue.put_nowait((job, user, transaction_address, source, cleanup))
+    logger.debug(f"Queued ingest job {job.id} for collection '{name}', {queue.qsize()} jobs waiting.")
+    return job
+
+
+def submit_staged_ingest(user: User, name: str, transaction_address: str, ws: Workspace) -> IngestJob:
+    """Queue the creation of a collection from an archive staged with stage_archive, removing it afterwards."""
+    path = staged_path(ws)
+    job = submit_ingest(
+        user,
+        name,
+        transaction_address,
+        source=lambda: open(path, "rb"),
+        cleanup=lambda: workspaces.close_workspace(ws),
+        size=os.path.getsize(path),
+    )
+    # Kept for as long as the job runs, however long it waits in the queue
+    ws.job = job
+    return job
+
+
+def get_job(job_id: UUID, user: User) -> IngestJob | None:
+    job = jobs.get(job_id)
+    if job is None or job.owner_id != user.id:
+        return None
+    return job
+
+
+def prune_jobs():
+    """Forget finished jobs older than JOB_RETENTION_MINUTES."""
+    threshold = datetime.now() - timedelta(minutes=JOB_RETENTION_MINUTES)
+    for job_id, job in list(jobs.items()):
+        if job.finished is not None and job.finished < threshold:
+            del jobs[job_id]
+
+
+async def run_ingest(
+    job: IngestJob,
+    user: User,
+    transaction_address: str,
+    source: ArchiveSource,
+    cleanup: Cleanup | None,
+):
+    logger.info(f"Starting ingest job {job.id} for collection '{job.name}'.")
+    try:
+        with Session(engine) as session, source() as archive:
+            collection = await collections.create_collection(session, job.name, archive, user, transaction_address, job)
+            logger.info(f"Ingest job {job.id} created collection {collection.id}.")
+        job.finish()
+    except (ValueError, OverflowError) as e:
+        # Expected failures (a bad archive, no room left), their message is meant for the client
+        logger.error(f"Ingest job {job.id} failed: {e!r}")
+        job.finish(str(e))
+    except Exception:
+        # Anything else may hold paths, queries or storage errors, so it is only logged
+        logger.exception(f"Ingest job {job.id} failed unexpectedly.")
+        job.finish(INGEST_FAILED)
+    finally:
+        if cleanup is not None:
+            try:
+                await cleanup()
+            except OSError as e:
+                logger.warning(f"Could not clean up after ingest job {job.id}: {e!r}")
+
+
+async def worker():
+    while True:
+        job, user, transaction_address, source, cleanup = await queue.get()
+        try:
+            await run_ingest(job, user, transaction_address, source, cleanup)
+        finally:
+            queue.task_done()
+
+
+async def start_workers():
+    """Start the pool of INGEST_WORKERS workers, which bounds how many collections are ingested at once."""
+    for _ in range(INGEST_WORKERS):
+        workers.append(asyncio.create_task(worker()))
+    logger.debug(f"Started {INGEST_WORKERS} ingest workers.")
+
+
+async def stop_workers():
+    for task in workers:
+        task.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    workers.clear()
+    # Queued jobs are lost along with their staged archives
+    while not queue.empty():
+        job, *_ = queue.get_nowait()
+        if job.status == JobStatus.queued:
+            job.finish("Server shut down before the job started")
+    logger.debug("Stopped ingest workers.")
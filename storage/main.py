@@ -21,9 +21,65 @@ def must_getenv(var_name: str) -> str:
     return value
 
 
+def getenv_int(var_name: str, default: int) -> int:
+    value = os.getenv(var_name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        logger.error(f"{var_name} must be an integer, got '{value}'")
+        raise ValueError(f"{var_name} must be an integer")
+
+
 TEMP_FOLDER = must_getenv("TEMP_FOLDER")
 logger.debug(f"TEMP_FOLDER set to: {TEMP_FOLDER}")
 
+# Number of threads used to hash ingested files, hashlib releases the GIL on large buffers
+HASH_WORKERS = getenv_int("HASH_WORKERS", os.cpu_count() or 1)
+logger.debug(f"HASH_WORKERS set to: {HASH_WORKERS}")
+
+# Collections ingested at the same time in the background, and how long finished ingest jobs can be looked up
+INGEST_WORKERS = getenv_int("INGEST_WORKERS", 2)
+JOB_RETENTION_MINUTES = getenv_int("JOB_RETENTION_MINUTES", 60)
+logger.debug(f"INGEST_WORKERS set to: {INGEST_WORKERS}, jobs kept for {JOB_RETENTION_MINUTES} minutes")
+
+# Largest chunk accepted by resumable uploads, and how long an upload may sit idle before it is dropped
+MAX_CHUNK_SIZE = getenv_int("MAX_CHUNK_SIZE", 64 * 1024 * 1024)
+UPLOAD_EXPIRY_MINUTES = getenv_int("UPLOAD_EXPIRY_MINUTES", 24 * 60)
+logger.debug(f"MAX_CHUNK_SIZE set to: {MAX_CHUNK_SIZE}, uploads expire after {UPLOAD_EXPIRY_MINUTES} minutes")
+
+# Documents fetched from storage at the same time when a collection is downloaded
+DOWNLOAD_CONCURRENCY = getenv_int("DOWNLOAD_CONCURRENCY", 8)
+logger.debug(f"DOWNLOAD_CONCURRENCY set to: {DOWNLOAD_CONCURRENCY}")
+
+# Total size (in MiB) reserved by the scratch workspaces of requests and jobs, more have to wait for room
+WORKSPACE_QUOTA_MB = getenv_int("WORKSPACE_QUOTA_MB", 10 * 1024)
+# Workspaces still open after this long are considered abandoned, the janitor looks for them every so often
+WORKSPACE_TTL_MINUTES = getenv_int("WORKSPACE_TTL_MINUTES", 6 * 60)
+WORKSPACE_JANITOR_SECONDS = getenv_int("WORKSPACE_JANITOR_SECONDS", 60)
+logger.debug(
+    f"WORKSPACE_QUOTA_MB set to: {WORKSPACE_QUOTA_MB}, workspaces expire after {WORKSPACE_TTL_MINUTES} minutes"
+)
+
+# Kept across restarts, unlike TEMP_FOLDER
+CACHE_FOLDER = os.getenv("CACHE_FOLDER", "cache")
+# Budget (in MiB) of the local copies of document content fetched from storage, 0 disables them
+CONTENT_CACHE_MB = getenv_int("CONTENT_CACHE_MB", 1024)
+# Budget (in MiB) of the archives built for collection downloads, reused while the collection doesn't change
+ARCHIVE_CACHE_MB = getenv_int("ARCHIVE_CACHE_MB", 4096)
+# Budget (in MiB) of the obfuscated signatures ready to be sent
+SIGNATURE_CACHE_MB = getenv_int("SIGNATURE_CACHE_MB", 256)
+logger.debug(
+    f"CACHE_FOLDER set to: {CACHE_FOLDER}, content cache of {CONTENT_CACHE_MB}MiB, "
+    f"archive cache of {ARCHIVE_CACHE_MB}MiB, signature cache of {SIGNATURE_CACHE_MB}MiB"
+)
+
+# Items returned by listing endpoints when the client doesn't ask for a page size, and the most they can ask for
+PAGE_SIZE = getenv_int("PAGE_SIZE", 100)
+MAX_PAGE_SIZE = getenv_int("MAX_PAGE_SIZE", 1000)
+logger.debug(f"PAGE_SIZE set to: {PAGE_SIZE}, at most {MAX_PAGE_SIZE}")
+
 tmp = os.getenv("TEST_MODE")
 TEST_MODE = False
 if tmp is not None:
@@ -45,6 +101,12 @@ logger.debug(f"STORAGE set to: {STORAGE}")
 
 
 class StorageStrategy:
+    def startup(self):
+        raise NotImplementedError
+
+    def shutdown(self):
+        raise NotImplementedError
+
     def upload_folder(self, db: Session, mappings: dict, collection: Collection, user: User):
         raise NotImplementedError
 
@@ -57,13 +119,31 @@ class StorageStrategy:
     def create_document(self, db: Session, document: Document, name: str):
         raise NotImplementedError
 
+    def store_document(self, db: Session, document: Document, content: bytes, collection: Collection, user: User):
+        raise NotImplementedError
+
+    def release_documents(self, db: Session, docs: list[Document]):
+        raise NotImplementedError
+
+    def download_document(self, db: Session, document: Document):
+        raise NotImplementedError
+
+    def stream_document(self, db: Session, document: Document):
+        raise NotImplementedError
+
     @staticmethod
     def verify_matches_interface(obj):
         return (
-            hasattr(obj, "create_collection")
+            hasattr(obj, "startup")
+            and hasattr(obj, "shutdown")
+            and hasattr(obj, "create_collection")
             and hasattr(obj, "create_user")
             and hasattr(obj, "create_document")
             and hasattr(obj, "upload_folder")
+            and hasattr(obj, "store_document")
+            and hasattr(obj, "release_documents")
+            and hasattr(obj, "download_document")
+            and hasattr(obj, "stream_document")
         )
 
 
@@ -75,6 +155,33 @@ match STORAGE:
         logger.debug(f"PAPERLESS_URL: {PAPERLESS_URL}")
         logger.debug(f"PAPERLESS_TOKEN set: {PAPERLESS_TOKEN}")
 
+        # Adaptive limit on documents being uploaded/consumed at once, see utils.concurrency.AIMDLimiter
+        PAPERLESS_MIN_CONCURRENCY = getenv_int("PAPERLESS_MIN_CONCURRENCY", 1)
+        PAPERLESS_INITIAL_CONCURRENCY = getenv_int("PAPERLESS_INITIAL_CONCURRENCY", 4)
+        PAPERLESS_MAX_CONCURRENCY = getenv_int("PAPERLESS_MAX_CONCURRENCY", 32)
+        # Seconds a document may take to be uploaded and consumed before it counts as slow
+        PAPERLESS_LATENCY_TARGET = getenv_int("PAPERLESS_LATENCY_TARGET", 30)
+        PAPERLESS_RETRIES = getenv_int("PAPERLESS_RETRIES", 3)
+        # Connections kept open to Paperless-ngx by the shared client, and for how long (in seconds) idle ones live
+        PAPERLESS_POOL_SIZE = getenv_int("PAPERLESS_POOL_SIZE", 100)
+        PAPERLESS_KEEPALIVE = getenv_int("PAPERLESS_KEEPALIVE", 60)
+        # Bounds (in milliseconds) of the interval between rounds of polling pending consumption tasks
+        PAPERLESS_POLL_MIN_MS = getenv_int("PAPERLESS_POLL_MIN_MS", 250)
+        PAPERLESS_POLL_MAX_MS = getenv_int("PAPERLESS_POLL_MAX_MS", 5000)
+        # Seconds a consumption task may stay pending before the document counts as failed
+        PAPERLESS_TASK_TIMEOUT = getenv_int("PAPERLESS_TASK_TIMEOUT", 15 * 60)
+
+        logger.debug(
+            f"Paperless concurrency: {PAPERLESS_MIN_CONCURRENCY}-{PAPERLESS_MAX_CONCURRENCY}, "
+            f"starting at {PAPERLESS_INITIAL_CONCURRENCY}, latency target {PAPERLESS_LATENCY_TARGET}s, "
+            f"{PAPERLESS_RETRIES} retries"
+        )
+        logger.debug(f"Paperless pool size: {PAPERLESS_POOL_SIZE}, keep-alive {PAPERLESS_KEEPALIVE}s")
+        logger.debug(
+            f"Paperless task polling every {PAPERLESS_POLL_MIN_MS}-{PAPERLESS_POLL_MAX_MS}ms, "
+            f"tasks time out after {PAPERLESS_TASK_TIMEOUT}s"
+        )
+
         import storage.adapters.paperless as ppl
 
         store = ppl
@@ -0,0 +1,187 @@
+import hashlib
+import io
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import AsyncIterator
+from uuid import UUID, uuid4
+
+import storage.jobs as jobs
+import storage.workspaces as workspaces
+from models.job import IngestJob
+from models.upload import ChunkedUpload, ChunkInfo
+from models.user import User
+from models.workspace import Workspace
+from storage.main import MAX_CHUNK_SIZE, UPLOAD_EXPIRY_MINUTES
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+# Upper bound on the number of chunks of a single upload
+MAX_CHUNKS = 100_000
+
+uploads: dict[UUID, ChunkedUpload] = {}
+# Workspace holding the chunks of each upload, so they count against the workspace quota
+upload_workspaces: dict[UUID, Workspace] = {}
+
+
+class ChunkReader(io.RawIOBase):
+    """Read the given chunk files one after the other, as a single stream."""
+
+    def __init__(self, paths: list[str]):
+        self._paths = iter(paths)
+        self._current: io.BufferedReader | None = None
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while True:
+            if self._current is None:
+                path = next(self._paths, None)
+                if path is None:
+                    return 0
+                self._current = open(path, "rb")
+            read = self._current.readinto(buffer)
+            if read:
+                return read
+            self._current.close()
+            self._current = None
+
+    def close(self):
+        if self._current is not None:
+            self._current.close()
+            self._current = None
+        super().close()
+
+
+def upload_folder(upload: ChunkedUpload) -> str:
+    return workspaces.workspace_path(upload_workspaces[upload.id])
+
+
+def chunk_path(upload: ChunkedUpload, index: int) -> str:
+    return f"{upload_folder(upload)}/{index}.chunk"
+
+
+def keep_until_expiry(upload: ChunkedUpload):
+    # The workspace lasts as long as the upload, which only expires once it stops receiving chunks
+    workspaces.renew_workspace(upload_workspaces[upload.id], upload.updated + timedelta(minutes=UPLOAD_EXPIRY_MINUTES))
+
+
+async def initiate_upload(user: User, name: str, transaction_address: str) -> ChunkedUpload:
+    logger.debug(f"Initiating chunked upload of '{name}' for user {user.id}.")
+    await prune_uploads()
+    upload = ChunkedUpload(name=name, owner_id=user.id, transaction_address=transaction_address)
+    upload_workspaces[upload.id] = await workspaces.open_workspace(f"upload of {name}")
+    uploads[upload.id] = upload
+    keep_until_expiry(upload)
+    logger.debug(f"Initiated chunked upload {upload.id}.")
+    return upload
+
+
+def get_upload(upload_id: UUID, user: User) -> ChunkedUpload | None:
+    upload = uploads.get(upload_id)
+    if upload is None or upload.owner_id != user.id:
+        return None
+    if upload_workspaces[upload.id].closed:
+        # Removed by the janitor
+        uploads.pop(upload.id, None)
+        upload_workspaces.pop(upload.id, None)
+        return None
+    return upload
+
+
+async def write_chunk(upload: ChunkedUpload, index: int, body: AsyncIterator[bytes], checksum: str) -> ChunkInfo:
+    """
+    Store one chunk of the upload, replacing any previous copy of it.
+    The chunk is only kept if its SHA-256 matches the given checksum, otherwise a ValueError is raised.
+    Its bytes are counted against the workspace quota as they arrive, an OverflowError is raised if they don't fit.
+    """
+    logger.debug(f"Receiving chunk {index} of upload {upload.id}.")
+    if not (0 <= index < MAX_CHUNKS):
+        logger.error(f"Chunk index {index} out of range.")
+        raise ValueError(f"Chunk index must be between 0 and {MAX_CHUNKS - 1}")
+    path = chunk_path(upload, index)
+    # Written under a unique name first, so a chunk being resent never leaves a half written copy behind
+    partial_path = f"{path}.{uuid4()}"
+    ws = upload_workspaces[upload.id]
+    chunk_hash = hashlib.sha256()
+    size = 0
+    # Bytes of this chunk counted against the quota, given back unless it replaces the previous copy
+    counted = 0
+    try:
+        with open(partial_path, "wb") as file:
+            async for data in body:
+                size += len(data)
+                if size > MAX_CHUNK_SIZE:
+                    logger.error(f"Chunk {index} of upload {upload.id} is larger than {MAX_CHUNK_SIZE} bytes.")
+                    raise OverflowError(f"Chunks can't be larger than {MAX_CHUNK_SIZE} bytes")
+                await workspaces.adjust_reservation(ws, len(data))
+                counted += len(data)
+                chunk_hash.update(data)
+                file.write(data)
+        digest = chunk_hash.hexdigest()
+        if digest != checksum.lower():
+            logger.error(f"Checksum mismatch for chunk {index} of upload {upload.id}.")
+            raise ValueError("Chunk checksum does not match its content")
+        os.replace(partial_path, path)
+        previous = upload.chunks.get(index)
+        counted = previous.size if previous is not None else 0
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        if counted > 0:
+            await workspaces.adjust_reservation(ws, -counted)
+    info = ChunkInfo(index=index, size=size, sha256=digest)
+    upload.chunks[index] = info
+    upload.updated = datetime.now()
+    keep_until_expiry(upload)
+    logger.debug(f"Stored chunk {index} of upload {upload.id} ({size} bytes).")
+    return info
+
+
+def finalize_upload(upload: ChunkedUpload, user: User, chunk_count: int) -> IngestJob:
+    """
+    Feed the chunks of the upload, in order, to the creation of a collection, which is run as an ingest job.
+    Raises a ValueError if any of the chunk_count chunks is missing.
+    """
+    logger.debug(f"Finalizing chunked upload {upload.id} with {chunk_count} chunks.")
+    missing = [index for index in range(chunk_count) if index not in upload.chunks]
+    if chunk_count <= 0 or missing:
+        logger.error(f"Upload {upload.id} is missing chunks: {missing}.")
+        raise ValueError(f"Upload is missing chunks: {missing}")
+    if max(upload.chunks) >= chunk_count:
+        logger.error(f"Upload {upload.id} has chunks past the expected {chunk_count}.")
+        raise ValueError("Upload has more chunks than expected")
+    paths = [chunk_path(upload, index) for index in range(chunk_count)]
+    del uploads[upload.id]
+    ws = upload_workspaces.pop(upload.id)
+    job = jobs.submit_ingest(
+        user,
+        upload.name,
+        upload.transaction_address,
+        source=lambda: ChunkReader(paths),
+        cleanup=lambda: workspaces.close_workspace(ws),
+        size=sum(upload.chunks[index].size for index in range(chunk_count)),
+    )
+    # The chunks are kept for as long as the job runs
+    ws.job = job
+    logger.debug(f"Chunked upload {upload.id} queued as ingest job {job.id}.")
+    return job
+
+
+async def abort_upload(upload: ChunkedUpload):
+    logger.debug(f"Aborting chunked upload {upload.id}.")
+    uploads.pop(upload.id, None)
+    ws = upload_workspaces.pop(upload.id, None)
+    if ws is not None:
+        await workspaces.close_workspace(ws)
+
+
+async def prune_uploads():
+    """Abort uploads that received nothing for UPLOAD_EXPIRY_MINUTES."""
+    threshold = datetime.now() - timedelta(minutes=UPLOAD_EXPIRY_MINUTES)
+    for upload in list(uploads.values()):
+        if upload.updated < threshold:
+            logger.info(f"Chunked upload {upload.id} expired.")
+            await abort_upload(upload)
@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import os
+import shutil
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from uuid import UUID
+
+from models.job import IngestJob
+from models.workspace import Workspace
+from storage.main import (
+    TEMP_FOLDER,
+    WORKSPACE_JANITOR_SECONDS,
+    WORKSPACE_QUOTA_MB,
+    WORKSPACE_TTL_MINUTES,
+)
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+WORKSPACES_FOLDER = f"{TEMP_FOLDER}/workspaces"
+QUOTA = WORKSPACE_QUOTA_MB * 1024 * 1024
+
+workspaces: dict[UUID, Workspace] = {}
+reserved = 0
+# Notified every time a workspace is closed, so requests waiting for room can try again
+released = asyncio.Condition()
+janitor_task: asyncio.Task | None = None
+
+
+def workspace_path(workspace: Workspace) -> str:
+    return f"{WORKSPACES_FOLDER}/{workspace.id}"
+
+
+def fits(size: int) -> bool:
+    # A reservation larger than the whole quota still gets in, alone, rather than waiting forever
+    return size <= 0 or reserved == 0 or reserved + size <= QUOTA
+
+
+def held_with(workspace: Workspace) -> int:
+    """Bytes reserved by the workspace, together with the other workspaces of its job if it has one."""
+    if workspace.job is None:
+        return workspace.reserved
+    return sum(ws.reserved for ws in workspaces.values() if ws.job is workspace.job)
+
+
+async def open_workspace(purpose: str, reserve: int = 0, job: IngestJob | None = None) -> Workspace:
+    """
+    Create a unique scratch directory, counting reserve bytes against the quota until it is closed.
+    Waits while the reservation would take the workspaces in use over WORKSPACE_QUOTA_MB.
+    A workspace opened for a job is kept for as long as the job runs, see sweep.
+    """
+    global reserved
+    async with released:
+        if not fits(reserve):
+            logger.info(f"Waiting for {reserve} bytes of workspace for {purpose}, {reserved} bytes in use.")
+        await released.wait_for(lambda: fits(reserve))
+        reserved += reserve
+    workspace = Workspace(
+        purpose=purpose,
+        reserved=reserve,
+        expires=datetime.now() + timedelta(minutes=WORKSPACE_TTL_MINUTES),
+        job=job,
+    )
+    workspaces[workspace.id] = workspace
+    os.makedirs(workspace_path(workspace), exist_ok=True)
+    logger.debug(f"Opened workspace {workspace.id} for {purpose}, {reserved} bytes reserved in total.")
+    return workspace
+
+
+async def adjust_reservation(workspace: Workspace, delta: int):
+    """
+    Add delta bytes to the reservation of an open workspace (a negative delta gives some back),
+    for content whose size is only known as it is written.
+    Never waits for room, as others may be waiting on what the workspace holds: raises an OverflowError instead
+    when the quota can't take it, unless the workspace (with the rest of its job) holds every reservation.
+    """
+    global reserved
+    async with released:
+        if delta > 0 and reserved + delta > QUOTA and reserved != held_with(workspace):
+            logger.error(f"Workspace {workspace.id} can't grow by {delta} bytes, {reserved} bytes in use.")
+            raise OverflowError("Not enough room left in the workspace quota, try again later")
+        workspace.reserved += delta
+        reserved += delta
+        if delta < 0:
+            released.notify_all()
+
+
+def renew_workspace(workspace: Workspace, expires: datetime):
+    """Keep the workspace until at least the given time."""
+    workspace.expires = max(workspace.expires, expires)
+
+
+async def close_workspace(workspace: Workspace):
+    """Remove the workspace and everything in it, giving its reservation back. Closing it again does nothing."""
+    global reserved
+    if workspace.closed:
+        return
+    workspace.closed = True
+    await asyncio.to_thread(shutil.rmtree, workspace_path(workspace), ignore_errors=True)
+    workspaces.pop(workspace.id, None)
+    async with released:
+        reserved -= workspace.reserved
+        released.notify_all()
+    logger.debug(f"Closed workspace {workspace.id} ({workspace.purpose}).")
+
+
+@asynccontextmanager
+async def workspace(purpose: str, reserve: int = 0):
+    """Open a workspace for the duration of the block, see open_workspace."""
+    opened = await open_workspace(purpose, reserve)
+    try:
+        yield opened
+    finally:
+        await close_workspace(opened)
+
+
+async def sweep():
+    """
+    Close workspaces past their expiry, which were abandoned by whoever opened them,
+    and remove directories left behind by closed workspaces or a previous run.
+    Workspaces of jobs still running are kept, however long the job takes.
+    """
+    now = datetime.now()
+    for expired in [ws for ws in workspaces.values() if ws.expires < now and not in_use(ws)]:
+        logger.warning(f"Workspace {expired.id} ({expired.purpose}) expired, removing it.")
+        await close_workspace(expired)
+    if not os.path.isdir(WORKSPACES_FOLDER):
+        return
+    known = {str(workspace_id) for workspace_id in workspaces}
+    for entry in os.listdir(WORKSPACES_FOLDER):
+        if entry in known:
+            continue
+        logger.info(f"Removing leftover workspace directory '{entry}'.")
+        path = f"{WORKSPACES_FOLDER}/{entry}"
+        if os.path.isdir(path):
+            await asyncio.to_thread(shutil.rmtree, path, ignore_errors=True)
+        else:
+            os.remove(path)
+
+
+def in_use(workspace: Workspace) -> bool:
+    return workspace.job is not None and not workspace.job.is_finished()
+
+
+async def janitor():
+    while True:
+        try:
+            await sweep()
+        except Exception as e:
+            logger.error(f"Workspace janitor failed: {e!r}")
+        await asyncio.sleep(WORKSPACE_JANITOR_SECONDS)
+
+
+async def start_janitor():
+    """Start the janitor, which sweeps the workspaces every WORKSPACE_JANITOR_SECONDS."""
+    global janitor_task
+    if janitor_task is None:
+        janitor_task = asyncio.create_task(janitor())
+    logger.debug(f"Started workspace janitor, sweeping every {WORKSPACE_JANITOR_SECONDS}s.")
+
+
+async def stop_janitor():
+    global janitor_task
+    if janitor_task is not None:
+        janitor_task.cancel()
+        await asyncio.gather(janitor_task, return_exceptions=True)
+        janitor_task = None
+    for opened in list(workspaces.values()):
+        await close_workspace(opened)
+    logger.debug("Stopped workspace janitor.")
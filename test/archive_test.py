@@ -0,0 +1,160 @@
+import asyncio
+import hashlib
+import io
+import os
+import tarfile
+
+import pytest
+from conftest import make_collection
+
+import storage.collection as collections
+import storage.folder as folder
+from models.collection import DocumentIntake
+from models.event import EventTypes
+from storage.event import register_event
+from storage.folder import recreate_structure, stream_tar
+
+LONG_NAME = "a" * 150 + ".txt"
+FILES = {
+    "readme.txt": b"top level",
+    "sub/b.bin": bytes(range(256)) * 5,
+    "sub/ünïcode.txt": b"non-ASCII name",
+    f"sub/{LONG_NAME}": b"long name",
+    "sub/empty.txt": b"",
+}
+
+
+class FakeStore:
+    """Serves documents by hash, keeping track of how many are being downloaded at once."""
+
+    def __init__(self, files: dict[str, bytes]):
+        self.content = {hashlib.sha256(content).hexdigest(): content for content in files.values()}
+        self.active = 0
+        self.peak = 0
+        self.started = 0
+
+    async def download_document(self, db, doc):
+        self.started += 1
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        try:
+            await asyncio.sleep(0.001)
+            content = self.content[doc.hash]
+        finally:
+            self.active -= 1
+        return DocumentIntake(name=doc.name, content=content, size=len(content), hash=doc.hash, parent_folder=None)
+
+
+@pytest.fixture
+def store(monkeypatch):
+    store = FakeStore(FILES)
+    monkeypatch.setattr(folder, "store", store)
+    return store
+
+
+def collect(stream) -> bytes:
+    async def main():
+        return b"".join([block async for block in stream])
+
+    return asyncio.run(main())
+
+
+def test_streamed_tar_holds_the_collection(db, user, store):
+    collection = make_collection(db, user, "col", FILES)
+    structure = recreate_structure(db, collection.folder, user)
+
+    archive = collect(stream_tar(db, structure, "col", 1_700_000_000))
+
+    assert len(archive) % tarfile.RECORDSIZE == 0
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        members = {member.name: member for member in tar}
+        assert set(members) == {"col", "col/sub"} | {f"col/{name}" for name in FILES}
+        assert members["col/sub"].isdir()
+        for name, content in FILES.items():
+            member = members[f"col/{name}"]
+            assert (member.mtime, member.size) == (1_700_000_000, len(content))
+            assert tar.extractfile(member).read() == content
+    # Same structure and mtime, same bytes
+    assert collect(stream_tar(db, structure, "col", 1_700_000_000)) == archive
+
+
+def test_documents_are_fetched_ahead_within_bounds(db, user, store, monkeypatch):
+    monkeypatch.setattr(folder, "DOWNLOAD_CONCURRENCY", 2)
+    files = {f"{index}.txt": str(index).encode() for index in range(10)}
+    store.content.update(FakeStore(files).content)
+    collection = make_collection(db, user, "col", files)
+    docs = sorted(collection.documents, key=lambda doc: doc.name)
+
+    async def main():
+        fetched = folder.fetch_documents(db, docs)
+        names = [(await anext(fetched)).name for _ in range(3)]
+        await fetched.aclose()
+        await asyncio.sleep(0.01)
+        return names
+
+    assert asyncio.run(main()) == ["0.txt", "1.txt", "2.txt"]
+    assert store.peak == 2
+    # Downloads running ahead are dropped with the consumer
+    assert store.started == 4 and store.active == 0
+
+
+def test_archives_are_cached_until_the_collection_changes(db, user, store, scratch):
+    collection = make_collection(db, user, "col", FILES)
+
+    path, key, workspace = asyncio.run(collections.download_collection(db, collection, user))
+    assert workspace is None and path == collections.archive_cache.path(key)
+    downloads = store.started
+
+    again, same_key, _ = asyncio.run(collections.download_collection(db, collection, user))
+    assert (again, same_key) == (path, key)
+    assert store.started == downloads
+
+    # Deleting a document changes what the archive holds
+    deleted = collection.documents[0]
+    register_event(db, deleted, user, EventTypes.Delete)
+    db.commit()
+    collections.invalidate_archive(collection.id)
+    assert collections.archive_cache.lookup(key) is None
+    # Still being sent by both downloads, so it stays on disk until they are done
+    asyncio.run(collections.release_archive(key, None))
+    assert os.path.exists(path)
+    asyncio.run(collections.release_archive(same_key, None))
+    assert not os.path.exists(path)
+    rebuilt, new_key, _ = asyncio.run(collections.download_collection(db, collection, user))
+    assert new_key != key and store.started > downloads
+    with tarfile.open(rebuilt) as tar:
+        assert len(tar.getnames()) == len(FILES) + 1
+        assert not any(name.endswith(deleted.name) for name in tar.getnames())
+
+
+def test_archive_fingerprint_follows_the_content(db, user):
+    collection = make_collection(db, user, "col", FILES)
+    structure = recreate_structure(db, collection.folder, user)
+    fingerprint = collections.archive_fingerprint(collection, structure)
+    assert collections.archive_fingerprint(collection, recreate_structure(db, collection.folder, user)) == fingerprint
+
+    collection.name = "renamed"
+    assert collections.archive_fingerprint(collection, structure) != fingerprint
+
+
+def test_archive_members_are_sorted_by_name(db, user, store):
+    # Inserted in reverse, so the rows don't come back sorted on their own
+    names = ["z.txt", "sub/y.txt", "sub/b.txt", "m.txt", "a/x.txt", "a.txt"]
+    collection = make_collection(db, user, "col", {name: name.encode() for name in names})
+    store.content.update(FakeStore({name: name.encode() for name in names}).content)
+    structure = recreate_structure(db, collection.folder, user)
+
+    archive = collect(stream_tar(db, structure, "col", 0))
+
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        assert tar.getnames() == [
+            "col",
+            "col/a",
+            "col/a/x.txt",
+            "col/a.txt",
+            "col/m.txt",
+            "col/sub",
+            "col/sub/b.txt",
+            "col/sub/y.txt",
+            "col/z.txt",
+        ]
@@ -0,0 +1,121 @@
+import asyncio
+import io
+import itertools
+
+import pytest
+from conftest import make_collection
+from sqlmodel import Session
+
+import storage.adapters.paperless as adapter
+import utils.paperless as ppl
+from models.paperless import BlobPaperless, CollectionPaperless, UserPaperless
+
+
+class FakePaperless:
+    """Replaces the Paperless-ngx calls of the adapter, numbering uploaded documents from 100."""
+
+    def __init__(self):
+        self.ids = itertools.count(100)
+        self.uploads: list[bytes] = []
+        self.deleted: list[int] = []
+        self.on_verify = None
+
+    async def upload_document(self, file, suffix, title, **kwargs):
+        self.uploads.append(file.read())
+        file.close()
+        await asyncio.sleep(0)
+        return f"task-{len(self.uploads)}"
+
+    async def verify_document(self, task_id):
+        paperless_id = next(self.ids)
+        if self.on_verify is not None:
+            self.on_verify()
+        return paperless_id
+
+    async def delete_document(self, paperless_id):
+        self.deleted.append(paperless_id)
+
+
+@pytest.fixture
+def paperless(monkeypatch):
+    fake = FakePaperless()
+    for name in ["upload_document", "verify_document", "delete_document"]:
+        monkeypatch.setattr(ppl, name, getattr(fake, name))
+    return fake
+
+
+@pytest.fixture
+def collection(db, user):
+    collection = make_collection(db, user, files={"a.txt": b"same", "b.txt": b"same", "c.txt": b"other"})
+    collection.paperless = CollectionPaperless(paperless_id=1)
+    db.add(UserPaperless(paperless_id=2, user_id=user.id))
+    db.add(collection)
+    db.commit()
+    return collection
+
+
+def link(db, user, docs, content: bytes):
+    owner = db.merge(user)
+    ids = [doc.id for doc in docs]
+    source = lambda: io.BytesIO(content)  # noqa: E731
+    return adapter.link_documents(db, ids, docs[0].hash, docs[0].name, source, docs[0].collection, owner)
+
+
+def by_name(collection):
+    return {doc.name: doc for doc in collection.documents}
+
+
+def test_identical_content_is_uploaded_once(db, user, collection, paperless):
+    docs = by_name(collection)
+
+    async def main():
+        # Concurrently, as an ingest does
+        await asyncio.gather(link(db, user, [docs["a.txt"]], b"same"), link(db, user, [docs["b.txt"]], b"same"))
+        await link(db, user, [docs["c.txt"]], b"other")
+
+    asyncio.run(main())
+    db.commit()
+
+    assert len(paperless.uploads) == 2
+    blob = db.get(BlobPaperless, docs["a.txt"].hash)
+    assert blob.ref_count == 2
+    db.expire_all()
+    assert docs["a.txt"].paperless.paperless_id == docs["b.txt"].paperless.paperless_id == blob.paperless_id
+
+
+def test_blobs_are_deleted_with_their_last_reference(db, user, collection, paperless):
+    docs = by_name(collection)
+    asyncio.run(link(db, user, [docs["a.txt"], docs["b.txt"]], b"same"))
+    db.commit()
+    paperless_id = db.get(BlobPaperless, docs["a.txt"].hash).paperless_id
+
+    asyncio.run(adapter.release_documents(db, [docs["a.txt"]]))
+    assert paperless.deleted == []
+    with Session(db.get_bind()) as session:
+        assert session.get(BlobPaperless, docs["a.txt"].hash).ref_count == 1
+
+    asyncio.run(adapter.release_documents(db, [docs["b.txt"]]))
+    assert paperless.deleted == [paperless_id]
+    with Session(db.get_bind()) as session:
+        assert session.get(BlobPaperless, docs["a.txt"].hash) is None
+
+
+def test_content_stored_by_another_process_wins(db, user, collection, paperless):
+    docs = by_name(collection)
+    file_hash = docs["a.txt"].hash
+
+    def other_process_stores_it():
+        with Session(db.get_bind()) as session:
+            session.add(BlobPaperless(hash=file_hash, paperless_id=42, ref_count=1))
+            session.commit()
+
+    paperless.on_verify = other_process_stores_it
+    asyncio.run(link(db, user, [docs["a.txt"]], b"same"))
+    db.commit()
+
+    # This process' copy is dropped and the documents point at the registered one
+    assert paperless.deleted == [100]
+    db.expire_all()
+    assert docs["a.txt"].paperless.paperless_id == 42
+    with Session(db.get_bind()) as session:
+        assert session.get(BlobPaperless, file_hash).ref_count == 2
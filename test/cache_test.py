@@ -0,0 +1,93 @@
+import os
+
+import pytest
+
+from utils.cache import LRUFileCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return LRUFileCache(str(tmp_path / "cache"), max_bytes=10)
+
+
+def test_least_recently_used_entries_are_evicted(cache):
+    assert cache.put("first", b"1234")
+    assert cache.put("second", b"1234")
+    # Using first makes second the oldest
+    assert cache.get("first") == b"1234"
+    assert cache.put("third", b"1234")
+
+    assert cache.lookup("second") is None
+    assert not os.path.exists(cache.path("second"))
+    assert cache.get("first") == cache.get("third") == b"1234"
+    assert cache.size == 8
+
+
+def test_entries_larger_than_the_budget_are_not_kept(cache):
+    cache.put("small", b"1234")
+    assert not cache.put("large", b"x" * 11)
+    assert cache.lookup("large") is None
+    assert cache.get("small") == b"1234"
+    assert [names for _, _, names in os.walk(cache.folder) if names] == [["small"]]
+
+
+def test_replacing_an_entry_keeps_its_size_right(cache):
+    cache.put("key", b"123456")
+    cache.put("key", b"12")
+    assert cache.size == 2
+    cache.discard("key")
+    assert cache.size == 0 and cache.lookup("key") is None
+
+
+def test_entries_are_reloaded_in_order_of_use(cache):
+    cache.put("old", b"1234")
+    cache.put("new", b"1234")
+    os.utime(cache.path("old"), (1, 1))
+    unfinished = cache.temp_path("partial")
+    with open(unfinished, "wb") as file:
+        file.write(b"12")
+
+    reloaded = LRUFileCache(cache.folder, max_bytes=10)
+    reloaded.load()
+    assert reloaded.size == 8
+    assert not os.path.exists(unfinished)
+    reloaded.put("newest", b"1234")
+    assert reloaded.lookup("old") is None
+    assert reloaded.lookup("new") is not None
+
+
+def test_keys_cannot_leave_the_cache_folder(cache):
+    with pytest.raises(ValueError):
+        cache.path("../escape")
+
+
+def test_disabled_cache_keeps_nothing(tmp_path):
+    cache = LRUFileCache(str(tmp_path / "cache"), max_bytes=0)
+    cache.load()
+    assert not cache.put("key", b"1")
+    assert cache.get("key") is None
+
+
+def test_pinned_entries_outlive_eviction_until_released(cache):
+    cache.put("sent", b"12345678")
+    path = cache.lookup("sent", pin=True)
+    assert cache.add_file("other", write(cache, "other", b"1234"), pin=True)
+
+    # Evicted from the index, but the file stays while the response reads it
+    assert cache.lookup("sent") is None and cache.size == 4
+    with open(path, "rb") as file:
+        assert file.read() == b"12345678"
+    cache.release("sent")
+    assert not os.path.exists(path)
+
+    cache.discard("other")
+    assert os.path.exists(cache.path("other"))
+    cache.release("other")
+    assert not os.path.exists(cache.path("other"))
+
+
+def write(cache: LRUFileCache, key: str, content: bytes) -> str:
+    temp = cache.temp_path(key)
+    with open(temp, "wb") as file:
+        file.write(content)
+    return temp
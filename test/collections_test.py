@@ -0,0 +1,119 @@
+import asyncio
+import hashlib
+import io
+from datetime import datetime, timedelta
+
+from conftest import make_collection, make_tar
+from sqlmodel import select
+
+import storage.collection as collections
+from models.collection import Collection, CollectionPermission, Document, Permission
+from models.event import EventTypes
+from models.user import User
+from storage.event import register_event
+
+
+class FakeStore:
+    """Records the documents handed over for upload."""
+
+    def __init__(self):
+        self.uploaded: list[str] = []
+
+    async def create_collection(self, db, collection, name):
+        pass
+
+    async def upload_folder(self, db, mappings, collection, user, job=None):
+        self.uploaded.extend(mapping.name for mapping in mappings)
+
+
+def test_archive_is_ingested_into_a_collection(db, user, scratch, monkeypatch):
+    store = FakeStore()
+    monkeypatch.setattr(collections, "store", store)
+    monkeypatch.setattr(collections, "verify_manifest", lambda *_: True)
+    files = {"hashes.asics": b"signature", "hashes.json": b"{}", "archive/a.txt": b"a", "archive/sub/b.txt": b"b"}
+
+    collection = asyncio.run(
+        collections.create_collection(db, "col.tar", io.BytesIO(make_tar(files, "w:gz")), db.merge(user), "0x0")
+    )
+
+    assert (collection.signature, collection.manifest) == (b"signature", "{}")
+    assert sorted(store.uploaded) == ["a.txt", "b.txt"]
+    documents = db.exec(select(Document).where(Document.collection_id == collection.id)).all()
+    assert sorted((doc.name, doc.hash) for doc in documents) == [
+        ("a.txt", hashlib.sha256(b"a").hexdigest()),
+        ("b.txt", hashlib.sha256(b"b").hexdigest()),
+    ]
+
+
+def test_events_keep_the_lifecycle_columns(db, user):
+    col = make_collection(db, user)
+    created = col.created_at
+    assert created is not None and col.deleted_at is None
+    assert col.last_access() == created
+
+    register_event(db, col, user, EventTypes.Access)
+    accessed = col.last_access_at
+    register_event(db, col, user, EventTypes.Delete)
+    deleted = col.deleted_at
+    register_event(db, col, user, EventTypes.Delete)
+    register_event(db, col, user, EventTypes.Create)
+    db.commit()
+    db.refresh(col)
+
+    # Only the first creation and deletion are kept
+    assert (col.created(), col.deleted_at) == (created, deleted)
+    assert col.is_deleted() and col.last_access() == accessed
+
+
+def test_deleted_collections_are_left_out(db, user):
+    kept = make_collection(db, user, "kept")
+    deleted = make_collection(db, user, "deleted")
+    register_event(db, deleted, user, EventTypes.Delete)
+    db.commit()
+
+    assert [col.id for col in collections.get_collections(db, user).items] == [kept.id]
+    assert [col.id for col in collections.get_collections_by_user(db, user).items] == [kept.id]
+    assert collections.get_collection_by_id(db, deleted.id, user) is None
+
+
+def test_visible_collections_match_can_view(db, user):
+    others = [User(name=name, email=f"{name}@example.com") for name in ["first", "second"]]
+    db.add_all(others)
+    db.commit()
+    owned = make_collection(db, user, "owned")
+    # Shared with the user by both others, it must still come up once
+    shared = make_collection(db, others[0], "shared")
+    readable = make_collection(db, others[0], "readable")
+    deleted = make_collection(db, others[1], "deleted")
+    make_collection(db, others[1], "private")
+    for col, creator, granted in [
+        (shared, others[0], Permission.view),
+        (shared, others[1], Permission.view),
+        (readable, others[0], Permission.read),
+        (deleted, others[1], Permission.view),
+    ]:
+        db.add(CollectionPermission(collection_id=col.id, user_id=user.id, creator_id=creator.id, permission=granted))
+    register_event(db, deleted, others[1], EventTypes.Delete)
+    db.commit()
+
+    visible = [col.id for col in collections.get_collections(db, user).items]
+
+    expected = [col.id for col in db.exec(select(Collection)).all() if col.can_view(user) and not col.is_deleted()]
+    assert sorted(visible) == sorted(expected) == sorted([owned.id, shared.id])
+    assert len(visible) == len(set(visible))
+
+
+def test_last_access_filter_keeps_documents_never_accessed(db, user):
+    col = make_collection(db, user, files={"old.txt": b"old", "recent.txt": b"recent", "never.txt": b"never"})
+    now = datetime.now()
+    for doc in col.documents:
+        if doc.name == "old.txt":
+            doc.last_access_at = now - timedelta(days=30)
+        elif doc.name == "recent.txt":
+            doc.last_access_at = now
+        db.add(doc)
+    db.commit()
+
+    page = collections.filter_documents(db, col, None, None, now - timedelta(days=1))
+
+    assert sorted(doc.name for doc in page.items) == ["never.txt", "recent.txt"]
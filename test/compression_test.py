@@ -0,0 +1,61 @@
+import asyncio
+import gzip
+
+import pytest
+import zstandard
+
+import utils.compression as compression
+from models.archive import ArchiveFormat
+from utils.compression import compress_stream, negotiate_format
+
+BLOCKS = [b"header" * 100, b"", b"content" * 50_000, b"trailer"]
+
+
+def compress(fmt: ArchiveFormat) -> bytes:
+    async def blocks():
+        for block in BLOCKS:
+            yield block
+
+    async def main():
+        return b"".join([chunk async for chunk in compress_stream(blocks(), fmt)])
+
+    return asyncio.run(main())
+
+
+def test_gzip_round_trip_is_reproducible(monkeypatch):
+    monkeypatch.setattr(compression, "COMPRESS_CHUNK_SIZE", 1000)
+    compressed = compress(ArchiveFormat.tar_gz)
+    assert gzip.decompress(compressed) == b"".join(BLOCKS)
+    assert compress(ArchiveFormat.tar_gz) == compressed
+
+
+def test_zstd_round_trip_is_reproducible():
+    compressed = compress(ArchiveFormat.tar_zst)
+    assert zstandard.ZstdDecompressor().decompressobj().decompress(compressed) == b"".join(BLOCKS)
+    assert compress(ArchiveFormat.tar_zst) == compressed
+
+
+def test_plain_tar_is_passed_through():
+    assert compress(ArchiveFormat.tar) == b"".join(BLOCKS)
+
+
+@pytest.mark.parametrize(
+    "accept, expected",
+    [
+        (None, ArchiveFormat.tar),
+        ("*/*", ArchiveFormat.tar),
+        (ArchiveFormat.tar_gz.media_type, ArchiveFormat.tar_gz),
+        (f"{ArchiveFormat.tar_gz.media_type}, {ArchiveFormat.tar_zst.media_type}", ArchiveFormat.tar_zst),
+        (f"{ArchiveFormat.tar_gz.media_type}, {ArchiveFormat.tar_zst.media_type};q=0.5", ArchiveFormat.tar_gz),
+        (f"{ArchiveFormat.tar_zst.media_type};q=0", ArchiveFormat.tar),
+        (f"{ArchiveFormat.tar_zst.media_type};q=oops", ArchiveFormat.tar),
+    ],
+)
+def test_format_negotiation(accept, expected):
+    assert negotiate_format(accept) == expected
+
+
+def test_zstd_is_not_offered_without_zstandard(monkeypatch):
+    monkeypatch.setattr(compression, "zstandard", None)
+    assert ArchiveFormat.tar_zst not in compression.available_formats()
+    assert negotiate_format(ArchiveFormat.tar_zst.media_type) == ArchiveFormat.tar
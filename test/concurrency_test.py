@@ -0,0 +1,78 @@
+import asyncio
+
+import aiohttp
+import pytest
+
+from utils.concurrency import AIMDLimiter, retry
+from utils.paperless import is_transient
+
+
+def test_limiter_bounds_calls_in_flight():
+    async def main():
+        limiter = AIMDLimiter(2, 1, 2, latency_target=60)
+        peak = 0
+
+        async def call():
+            nonlocal peak
+            async with limiter.slot():
+                peak = max(peak, limiter.in_flight)
+                await asyncio.sleep(0.01)
+
+        await asyncio.gather(*(call() for _ in range(10)))
+        return peak, limiter.in_flight
+
+    assert asyncio.run(main()) == (2, 0)
+
+
+def test_limiter_grows_additively_and_backs_off_once_per_window():
+    async def main():
+        limiter = AIMDLimiter(4, 1, 100, latency_target=60)
+        limiter._last_backoff = float("-inf")
+        # A full window of healthy calls adds about one
+        for _ in range(5):
+            await limiter.acquire()
+            await limiter.release(0.01, failed=False)
+        assert limiter.limit == 5
+        # A burst of failures only halves it once
+        for _ in range(3):
+            await limiter.acquire()
+            await limiter.release(0.01, failed=True)
+        assert limiter.limit == 2
+        # Slow calls count as failures, but the limit never drops below the minimum
+        for _ in range(2):
+            limiter._last_backoff = float("-inf")
+            await limiter.acquire()
+            await limiter.release(120, failed=False)
+            assert limiter.limit == 1
+
+    asyncio.run(main())
+
+
+def test_limiter_rejects_inconsistent_limits():
+    with pytest.raises(ValueError):
+        AIMDLimiter(10, 1, 5, latency_target=1)
+
+
+def test_transient_failures_are_retried():
+    attempts = []
+
+    async def flaky():
+        attempts.append(True)
+        if len(attempts) < 3:
+            raise aiohttp.ClientResponseError(None, (), status=503)  # type: ignore
+        return "done"
+
+    assert asyncio.run(retry(flaky, 5, is_transient, base_delay=0)) == "done"
+    assert len(attempts) == 3
+
+
+def test_permanent_failures_are_not_retried():
+    attempts = []
+
+    async def rejected():
+        attempts.append(True)
+        raise aiohttp.ClientResponseError(None, (), status=400)  # type: ignore
+
+    with pytest.raises(aiohttp.ClientResponseError):
+        asyncio.run(retry(rejected, 5, is_transient, base_delay=0))
+    assert len(attempts) == 1
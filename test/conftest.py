@@ -0,0 +1,95 @@
+import asyncio
+import hashlib
+import io
+import tarfile
+
+import pytest
+from sqlmodel import Session, SQLModel, create_engine
+
+import storage.collection as collections
+import storage.workspaces as workspaces
+from models.collection import Collection, Document
+from models.event import EventTypes
+from models.folder import Folder
+from models.user import User
+from storage.event import register_event
+
+
+@pytest.fixture
+def engine(tmp_path):
+    """A fresh database with every table. A file rather than in memory, so sessions get connections of their own."""
+    engine = create_engine(f"sqlite:///{tmp_path}/test.db", connect_args={"check_same_thread": False})
+    SQLModel.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def db(engine):
+    with Session(engine) as session:
+        yield session
+
+
+@pytest.fixture
+def user(engine) -> User:
+    """A user detached from any session, same as the ones get_current_user hands to the routes."""
+    with Session(engine) as session:
+        user = User(name="Test", email="test@example.com")
+        session.add(user)
+        session.commit()
+        session.refresh(user)
+    return user
+
+
+@pytest.fixture
+def scratch(tmp_path, monkeypatch):
+    """Keep workspaces and caches of the test under its own temporary directory, with nothing reserved yet."""
+    monkeypatch.setattr(workspaces, "WORKSPACES_FOLDER", str(tmp_path / "workspaces"))
+    monkeypatch.setattr(workspaces, "workspaces", {})
+    monkeypatch.setattr(workspaces, "reserved", 0)
+    monkeypatch.setattr(workspaces, "released", asyncio.Condition())
+    for name in ["archive_cache", "signature_cache"]:
+        cache = getattr(collections, name)
+        monkeypatch.setattr(cache, "folder", str(tmp_path / name))
+    return tmp_path
+
+
+def make_collection(db: Session, owner: User, name: str = "collection", files: dict[str, bytes] | None = None):
+    """A collection with documents at the given paths (relative to its root folder), created the way ingest does."""
+    collection = Collection(name=name, owner_id=owner.id)
+    root = Folder(name=name, collection_id=collection.id)
+    collection.folder = root
+    register_event(db, collection, owner, EventTypes.Create)
+    folders = {"": root}
+    for path, content in (files or {}).items():
+        parent = ""
+        *dirs, file_name = path.split("/")
+        for part in dirs:
+            current = f"{parent}/{part}" if parent else part
+            if current not in folders:
+                folders[current] = Folder(name=part, collection_id=collection.id, parent=folders[parent])
+                db.add(folders[current])
+            parent = current
+        doc = Document(
+            name=file_name,
+            size=len(content),
+            hash=hashlib.sha256(content).hexdigest(),
+            folder=folders[parent],
+            collection_id=collection.id,
+        )
+        db.add(doc)
+        register_event(db, doc, owner, EventTypes.Create)
+    db.add(collection)
+    db.commit()
+    db.refresh(collection)
+    return collection
+
+
+def make_tar(files: dict[str, bytes], mode: str = "w") -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode=mode) as tar:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return buffer.getvalue()
@@ -0,0 +1,201 @@
+import hashlib
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+import pytest
+from conftest import make_collection, make_tar
+from sqlalchemy import event
+from sqlmodel import select
+
+import storage.folder as folder
+from models.collection import Document, EDocumentIntake, FileDocumentIntake
+from models.event import EventTypes
+from models.folder import Folder, FolderIntake
+from storage.event import register_event
+from storage.folder import extract_archive, walk_folder
+
+
+class OneWayStream(io.RawIOBase):
+    """A stream that can't seek, like the body of a request."""
+
+    def __init__(self, data: bytes):
+        self.source = io.BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        chunk = self.source.read(len(buffer))
+        buffer[: len(chunk)] = chunk
+        return len(chunk)
+
+
+def sha256(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+FILES = {"col/a.txt": b"a" * 3_000_000, "col/sub/b.txt": b"b", "col/sub/deeper/c.txt": b""}
+
+
+@pytest.mark.parametrize("mode", ["w", "w:gz"])
+def test_archive_is_extracted_from_a_stream(tmp_path, mode):
+    hashes = extract_archive(OneWayStream(make_tar(FILES, mode)), str(tmp_path))
+
+    expected = {os.path.normpath(tmp_path / name): sha256(content) for name, content in FILES.items()}
+    assert hashes == expected
+    assert list(hashes) == list(expected), "hashes are in archive order"
+    for name, content in FILES.items():
+        assert (tmp_path / name).read_bytes() == content
+
+
+def test_archive_members_outside_the_target_are_rejected(tmp_path):
+    with pytest.raises(Exception, match="outside"):
+        extract_archive(io.BytesIO(make_tar({"../escape.txt": b"x"})), str(tmp_path / "target"))
+    assert not (tmp_path / "escape.txt").exists()
+
+
+def test_walked_documents_stay_on_disk(tmp_path, user):
+    (tmp_path / "col" / "sub").mkdir(parents=True)
+    (tmp_path / "col" / "a.txt").write_bytes(b"first")
+    (tmp_path / "col" / "sub" / "b.txt").write_bytes(b"second")
+
+    root = walk_folder(str(tmp_path / "col"), user)
+
+    sub, a = sorted(root.children, key=lambda child: child.name, reverse=True)
+    assert isinstance(sub, FolderIntake) and isinstance(a, FileDocumentIntake)
+    assert not hasattr(a, "content")
+    assert (a.size, a.hash, a.path) == (5, sha256(b"first"), str(tmp_path / "col" / "a.txt"))
+    # Written after the walk, to show the content is only read when asked for
+    (tmp_path / "col" / "sub" / "b.txt").write_bytes(b"changed")
+    intake = EDocumentIntake.create(uuid4(), sub.children[0])
+    assert intake.read() == b"changed"
+    with intake.open() as file:
+        assert file.read(3) == b"cha"
+
+
+class RecordingPool(ThreadPoolExecutor):
+    """A hashing pool remembering what it was given."""
+
+    def __init__(self):
+        super().__init__(max_workers=2, thread_name_prefix="hash")
+        self.submitted: list[str] = []
+
+    def submit(self, fn, /, *args, **kwargs):
+        self.submitted.append(getattr(fn, "__name__", repr(fn)))
+        return super().submit(fn, *args, **kwargs)
+
+
+def test_hashing_runs_on_the_pool_without_reading_files_back(tmp_path, user, monkeypatch):
+    monkeypatch.setattr(folder, "ARCHIVE_CHUNK_SIZE", 1000)
+    files = {f"col/{name}.txt": name.encode() * 2500 for name in "edcba"}
+    pool = RecordingPool()
+    monkeypatch.setattr(folder, "hash_pool", pool)
+    read_back = []
+    monkeypatch.setattr(folder, "hash_file", read_back.append)
+
+    done = []
+    hashes = extract_archive(io.BytesIO(make_tar(files)), str(tmp_path), on_hashed=done.append)
+
+    assert read_back == [] and pool.submitted == ["update"] * 15
+    assert done == list(hashes)
+    assert hashes[os.path.normpath(tmp_path / "col" / "a.txt")] == sha256(b"a" * 2500)
+
+    # Only files the extraction didn't hash are hashed again
+    monkeypatch.setattr(folder, "hash_file", lambda path: read_back.append(path) or sha256(b"late"))
+    (tmp_path / "col" / "late.txt").write_bytes(b"late")
+    root = walk_folder(str(tmp_path / "col"), user, hashes)
+    assert read_back == [os.path.normpath(tmp_path / "col" / "late.txt")]
+    # Children are sorted by name, whatever the order of the archive
+    assert [child.name for child in root.children] == ["a.txt", "b.txt", "c.txt", "d.txt", "e.txt", "late.txt"]
+    pool.shutdown()
+
+
+def test_bulk_insert_matches_the_structure(db, user, tmp_path, monkeypatch):
+    monkeypatch.setattr(folder, "BULK_INSERT_BATCH", 2)
+    for name in ["col/a.txt", "col/sub/b.txt", "col/sub/c.txt", "col/sub/deeper/d.txt", "col/other/e.txt"]:
+        (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / name).write_bytes(name.encode())
+    collection = make_collection(db, user, "col")
+    db_root = collection.folder
+    root = walk_folder(str(tmp_path / "col"), user)
+
+    mappings = folder.create_folder(db, root, db_root, bulk=True)
+
+    db.expire_all()
+    assert paths(db_root) == {
+        "a.txt",
+        "other/",
+        "other/e.txt",
+        "sub/",
+        "sub/b.txt",
+        "sub/c.txt",
+        "sub/deeper/",
+        "sub/deeper/d.txt",
+    }
+    documents = {doc.id: doc for doc in collection.documents}
+    assert sorted(documents) == sorted(mapping.doc_id for mapping in mappings)
+    for mapping in mappings:
+        doc = documents[mapping.doc_id]
+        assert (doc.name, doc.hash, doc.size) == (mapping.name, mapping.hash, mapping.size)
+        assert doc.lineage_id == doc.id and doc.is_current and doc.created_at is not None
+        assert [(event.type, event.user_id) for event in doc.events] == [(EventTypes.Create, user.id)]
+
+
+def paths(root: Folder, prefix: str = "") -> set[str]:
+    found = {f"{prefix}{doc.name}" for doc in root.documents}
+    for sub in root.sub_folders:
+        found.add(f"{prefix}{sub.name}/")
+        found |= paths(sub, f"{prefix}{sub.name}/")
+    return found
+
+
+def supersede(db, doc, content: bytes):
+    """A newer version of doc, the way update_document records one."""
+    newer = Document(
+        name=doc.name,
+        size=len(content),
+        hash=sha256(content),
+        folder_id=doc.folder_id,
+        collection_id=doc.collection_id,
+        lineage_id=doc.lineage_id,
+        version_no=doc.version_no + 1,
+    )
+    doc.is_current = False
+    db.add_all([doc, newer])
+    return newer
+
+
+def test_tree_is_loaded_in_a_fixed_number_of_queries(db, engine, user):
+    files = {f"d{i}/e{j}/f{i}{j}{k}.txt": b"%d" % k for i in range(3) for j in range(3) for k in range(3)}
+    collection = make_collection(db, user, "col", files)
+    documents = {doc.name: doc for doc in collection.documents}
+    updated = supersede(db, documents["f000.txt"], b"updated")
+    # Deleting any version leaves the whole chain out
+    supersede(db, documents["f111.txt"], b"updated")
+    register_event(db, documents["f111.txt"], user, EventTypes.Delete)
+    db.commit()
+    root = db.exec(
+        select(Folder).where(Folder.collection_id == collection.id).where(Folder.parent_id == None)  # noqa: E711
+    ).one()
+    # Nothing left loaded, so every relationship walked would show up as a query
+    db.expire_all()
+    db.refresh(root)
+
+    statements: list[str] = []
+
+    def listen(connection, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", listen)
+    try:
+        structure = folder.recreate_structure(db, root, user)
+    finally:
+        event.remove(engine, "before_cursor_execute", listen)
+
+    assert len([statement for statement in statements if statement.lstrip().startswith("SELECT")]) == 3
+    found = {path: item for path, item in folder.walk_structure(structure, "col") if not isinstance(item, FolderIntake)}
+    assert len(found) == len(files) - 1
+    assert "col/d1/e1/f111.txt" not in found
+    assert found["col/d0/e0/f000.txt"].id == updated.id
@@ -0,0 +1,101 @@
+import pytest
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.testclient import TestClient
+from starlette.background import BackgroundTask
+
+from utils.http import etag_matches, file_response, parse_range, stream_response
+
+CONTENT = bytes(range(256)) * 4
+ETAG = '"v1"'
+
+
+@pytest.mark.parametrize(
+    "header, expected",
+    [
+        ("bytes=0-99", (0, 99)),
+        ("bytes=1000-", (1000, 1023)),
+        ("bytes=1000-5000", (1000, 1023)),
+        ("bytes=-24", (1000, 1023)),
+        ("bytes=-5000", (0, 1023)),
+        # Ignored, the whole content is sent
+        ("bytes=10-5", None),
+        ("bytes=0-1,5-6", None),
+        ("items=0-1", None),
+        ("bytes=-", None),
+    ],
+)
+def test_parse_range(header, expected):
+    assert parse_range(header, len(CONTENT)) == expected
+
+
+@pytest.mark.parametrize("header, size", [("bytes=1024-", 1024), ("bytes=-0", 1024), ("bytes=-10", 0)])
+def test_unsatisfiable_ranges(header, size):
+    with pytest.raises(HTTPException) as raised:
+        parse_range(header, size)
+    assert raised.value.status_code == 416
+    assert raised.value.headers == {"Content-Range": f"bytes */{size}"}
+
+
+def test_etag_matching_is_weak():
+    assert etag_matches('"v0", W/"v1"', ETAG)
+    assert etag_matches("*", ETAG)
+    assert not etag_matches('"v2"', ETAG)
+    assert not etag_matches(None, ETAG)
+
+
+@pytest.fixture(params=["file", "stream"])
+def client(request, tmp_path):
+    """The same content served from a file and from a stream, which must answer alike."""
+    path = tmp_path / "content"
+    path.write_bytes(CONTENT)
+    app = FastAPI()
+    app.state.sent = []
+
+    @app.get("/content")
+    async def content(request: Request):
+        if request.app.state.kind == "file":
+            return file_response(request, str(path), ETAG, background=BackgroundTask(app.state.sent.append, True))
+        return stream_response(request, ETAG, len(CONTENT), lambda start, end: iter([CONTENT[start : end + 1]]))
+
+    app.state.kind = request.param
+    return TestClient(app)
+
+
+def test_whole_content(client):
+    response = client.get("/content")
+    assert response.status_code == 200
+    assert response.content == CONTENT
+    assert (response.headers["etag"], response.headers["accept-ranges"]) == (ETAG, "bytes")
+
+
+def test_not_modified(client):
+    response = client.get("/content", headers={"If-None-Match": ETAG})
+    assert response.status_code == 304
+    assert response.content == b""
+
+
+def test_partial_content(client):
+    response = client.get("/content", headers={"Range": "bytes=1000-", "If-Range": ETAG})
+    assert response.status_code == 206
+    assert response.content == CONTENT[1000:]
+    assert response.headers["content-range"] == "bytes 1000-1023/1024"
+    assert response.headers["content-length"] == "24"
+
+
+def test_range_of_another_version_sends_everything(client):
+    response = client.get("/content", headers={"Range": "bytes=1000-", "If-Range": '"v0"'})
+    assert response.status_code == 200
+    assert response.content == CONTENT
+
+
+def test_range_past_the_end(client):
+    response = client.get("/content", headers={"Range": "bytes=2000-"})
+    assert response.status_code == 416
+    assert response.headers["content-range"] == "bytes */1024"
+
+
+@pytest.mark.parametrize("client", ["file"], indirect=True)
+@pytest.mark.parametrize("headers", [{}, {"If-None-Match": ETAG}, {"Range": "bytes=1000-"}, {"Range": "bytes=2000-"}])
+def test_background_runs_whatever_the_answer(client, headers):
+    client.get("/content", headers=headers)
+    assert client.app.state.sent == [True]
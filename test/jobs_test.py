@@ -0,0 +1,91 @@
+import asyncio
+import io
+import threading
+
+from conftest import make_tar
+
+import storage.collection as collections
+import storage.jobs as jobs
+from models.job import JobStatus
+
+
+class FakeStore:
+    """Stands in for the storage backend, recording which thread the structure was written from."""
+
+    def __init__(self):
+        self.uploaded = 0
+
+    async def create_collection(self, db, collection, name):
+        pass
+
+    async def upload_folder(self, db, mappings, collection, user, job=None):
+        self.uploaded = len(mappings)
+        job.advance("uploaded", len(mappings))
+        job.advance("verified", len(mappings))
+
+
+def ingest_archive() -> bytes:
+    files = {"hashes.asics": b"signature", "hashes.json": b"{}"}
+    for name in ["a.txt", "b.txt", "sub/c.txt", "sub/d.txt"]:
+        files[f"archive/{name}"] = name.encode()
+    return make_tar(files)
+
+
+def test_ingest_job_counts_documents_only(engine, user, scratch, monkeypatch):
+    store = FakeStore()
+    monkeypatch.setattr(collections, "store", store)
+    monkeypatch.setattr(collections, "verify_manifest", lambda *_: True)
+    monkeypatch.setattr(jobs, "engine", engine)
+    insert_threads = []
+    create_folder = collections.create_folder
+
+    def recording_create_folder(*args):
+        insert_threads.append(threading.current_thread())
+        return create_folder(*args)
+
+    monkeypatch.setattr(collections, "create_folder", recording_create_folder)
+    archive = ingest_archive()
+    job = jobs.submit_ingest(user, "col.tar", "0x0", lambda: io.BytesIO(archive), size=len(archive))
+    jobs.queue.get_nowait()
+
+    asyncio.run(jobs.run_ingest(job, user, "0x0", lambda: io.BytesIO(archive), None))
+
+    assert job.status == JobStatus.done, job.error
+    assert job.files_total == 4
+    assert job.files_hashed == 4
+    assert job.files_uploaded == job.files_verified == 4
+    assert store.uploaded == 4
+    # The structure is inserted off the event loop
+    assert insert_threads and insert_threads[0] is not threading.main_thread()
+
+
+def test_failed_ingest_job_records_error(engine, user, scratch, monkeypatch):
+    monkeypatch.setattr(collections, "store", FakeStore())
+    monkeypatch.setattr(collections, "verify_manifest", lambda *_: False)
+    monkeypatch.setattr(jobs, "engine", engine)
+    archive = ingest_archive()
+    cleaned = []
+
+    async def cleanup():
+        cleaned.append(True)
+
+    job = jobs.submit_ingest(user, "col.tar", "0x0", lambda: io.BytesIO(archive))
+    jobs.queue.get_nowait()
+
+    asyncio.run(jobs.run_ingest(job, user, "0x0", lambda: io.BytesIO(archive), cleanup))
+
+    assert job.status == JobStatus.failed
+    assert "Manifest hash" in job.error
+    assert cleaned == [True]
+    assert jobs.get_job(job.id, user) is job
+
+
+def test_unexpected_failures_are_not_shown_to_clients(engine, user, scratch, monkeypatch):
+    monkeypatch.setattr(collections, "store", FakeStore())
+    monkeypatch.setattr(jobs, "engine", engine)
+    job = jobs.submit_ingest(user, "col.tar", "0x0", lambda: io.BytesIO(b"not a tar archive"))
+
+    asyncio.run(jobs.run_ingest(*jobs.queue.get_nowait()))
+
+    assert job.status == JobStatus.failed
+    assert job.error == jobs.INGEST_FAILED
@@ -0,0 +1,142 @@
+import os
+import shutil
+import uuid
+
+import pytest
+from sqlalchemy import create_engine, text
+
+from alembic import command
+from alembic.config import Config
+
+HERE = os.path.dirname(__file__)
+
+
+class Database:
+    """A copy of the test database, migrated step by step with alembic."""
+
+    def __init__(self, path: str):
+        self.url = f"sqlite:///{path}"
+        self.engine = create_engine(self.url)
+        # Built without alembic.ini, so the logging of the test run is left alone
+        self.config = Config()
+        self.config.set_main_option("script_location", os.path.join(HERE, "..", "alembic"))
+        self.config.set_main_option("sqlalchemy.url", self.url)
+
+    def upgrade(self, revision: str):
+        command.upgrade(self.config, revision)
+
+    def execute(self, statement: str, **params):
+        with self.engine.begin() as connection:
+            connection.execute(text(statement), params)
+
+    def query(self, statement: str, **params) -> list[tuple]:
+        with self.engine.connect() as connection:
+            return [tuple(row) for row in connection.execute(text(statement), params)]
+
+    def documents(self, count: int) -> list[str]:
+        return [row[0] for row in self.query("SELECT id FROM document ORDER BY id LIMIT :count", count=count)]
+
+    def delete(self, doc_id: str):
+        self.record(doc_id, "Delete")
+
+    def record(self, doc_id: str, event_type: str, timestamp: str | None = None):
+        """Add an event for the document, by the user who created it."""
+        self.execute(
+            "INSERT INTO documentevent (timestamp, id, user_id, document_id, type) "
+            "SELECT COALESCE(:timestamp, CURRENT_TIMESTAMP), :id, user_id, document_id, :type "
+            "FROM documentevent WHERE document_id = :doc AND type = 'Create'",
+            timestamp=timestamp,
+            id=uuid.uuid4().hex,
+            doc=doc_id,
+            type=event_type,
+        )
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = tmp_path / "test.db"
+    shutil.copy(os.path.join(HERE, "test.db"), path)
+    database = Database(str(path))
+    yield database
+    database.engine.dispose()
+
+
+def test_blob_backfill_counts_live_documents(database):
+    database.upgrade("2d1058b6847b")
+    kept, deleted, gone = database.documents(3)
+    # kept and deleted were both uploaded with the same content, gone has content only deleted documents held
+    for doc_id, file_hash, paperless_id in [(kept, "same", 11), (deleted, "same", 10), (gone, "gone", 12)]:
+        database.execute("UPDATE document SET hash = :hash WHERE id = :id", hash=file_hash, id=doc_id)
+        database.execute("INSERT INTO documentpaperless VALUES (:paperless, :id)", paperless=paperless_id, id=doc_id)
+    database.delete(deleted)
+    database.delete(gone)
+
+    database.upgrade("7c5e1a9d3b42")
+
+    assert database.query("SELECT hash, paperless_id, ref_count FROM blobpaperless") == [("same", 11, 1)]
+    links = database.query("SELECT doc_id, paperless_id FROM documentpaperless ORDER BY paperless_id")
+    assert links == [(deleted, 10), (kept, 11), (gone, 12)]
+
+
+def test_lifecycle_backfill_follows_the_events(database):
+    database.upgrade("7c5e1a9d3b42")
+    accessed, deleted, untouched = database.documents(3)
+    database.record(accessed, "Access", "2024-01-01 10:00:00.000000")
+    database.record(accessed, "Access", "2024-03-01 10:00:00.000000")
+    database.record(deleted, "Delete", "2024-02-01 10:00:00.000000")
+    database.record(deleted, "Delete", "2024-04-01 10:00:00.000000")
+
+    database.upgrade("e4b7c2a91f60")
+
+    for table in ["collection", "document"]:
+        assert database.query(f"SELECT COUNT(*) FROM {table} WHERE created_at IS NULL") == [(0,)]
+    rows = database.query(
+        "SELECT id, deleted_at, last_access_at FROM document WHERE id IN (:a, :b, :c)",
+        a=accessed,
+        b=deleted,
+        c=untouched,
+    )
+    assert sorted(rows) == sorted(
+        [
+            (accessed, None, "2024-03-01 10:00:00.000000"),
+            (deleted, "2024-02-01 10:00:00.000000", None),
+            (untouched, None, None),
+        ]
+    )
+
+
+def test_visibility_indexes_are_added(database):
+    database.upgrade("5a9d3e07c1b8")
+
+    indexes = {row[0] for row in database.query("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {"ix_collection_owner_id", "ix_collectionpermission_user_id"} <= indexes
+    plan = database.query("EXPLAIN QUERY PLAN SELECT collection_id FROM collectionpermission WHERE user_id = 'x'")
+    assert any("ix_collectionpermission_user_id" in row[-1] for row in plan)
+
+
+def test_versions_are_numbered_along_update_chains(database):
+    database.upgrade("5a9d3e07c1b8")
+    first, second, third, alone = database.documents(4)
+    for previous, updated in [(first, second), (second, third)]:
+        database.execute(
+            'INSERT INTO "update" (id, timestamp, user_id, previous_id, updated_id) '
+            "SELECT :id, CURRENT_TIMESTAMP, user_id, :previous, :updated "
+            "FROM documentevent WHERE document_id = :previous",
+            id=uuid.uuid4().hex,
+            previous=previous,
+            updated=updated,
+        )
+
+    database.upgrade("9b2f6d4e8a13")
+
+    rows = database.query(
+        "SELECT id, lineage_id, version_no, is_current FROM document WHERE id IN (:a, :b, :c, :d)",
+        a=first,
+        b=second,
+        c=third,
+        d=alone,
+    )
+    assert sorted(rows) == sorted(
+        [(first, first, 1, 0), (second, first, 2, 0), (third, first, 3, 1), (alone, alone, 1, 1)]
+    )
+    assert database.query("SELECT COUNT(*) FROM document WHERE lineage_id IS NULL OR is_current = 0") == [(2,)]
@@ -0,0 +1,37 @@
+from uuid import uuid4
+
+import pytest
+from fastapi import HTTPException
+
+from storage.main import MAX_PAGE_SIZE, PAGE_SIZE
+from utils.pagination import decode_cursor, encode_cursor, make_page, page_size
+
+
+def test_cursors_round_trip():
+    for _ in range(20):
+        key = uuid4()
+        cursor = encode_cursor(key)
+        assert "=" not in cursor
+        assert decode_cursor(cursor) == key
+
+
+@pytest.mark.parametrize("cursor", ["", "not a cursor", "AAAA", "é" * 22])
+def test_invalid_cursors_are_rejected(cursor):
+    with pytest.raises(HTTPException) as error:
+        decode_cursor(cursor)
+    assert error.value.status_code == 400
+
+
+@pytest.mark.parametrize(
+    "limit, expected", [(None, PAGE_SIZE), (0, 1), (-5, 1), (1, 1), (MAX_PAGE_SIZE + 1, MAX_PAGE_SIZE)]
+)
+def test_page_size_is_kept_in_bounds(limit, expected):
+    assert page_size(limit) == expected
+
+
+def test_pages_only_point_further_when_more_rows_came():
+    keys = sorted(uuid4() for _ in range(4))
+    assert make_page(keys, 4, lambda key: key).next_cursor is None
+    page = make_page(keys, 3, lambda key: key)
+    assert page.items == keys[:3]
+    assert decode_cursor(page.next_cursor) == keys[2]
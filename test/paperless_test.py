@@ -0,0 +1,166 @@
+import asyncio
+import contextlib
+
+import pytest
+
+import utils.paperless as ppl
+from utils.paperless import TaskPoller
+
+
+class FakePaperless:
+    """Answers the task listing with whatever tasks is set to, and records acknowledgements."""
+
+    def __init__(self):
+        self.tasks: list[dict] = []
+        self.acknowledged: list[int] = []
+
+    async def request_json(self, method: str, path: str, **kwargs):
+        if method == "post":
+            self.acknowledged.extend(kwargs["json"]["tasks"])
+            return {}
+        return [task for task in self.tasks if task["id"] not in self.acknowledged]
+
+
+def task(id: int, status: str, document: int | None = None, result: str | None = None) -> dict:
+    return {"id": id, "task_id": f"task-{id}", "status": status, "related_document": document, "result": result}
+
+
+def run_with(fake: FakePaperless, monkeypatch, coro):
+    async def get_paperless():
+        return fake
+
+    monkeypatch.setattr(ppl, "get_paperless", get_paperless)
+    return asyncio.run(coro)
+
+
+def test_poller_resolves_finished_tasks(monkeypatch):
+    fake = FakePaperless()
+    fake.tasks = [task(1, "SUCCESS", document=10), task(2, "STARTED"), task(3, "PENDING")]
+
+    async def main():
+        poller = TaskPoller(0.01, 0.05, 60)
+        first = asyncio.create_task(poller.wait("task-1"))
+        second = asyncio.create_task(poller.wait("task-2"))
+        assert await first == 10
+        # STARTED is unknown to pypaperless and must count as pending
+        await asyncio.sleep(0.1)
+        assert not second.done()
+        fake.tasks[1] = task(2, "SUCCESS", document=20)
+        assert await second == 20
+        await poller.stop()
+
+    run_with(fake, monkeypatch, main())
+    assert fake.acknowledged == [1, 2]
+
+
+def test_poller_reports_failures(monkeypatch):
+    fake = FakePaperless()
+    fake.tasks = [task(1, "FAILURE", result="Not consuming doc: It is a duplicate of 3")]
+
+    async def main():
+        poller = TaskPoller(0.01, 0.05, 60)
+        with pytest.raises(ValueError, match="duplicate"):
+            await poller.wait("task-1")
+        await poller.stop()
+
+    run_with(fake, monkeypatch, main())
+
+
+def test_poller_times_out_tasks_never_listed(monkeypatch):
+    fake = FakePaperless()
+
+    async def main():
+        poller = TaskPoller(0.01, 0.05, 0.2)
+        with pytest.raises(ValueError, match="in time"):
+            await asyncio.wait_for(poller.wait("task-1"), timeout=5)
+        assert poller._waiters == {}
+        await poller.stop()
+
+    run_with(fake, monkeypatch, main())
+
+
+def test_client_is_shared_and_initialized_once(monkeypatch):
+    initialized = []
+
+    async def initialize(self):
+        initialized.append(self)
+        await asyncio.sleep(0.01)
+        self._initialized = True
+
+    monkeypatch.setattr(ppl.Paperless, "initialize", initialize)
+    monkeypatch.setattr(ppl, "initialize_lock", asyncio.Lock())
+
+    async def main():
+        clients = await asyncio.gather(*(ppl.get_paperless() for _ in range(5)))
+        session = clients[0]._session
+        limit = session.connector.limit
+        await ppl.close_client()
+        return clients, session, limit
+
+    clients, session, limit = asyncio.run(main())
+    assert all(client is clients[0] for client in clients)
+    assert initialized == [clients[0]]
+    # Connections are pooled by the session of the client, which closes with it
+    assert limit == ppl.PAPERLESS_POOL_SIZE
+    assert session.closed and ppl.paperless_client is None
+
+
+class FakeDownload:
+    """Answers a document download with the given body, in blocks of the given sizes."""
+
+    def __init__(self, body: bytes, sizes: list[int]):
+        self.body = body
+        self.sizes = sizes
+        self.content = self
+
+    @contextlib.asynccontextmanager
+    async def request(self, method: str, path: str, **kwargs):
+        yield self
+
+    def raise_for_status(self):
+        pass
+
+    async def iter_chunked(self, size: int):
+        position = 0
+        for block_size in self.sizes:
+            yield self.body[position : position + block_size]
+            position += block_size
+
+
+@pytest.mark.parametrize("sizes", [[10], [3, 3, 4], [7, 1, 1, 1], [1] * 10, [8, 2]])
+def test_downloads_are_trimmed_across_blocks(monkeypatch, sizes):
+    fake = FakeDownload(b"contentSFX", sizes)
+
+    async def main():
+        return b"".join([bytes(block) async for block in ppl.stream_document(1, trim=3)])
+
+    assert run_with(fake, monkeypatch, main()) == b"content"
+
+
+def test_downloads_shorter_than_the_trim_fail(monkeypatch):
+    fake = FakeDownload(b"ab", [1, 1])
+
+    async def main():
+        return [block async for block in ppl.stream_document(1, trim=3)]
+
+    with pytest.raises(ValueError, match="shorter"):
+        run_with(fake, monkeypatch, main())
+
+
+def test_uploads_stream_the_file_then_the_suffix(tmp_path, monkeypatch):
+    monkeypatch.setattr(ppl, "DOCUMENT_CHUNK_SIZE", 4)
+    path = tmp_path / "document"
+    path.write_bytes(b"document content")
+    written: list[bytes] = []
+
+    class Writer:
+        async def write(self, chunk: bytes):
+            written.append(chunk)
+
+    file = open(path, "rb")
+    payload = ppl.SuffixedFilePayload(file, b"-suffix")
+    assert payload.size == len(b"document content-suffix")
+    asyncio.run(payload.write(Writer()))
+
+    assert written == [b"docu", b"ment", b" con", b"tent", b"-suffix"]
+    assert file.closed
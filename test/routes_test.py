@@ -0,0 +1,162 @@
+import pytest
+from conftest import make_collection
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlmodel import select
+
+import routes.collections
+import routes.documents
+import storage.collection as collections
+from models.collection import Document
+from utils.security import get_current_user, obfuscate_signature
+
+CONTENT = bytes(range(256)) * 8192
+
+
+class FakeStore:
+    """Streams document content the way the Paperless adapter does, in memoryviews rather than bytes."""
+
+    def __init__(self, content: bytes):
+        self.content = content
+        self.streamed = 0
+
+    async def store_document(self, db, doc, file, col, user):
+        pass
+
+    async def stream_document(self, db, doc):
+        self.streamed += 1
+        view = memoryview(self.content)
+        for start in range(0, len(view), 300_000):
+            yield view[start : start + 300_000]
+
+
+@pytest.fixture
+def store(monkeypatch):
+    store = FakeStore(CONTENT)
+    monkeypatch.setattr(collections, "store", store)
+    return store
+
+
+@pytest.fixture
+def client(engine, user, scratch, monkeypatch):
+    """The collection and document routes on the test database, called by the test user."""
+    for module in [routes.collections, routes.documents]:
+        monkeypatch.setattr(module, "engine", engine)
+    app = FastAPI()
+    app.include_router(routes.collections.collections_router)
+    app.include_router(routes.documents.documents_router)
+    app.dependency_overrides[get_current_user] = lambda: user
+    return TestClient(app)
+
+
+@pytest.fixture
+def signed(db, user):
+    collection = make_collection(db, user)
+    collection.signature = CONTENT[:100_000]
+    db.add(collection)
+    db.commit()
+    db.refresh(collection)
+    return collection
+
+
+@pytest.fixture
+def document(db, user):
+    collection = make_collection(db, user, files={"report.pdf": CONTENT})
+    return collection.documents[0]
+
+
+def test_document_content_is_streamed(client, store, document):
+    response = client.get(f"/documents/{document.id}/content")
+
+    assert response.status_code == 200
+    assert response.content == CONTENT
+    assert response.headers["content-type"] == "application/pdf"
+    assert response.headers["etag"] == f'"{document.hash}"'
+
+
+def test_document_content_ranges_span_chunks(client, store, document):
+    response = client.get(f"/documents/{document.id}/content", headers={"Range": "bytes=299990-600009"})
+
+    assert response.status_code == 206
+    assert response.content == CONTENT[299_990:600_010]
+    assert response.headers["content-range"] == f"bytes 299990-600009/{len(CONTENT)}"
+
+
+def test_document_content_not_modified_skips_storage(client, store, document):
+    response = client.get(f"/documents/{document.id}/content", headers={"If-None-Match": f'"{document.hash}"'})
+
+    assert response.status_code == 304
+    assert store.streamed == 0
+
+
+@pytest.mark.parametrize("cache_bytes", [1024 * 1024, 0])
+def test_signature_is_served_with_or_without_the_cache(client, signed, monkeypatch, cache_bytes):
+    monkeypatch.setattr(collections.signature_cache, "max_bytes", cache_bytes)
+    encoded = obfuscate_signature(signed.signature)
+    etag = f'"{collections.signature_version(signed)}"'
+
+    response = client.get("/collections/signature", params={"col_uuid": str(signed.id)})
+    assert response.status_code == 200
+    assert response.content == encoded
+    assert response.headers["etag"] == etag
+
+    response = client.get(
+        "/collections/signature", params={"col_uuid": str(signed.id)}, headers={"Range": "bytes=1000-1999"}
+    )
+    assert response.status_code == 206
+    assert response.content == encoded[1000:2000]
+
+    params = {"col_uuid": str(signed.id)}
+    response = client.get("/collections/signature", params=params, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    # Nothing is left pinned once the responses have been sent
+    assert collections.signature_cache.pinned == 0
+
+
+def test_collections_are_listed_page_by_page(client, db, user):
+    created = sorted(make_collection(db, user, f"collection {index}").id for index in range(7))
+
+    listed = []
+    params = {"limit": 3}
+    while True:
+        response = client.get("/collections/user", params=params)
+        assert response.status_code == 200
+        page = response.json()
+        assert len(page["items"]) <= 3
+        listed.extend(item["id"] for item in page["items"])
+        if page["next_cursor"] is None:
+            break
+        params["cursor"] = page["next_cursor"]
+
+    assert listed == [str(key) for key in created]
+    assert client.get("/collections/user", params={"cursor": "not a cursor"}).status_code == 400
+
+
+def test_document_updates_form_a_history(client, db, store, document):
+    params = {"col_uuid": str(document.collection_id)}
+
+    def update(doc_id, content: bytes):
+        files = {"file": ("report.pdf", content)}
+        return client.put("/documents/documents/", params={**params, "doc_uuid": str(doc_id)}, files=files)
+
+    def versions() -> list[Document]:
+        db.expire_all()
+        statement = select(Document).where(Document.lineage_id == document.lineage_id).order_by(Document.version_no)
+        return list(db.exec(statement).all())
+
+    assert update(document.id, b"second").status_code == 200
+    # Only the latest version can be updated
+    assert update(document.id, b"again").status_code == 400
+    assert update(versions()[-1].id, b"third").status_code == 200
+
+    first, second, third = versions()
+    assert [(doc.version_no, doc.is_current) for doc in (first, second, third)] == [(1, False), (2, False), (3, True)]
+
+    def updates(doc_id) -> list[tuple[str, str]]:
+        history = client.get("/documents/documents/history", params={**params, "doc_uuid": str(doc_id)}).json()
+        return [(event["previous_id"], event["updated_id"]) for event in history if "updated_id" in event]
+
+    chain = [(str(first.id), str(second.id)), (str(second.id), str(third.id))]
+    assert sorted(updates(first.id)) == sorted(chain)
+    assert updates(second.id) == chain[1:]
+    assert updates(third.id) == []
@@ -0,0 +1,89 @@
+import asyncio
+import hashlib
+import os
+
+import pytest
+
+import storage.jobs as jobs
+import storage.uploads as uploads
+import storage.workspaces as workspaces
+from storage.uploads import ChunkReader
+
+
+async def body(*parts: bytes):
+    for part in parts:
+        yield part
+
+
+def send(upload, index: int, content: bytes, checksum: str | None = None):
+    checksum = checksum or hashlib.sha256(content).hexdigest()
+    return asyncio.run(uploads.write_chunk(upload, index, body(content[:3], content[3:]), checksum))
+
+
+def test_chunk_reader_joins_chunks(tmp_path):
+    paths = []
+    for index, content in enumerate([b"abc", b"", b"defgh", b"i"]):
+        paths.append(str(tmp_path / f"{index}.chunk"))
+        (tmp_path / f"{index}.chunk").write_bytes(content)
+
+    reader = ChunkReader(paths)
+    assert reader.read(2) == b"ab"
+    assert reader.read(4) == b"c"
+    assert reader.read() == b"defghi"
+    assert reader.read() == b""
+    reader.close()
+
+
+def test_chunks_are_checked_and_can_be_resent(scratch, user):
+    upload = asyncio.run(uploads.initiate_upload(user, "col.tar", "0x0"))
+
+    info = send(upload, 1, b"second chunk")
+    assert (info.size, info.sha256) == (12, hashlib.sha256(b"second chunk").hexdigest())
+    with pytest.raises(ValueError, match="checksum"):
+        send(upload, 0, b"first chunk", checksum=hashlib.sha256(b"something else").hexdigest())
+    # A rejected chunk leaves nothing behind, not even its partial copy
+    assert 0 not in upload.chunks
+    assert os.listdir(uploads.upload_folder(upload)) == ["1.chunk"]
+    with pytest.raises(ValueError, match="missing"):
+        uploads.finalize_upload(upload, user, 2)
+
+    send(upload, 0, b"first chunk, ")
+    send(upload, 1, b"resent second chunk")
+    # Only the chunks kept count against the quota
+    assert workspaces.reserved == 32
+    folder = uploads.upload_folder(upload)
+    job = uploads.finalize_upload(upload, user, 2)
+    _, _, _, source, cleanup = jobs.queue.get_nowait()
+
+    assert job.archive_size == 32
+    with source() as archive:
+        assert archive.read() == b"first chunk, resent second chunk"
+    asyncio.run(cleanup())
+    assert not os.path.exists(folder)
+    assert workspaces.reserved == 0
+    assert uploads.get_upload(upload.id, user) is None
+
+
+def test_oversized_chunks_are_rejected(scratch, user, monkeypatch):
+    monkeypatch.setattr(uploads, "MAX_CHUNK_SIZE", 4)
+    upload = asyncio.run(uploads.initiate_upload(user, "col.tar", "0x0"))
+    with pytest.raises(OverflowError):
+        send(upload, 0, b"too large")
+    assert upload.chunks == {}
+    assert workspaces.reserved == 0
+    asyncio.run(uploads.abort_upload(upload))
+    assert uploads.get_upload(upload.id, user) is None
+
+
+def test_chunks_beyond_the_quota_are_rejected(scratch, user, monkeypatch):
+    monkeypatch.setattr(workspaces, "QUOTA", 20)
+    first = asyncio.run(uploads.initiate_upload(user, "first.tar", "0x0"))
+    second = asyncio.run(uploads.initiate_upload(user, "second.tar", "0x0"))
+    send(first, 0, b"x" * 15)
+    with pytest.raises(OverflowError, match="quota"):
+        send(second, 0, b"y" * 10)
+    assert second.chunks == {} and workspaces.reserved == 15
+    # Alone, an upload may go over the quota rather than never finish
+    asyncio.run(uploads.abort_upload(first))
+    send(second, 0, b"y" * 30)
+    assert workspaces.reserved == 30
@@ -0,0 +1,134 @@
+import asyncio
+import io
+import os
+from datetime import datetime, timedelta
+
+import pytest
+from conftest import make_tar
+
+import storage.collection as collections
+import storage.jobs as jobs
+import storage.workspaces as workspaces
+from models.job import IngestJob, JobStatus
+
+
+def expire(ws):
+    ws.expires = datetime.now() - timedelta(minutes=1)
+
+
+def test_sweep_keeps_workspaces_of_running_jobs(scratch, user):
+    async def main():
+        job = IngestJob(name="col.tar", owner_id=user.id)
+        running = await workspaces.open_workspace("ingest", reserve=10, job=job)
+        abandoned = await workspaces.open_workspace("download", reserve=5)
+        for ws in [running, abandoned]:
+            expire(ws)
+        os.makedirs(f"{workspaces.WORKSPACES_FOLDER}/leftover")
+
+        await workspaces.sweep()
+        assert not running.closed and abandoned.closed
+        assert os.listdir(workspaces.WORKSPACES_FOLDER) == [str(running.id)]
+        assert workspaces.reserved == 10
+
+        job.finish()
+        await workspaces.sweep()
+        assert running.closed and workspaces.reserved == 0
+
+    asyncio.run(main())
+
+
+def test_workspaces_wait_for_room(scratch, monkeypatch):
+    monkeypatch.setattr(workspaces, "QUOTA", 10)
+
+    async def main():
+        first = await workspaces.open_workspace("first", reserve=8)
+        second = asyncio.create_task(workspaces.open_workspace("second", reserve=8))
+        await asyncio.sleep(0.01)
+        assert not second.done()
+        await workspaces.close_workspace(first)
+        await asyncio.wait_for(second, timeout=1)
+        assert workspaces.reserved == 8
+
+    asyncio.run(main())
+
+
+class FakeStore:
+    """Records what the workspaces held while the documents were being stored."""
+
+    def __init__(self):
+        self.reserved = 0
+
+    async def create_collection(self, db, collection, name):
+        pass
+
+    async def upload_folder(self, db, mappings, collection, user, job=None):
+        self.reserved = workspaces.reserved
+
+
+def staged_ingest(user, archive: bytes):
+    async def main():
+        ws = await jobs.stage_archive(io.BytesIO(archive))
+        assert workspaces.reserved == len(archive)
+        job = jobs.submit_staged_ingest(user, "col.tar.gz", "0x0", ws)
+        queued = jobs.queue.get_nowait()
+        # A job must never wait on the room its own archive holds
+        await asyncio.wait_for(jobs.run_ingest(*queued), timeout=5)
+        return job
+
+    return asyncio.run(main())
+
+
+@pytest.fixture
+def store(engine, monkeypatch):
+    store = FakeStore()
+    monkeypatch.setattr(collections, "store", store)
+    monkeypatch.setattr(collections, "verify_manifest", lambda *_: True)
+    monkeypatch.setattr(jobs, "engine", engine)
+    return store
+
+
+def test_ingest_reserves_the_extracted_size(scratch, user, store):
+    files = {"hashes.asics": b"signature", "hashes.json": b"{}", "archive/a.txt": b"a" * 200_000}
+    archive = make_tar(files, "w:gz")
+    extracted = sum(len(content) for content in files.values())
+
+    job = staged_ingest(user, archive)
+
+    assert job.status == JobStatus.done, job.error
+    # The staged archive and everything extracted from it
+    assert store.reserved == len(archive) + extracted
+    assert workspaces.reserved == 0
+    assert os.listdir(workspaces.WORKSPACES_FOLDER) == []
+
+
+def test_archives_larger_than_half_the_quota_are_ingested(scratch, user, store, monkeypatch):
+    files = {"hashes.asics": b"signature", "hashes.json": b"{}", "archive/a.bin": os.urandom(200_000)}
+    archive = make_tar(files)
+    # Room for the staged archive, but not for extracting it next to it
+    monkeypatch.setattr(workspaces, "QUOTA", len(archive) + 1000)
+
+    job = staged_ingest(user, archive)
+
+    assert job.status == JobStatus.done, job.error
+    assert store.reserved > workspaces.QUOTA
+    assert workspaces.reserved == 0
+
+
+def test_ingest_fails_when_extracting_goes_over_the_quota(scratch, user, store, monkeypatch):
+    monkeypatch.setattr(workspaces, "QUOTA", 100_000)
+    files = {"hashes.asics": b"signature", "hashes.json": b"{}", "archive/a.txt": b"a" * 200_000}
+
+    async def main():
+        # Held by someone else, so the ingest can't have the whole quota to itself
+        other = await workspaces.open_workspace("download", reserve=1000)
+        ws = await jobs.stage_archive(io.BytesIO(make_tar(files, "w:gz")))
+        job = jobs.submit_staged_ingest(user, "col.tar.gz", "0x0", ws)
+        await asyncio.wait_for(jobs.run_ingest(*jobs.queue.get_nowait()), timeout=5)
+        await workspaces.close_workspace(other)
+        return job
+
+    job = asyncio.run(main())
+
+    assert job.status == JobStatus.failed
+    assert "quota" in job.error
+    assert workspaces.reserved == 0
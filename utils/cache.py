@@ -0,0 +1,189 @@
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from uuid import uuid4
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+KEY_PATTERN = re.compile(r"[A-Za-z0-9_-]+")
+
+
+class LRUFileCache:
+    """
+    Files on disk addressed by key, kept under a total size budget by evicting the least recently used ones.
+
+    Entries are written to a temporary file next to their final place and renamed into it,
+    so readers never see a partially written entry. Safe to use from several threads.
+    Entries handed out pinned (see lookup and add_file) stay on disk until they are released,
+    so a file being sent can't be evicted from under the response.
+
+    Args:
+        folder: str = Where the entries are kept, in subfolders named after the first characters of their key.
+        max_bytes: int = Total size of the entries, 0 disables the cache.
+    """
+
+    def __init__(self, folder: str, max_bytes: int):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        # Pin count of the entries in use, and the pinned ones dropped from the index, removed once released
+        self._pins: dict[str, int] = {}
+        self._dropped: set[str] = set()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def pinned(self) -> int:
+        """Number of entries handed out pinned and not released yet."""
+        return sum(self._pins.values())
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def path(self, key: str) -> str:
+        if KEY_PATTERN.fullmatch(key) is None:
+            raise ValueError(f"Invalid cache key '{key}'")
+        return os.path.join(self.folder, key[:2], key)
+
+    def temp_path(self, key: str) -> str:
+        """A fresh path to write an entry to before handing it to add_file."""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return f"{path}.{uuid4().hex}.tmp"
+
+    def load(self):
+        """Index the entries left on disk by a previous run, oldest used first, dropping unfinished writes."""
+        if not self.enabled:
+            return
+        os.makedirs(self.folder, exist_ok=True)
+        found: list[tuple[float, str, int]] = []
+        for dir_path, _, file_names in os.walk(self.folder):
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                if file_name.endswith(".tmp"):
+                    os.remove(path)
+                    continue
+                stat = os.stat(path)
+                found.append((stat.st_mtime, file_name, stat.st_size))
+        found.sort()
+        with self._lock:
+            for _, key, size in found:
+                self._entries[key] = size
+                self._size += size
+            self._evict()
+        logger.debug(f"Loaded {len(self._entries)} entries ({self._size} bytes) from cache '{self.folder}'.")
+
+    def lookup(self, key: str, pin: bool = False) -> str | None:
+        """
+        Return the path of the entry for the given key, marking it as recently used, or None on a miss.
+        A pinned entry is kept until release is called for it.
+        """
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            if pin:
+                self._pin(key)
+        path = self.path(key)
+        try:
+            # Keeps the order of use across restarts, see load
+            os.utime(path)
+        except FileNotFoundError:
+            if pin:
+                self.release(key)
+            self.discard(key)
+            return None
+        return path
+
+    def release(self, key: str):
+        """Unpin an entry returned pinned, removing it if it was evicted or discarded in the meantime."""
+        with self._lock:
+            count = self._pins.pop(key, 0) - 1
+            if count > 0:
+                self._pins[key] = count
+                return
+            if key not in self._dropped:
+                return
+            self._dropped.discard(key)
+        self._remove(key)
+
+    def get(self, key: str) -> bytes | None:
+        path = self.lookup(key)
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            # Evicted in between
+            return None
+
+    def add_file(self, key: str, source: str, pin: bool = False) -> bool:
+        """
+        Move the file at source (from temp_path) into the cache as the entry for the given key, pinned if asked.
+        Returns whether it was kept, entries larger than the whole budget are not and are left at source.
+        """
+        size = os.path.getsize(source)
+        if not self.enabled or size > self.max_bytes:
+            return False
+        os.replace(source, self.path(key))
+        with self._lock:
+            self._size += size - self._entries.get(key, 0)
+            self._entries[key] = size
+            self._entries.move_to_end(key)
+            self._dropped.discard(key)
+            if pin:
+                self._pin(key)
+            self._evict()
+        return True
+
+    def put(self, key: str, content: bytes, pin: bool = False) -> bool:
+        if not self.enabled or len(content) > self.max_bytes:
+            return False
+        temp = self.temp_path(key)
+        with open(temp, "wb") as file:
+            file.write(content)
+        if not self.add_file(key, temp, pin):
+            os.remove(temp)
+            return False
+        return True
+
+    def discard(self, key: str):
+        with self._lock:
+            size = self._entries.pop(key, None)
+            if size is None:
+                return
+            self._size -= size
+            if key in self._pins:
+                self._dropped.add(key)
+                return
+        self._remove(key)
+
+    def _pin(self, key: str):
+        # Lock must be held
+        self._pins[key] = self._pins.get(key, 0) + 1
+
+    def _evict(self):
+        # Lock must be held, pinned entries are only dropped from the index, their file goes once released
+        while self._size > self.max_bytes and len(self._entries) > 0:
+            key, size = self._entries.popitem(last=False)
+            self._size -= size
+            if key in self._pins:
+                self._dropped.add(key)
+            else:
+                self._remove(key)
+            logger.debug(f"Evicted '{key}' ({size} bytes) from cache '{self.folder}'.")
+
+    def _remove(self, key: str):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import zlib
+from typing import AsyncIterator, Protocol
+
+from models.archive import ArchiveFormat
+
+try:
+    import zstandard
+except ImportError:
+    # tar.zst is only offered when zstandard is installed
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+# Input gathered before it is handed to a worker thread, so the many small tar headers don't each cost a thread hop
+COMPRESS_CHUNK_SIZE = 1024 * 1024
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+class Compressor(Protocol):
+    def compress(self, data: bytes) -> bytes: ...
+
+    def flush(self) -> bytes: ...
+
+
+def available_formats() -> list[ArchiveFormat]:
+    """Formats that can be produced here, in order of preference."""
+    formats = [ArchiveFormat.tar_gz, ArchiveFormat.tar]
+    if zstandard is not None:
+        formats.insert(0, ArchiveFormat.tar_zst)
+    return formats
+
+
+def compressor(fmt: ArchiveFormat) -> Compressor | None:
+    """
+    A streaming compressor for the format, None for plain tar.
+    Output only depends on the input, so the same archive always compresses to the same bytes.
+    """
+    match fmt:
+        case ArchiveFormat.tar_gz:
+            # wbits 31 writes a gzip header, with no timestamp or file name
+            return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        case ArchiveFormat.tar_zst:
+            if zstandard is None:
+                raise ValueError("tar.zst archives need the zstandard package")
+            return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        case _:
+            return None
+
+
+async def compress_stream(blocks: AsyncIterator[bytes], fmt: ArchiveFormat) -> AsyncIterator[bytes]:
+    """Compress a stream of blocks on the fly, compression itself runs in worker threads."""
+    stream = compressor(fmt)
+    if stream is None:
+        async for block in blocks:
+            yield block
+        return
+    pending: list[bytes] = []
+    pending_size = 0
+    async for block in blocks:
+        pending.append(block)
+        pending_size += len(block)
+        if pending_size >= COMPRESS_CHUNK_SIZE:
+            output = await asyncio.to_thread(stream.compress, b"".join(pending))
+            pending.clear()
+            pending_size = 0
+            if output:
+                yield output
+    output = await asyncio.to_thread(stream.compress, b"".join(pending))
+    output += await asyncio.to_thread(stream.flush)
+    if output:
+        yield output
+
+
+def negotiate_format(accept: str | None) -> ArchiveFormat:
+    """
+    Pick the archive format from an Accept header, by quality and then by how well it compresses.
+    Plain tar when nothing listed can be produced.
+    """
+    formats = available_formats()
+    if accept is None:
+        return ArchiveFormat.tar
+    best: tuple[float, int] | None = None
+    chosen = ArchiveFormat.tar
+    for item in accept.split(","):
+        media_type, *params = [part.strip() for part in item.split(";")]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality <= 0:
+            continue
+        for rank, fmt in enumerate(formats):
+            if fmt.media_type != media_type:
+                continue
+            candidate = (quality, -rank)
+            if best is None or candidate > best:
+                best = candidate
+                chosen = fmt
+    return chosen
@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, TypeVar
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+T = TypeVar("T")
+
+
+class AIMDLimiter:
+    """
+    Concurrency limiter following additive-increase/multiplicative-decrease (as TCP congestion control does).
+
+    Args:
+        initial: int = The concurrency limit to start with.
+        minimum: int = The limit never goes below this value.
+        maximum: int = The limit never goes above this value.
+        latency_target: float = Calls slower than this (in seconds) are treated like failures.
+        backoff: float = Factor the limit is multiplied by when backing off.
+    """
+
+    def __init__(self, initial: int, minimum: int, maximum: int, latency_target: float, backoff: float = 0.5):
+        if not (1 <= minimum <= initial <= maximum):
+            raise ValueError("Concurrency limits must satisfy 1 <= minimum <= initial <= maximum")
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self._limit = float(initial)
+        self._in_flight = 0
+        self._last_backoff = 0.0
+        self._condition = asyncio.Condition()
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    async def acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < self.limit)
+            self._in_flight += 1
+
+    async def release(self, latency: float, failed: bool):
+        async with self._condition:
+            self._in_flight -= 1
+            now = time.monotonic()
+            if failed or latency > self.latency_target:
+                # Only back off once per latency window, so a burst of failures doesn't collapse the limit
+                if now - self._last_backoff > self.latency_target and self._limit > self.minimum:
+                    self._limit = max(self.minimum, self._limit * self.backoff)
+                    self._last_backoff = now
+                    logger.info(f"Backing off, concurrency limit is now {self.limit}.")
+            else:
+                # Grows by one for every full window of healthy calls
+                self._limit = min(self.maximum, self._limit + 1 / self._limit)
+            self._condition.notify_all()
+
+    @asynccontextmanager
+    async def slot(self):
+        """Hold one unit of concurrency for the duration of the block, measuring how long it took."""
+        await self.acquire()
+        start = time.monotonic()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            await self.release(time.monotonic() - start, failed)
+
+
+async def retry(
+    func: Callable[[], Awaitable[T]],
+    retries: int,
+    should_retry: Callable[[BaseException], bool],
+    base_delay: float = 0.5,
+    max_delay: float = 30.0,
+) -> T:
+    """
+    Call func until it succeeds, retrying failures accepted by should_retry at most `retries` times.
+    Waits are exponential with full jitter, so concurrent callers don't retry in lockstep.
+    """
+    attempt = 0
+    while True:
+        try:
+            return await func()
+        except Exception as e:
+            if attempt >= retries or not should_retry(e):
+                raise
+            delay = random.uniform(0, min(max_delay, base_delay * 2**attempt))
+            attempt += 1
+            logger.warning(f"Attempt {attempt} failed with {e!r}, retrying in {delay:.2f}s.")
+            await asyncio.sleep(delay)
@@ -28,3 +28,18 @@ def AccessForbidden(detail: str = "Access Forbidden"):
         status_code=status.HTTP_403_FORBIDDEN,
         detail=detail,
     )
+
+
+def RangeNotSatisfiable(size: int, detail: str = "Requested range not satisfiable"):
+    return HTTPException(
+        status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+        detail=detail,
+        headers={"Content-Range": f"bytes */{size}"},
+    )
+
+
+def InvalidCursor(detail: str = "Invalid pagination cursor"):
+    return HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail=detail,
+    )
@@ -0,0 +1,159 @@
+import os
+import re
+from typing import AsyncIterator, Callable, Iterator
+from urllib.parse import quote
+
+from fastapi import HTTPException, Request, Response
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+
+from utils.exceptions import RangeNotSatisfiable
+
+# Size of the blocks read from a file when sending part of it
+RANGE_CHUNK_SIZE = 1024 * 1024
+
+RANGE_PATTERN = re.compile(r"bytes=(\d*)-(\d*)")
+
+
+def attachment(filename: str) -> dict[str, str]:
+    """Content-Disposition header for a download, same as the one FileResponse sends when given a filename."""
+    quoted = quote(filename)
+    if quoted != filename:
+        return {"Content-Disposition": f"attachment; filename*=utf-8''{quoted}"}
+    return {"Content-Disposition": f'attachment; filename="{filename}"'}
+
+
+def etag_matches(header: str | None, etag: str) -> bool:
+    """Whether an If-None-Match header matches the given ETag, using the weak comparison it calls for."""
+    if header is None:
+        return False
+    if header.strip() == "*":
+        return True
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return etag.removeprefix("W/") in tags
+
+
+def not_modified(request: Request, etag: str, background: BackgroundTask | None = None) -> Response | None:
+    """A 304 response if the client already holds this version, None otherwise."""
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag}, background=background)
+    return None
+
+
+def parse_range(header: str, size: int) -> tuple[int, int] | None:
+    """
+    Parse a Range header into the first and last byte (inclusive) it asks for.
+    Returns None when the header should be ignored and the whole content sent: other units,
+    several ranges or a malformed value. Raises a 416 error when the range lies past the end.
+    """
+    match = RANGE_PATTERN.fullmatch(header.strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if first == "" and last == "":
+        return None
+    if first == "":
+        # Suffix range, the last N bytes
+        length = int(last)
+        if length == 0 or size == 0:
+            raise RangeNotSatisfiable(size)
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = size - 1 if last == "" else min(int(last), size - 1)
+    if start > end:
+        if last != "" and int(last) < start:
+            return None
+        raise RangeNotSatisfiable(size)
+    return start, end
+
+
+def requested_range(request: Request, etag: str, size: int) -> tuple[int, int] | None:
+    """
+    The byte range the client asked for, or None if it should get the whole content.
+    Ranges only apply when If-Range (if given) names the current ETag, so a resumed download never mixes versions.
+    """
+    header = request.headers.get("range")
+    if header is None:
+        return None
+    if_range = request.headers.get("if-range")
+    # If-Range uses strong comparison, so weak ETags and dates never match
+    if if_range is not None and if_range.strip() != etag:
+        return None
+    return parse_range(header, size)
+
+
+def read_file_range(path: str, start: int, end: int) -> Iterator[bytes]:
+    with open(path, "rb") as file:
+        file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = file.read(min(RANGE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def file_response(
+    request: Request,
+    path: str,
+    etag: str,
+    media_type: str | None = None,
+    headers: dict[str, str] | None = None,
+    background: BackgroundTask | None = None,
+) -> Response:
+    """
+    Send a file with the given strong ETag, answering conditional (If-None-Match) and range (Range, If-Range) requests.
+    Only single ranges are served, clients wanting several parts in parallel send one request for each.
+    background runs once the response has been sent, whatever it turned out to be.
+    """
+    cached = not_modified(request, etag, background)
+    if cached is not None:
+        return cached
+    size = os.path.getsize(path)
+    headers = {**(headers or {}), "ETag": etag, "Accept-Ranges": "bytes"}
+    try:
+        byte_range = requested_range(request, etag, size)
+    except HTTPException as e:
+        # Answered here rather than by the exception handler, which wouldn't run background
+        return JSONResponse({"detail": e.detail}, status_code=e.status_code, headers=e.headers, background=background)
+    if byte_range is None:
+        return FileResponse(path, media_type=media_type, headers=headers, background=background)
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        read_file_range(path, start, end),
+        status_code=206,
+        media_type=media_type,
+        headers=headers,
+        background=background,
+    )
+
+
+def stream_response(
+    request: Request,
+    etag: str,
+    size: int,
+    body: Callable[[int, int], Iterator[bytes] | AsyncIterator[bytes]],
+    media_type: str | None = None,
+    headers: dict[str, str] | None = None,
+) -> Response:
+    """
+    Same as file_response, for content of a known size produced by body(first, last) (both bytes included).
+    body is only called once the request turned out to need content, so a 304 never fetches anything.
+    """
+    cached = not_modified(request, etag)
+    if cached is not None:
+        return cached
+    headers = {**(headers or {}), "ETag": etag, "Accept-Ranges": "bytes"}
+    byte_range = requested_range(request, etag, size)
+    status_code = 200
+    if byte_range is None:
+        start, end = 0, size - 1
+    else:
+        start, end = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(body(start, end), status_code=status_code, media_type=media_type, headers=headers)
@@ -0,0 +1,44 @@
+import base64
+from typing import Any, Callable, Sequence, TypeVar
+from uuid import UUID
+
+from models.page import Page
+from storage.main import MAX_PAGE_SIZE, PAGE_SIZE
+from utils.exceptions import InvalidCursor
+
+T = TypeVar("T")
+
+
+def encode_cursor(key: UUID) -> str:
+    return base64.urlsafe_b64encode(key.bytes).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> UUID:
+    try:
+        return UUID(bytes=base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        raise InvalidCursor()
+
+
+def page_size(limit: int | None) -> int:
+    """The page size to use when the client asked for limit items, kept between 1 and MAX_PAGE_SIZE."""
+    if limit is None:
+        return PAGE_SIZE
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def paginate(statement: Any, key: Any, cursor: str | None, limit: int) -> Any:
+    """
+    Restrict a select to the page after cursor, ordered by the key column (which must be unique).
+    One row more than the page is fetched, so make_page can tell whether another page follows.
+    """
+    if cursor is not None:
+        statement = statement.where(key > decode_cursor(cursor))
+    return statement.order_by(key).limit(limit + 1)
+
+
+def make_page(rows: Sequence[T], limit: int, key: Callable[[T], UUID]) -> Page[T]:
+    if len(rows) <= limit:
+        return Page(items=list(rows))
+    items = list(rows[:limit])
+    return Page(items=items, next_cursor=encode_cursor(key(items[-1])))
@@ -1,14 +1,90 @@
 import asyncio
+import logging
+from typing import AsyncIterator, BinaryIO
 
+import aiohttp
+from aiohttp.payload import Payload
 from pypaperless import Paperless
+from pypaperless.const import API_PATH
+from pypaperless.exceptions import BadJsonResponseError
 from pypaperless.models.common import MatchingAlgorithmType, TaskStatusType
+from pypaperless.models.tasks import Task
 
-from storage.main import PAPERLESS_TOKEN, PAPERLESS_URL
+from storage.main import (
+    PAPERLESS_KEEPALIVE,
+    PAPERLESS_POLL_MAX_MS,
+    PAPERLESS_POLL_MIN_MS,
+    PAPERLESS_POOL_SIZE,
+    PAPERLESS_TASK_TIMEOUT,
+    PAPERLESS_TOKEN,
+    PAPERLESS_URL,
+)
 
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 
-def spawn_paperless():
+# Size of the blocks document content is sent and received in
+DOCUMENT_CHUNK_SIZE = 1024 * 1024
+
+# Process-wide client, its session keeps a pool of connections alive between requests
+paperless_client: Paperless | None = None
+initialize_lock = asyncio.Lock()
+
+
+def spawn_paperless(session: aiohttp.ClientSession | None = None):
     # TODO: suppress warning during initialization
-    return Paperless(PAPERLESS_URL, PAPERLESS_TOKEN)
+    return Paperless(PAPERLESS_URL, PAPERLESS_TOKEN, session=session)
+
+
+def open_client():
+    """
+    Create the shared Paperless-ngx client.
+    Must be called from within the running event loop, as the aiohttp session binds to it.
+    """
+    global paperless_client
+    if paperless_client is not None:
+        return
+    connector = aiohttp.TCPConnector(limit=PAPERLESS_POOL_SIZE, keepalive_timeout=PAPERLESS_KEEPALIVE)
+    paperless_client = spawn_paperless(aiohttp.ClientSession(connector=connector))
+
+
+async def close_client():
+    """Close the shared Paperless-ngx client and every pooled connection."""
+    global paperless_client
+    await task_poller.stop()
+    if paperless_client is None:
+        return
+    await paperless_client.close()
+    paperless_client = None
+
+
+async def get_paperless() -> Paperless:
+    """
+    Return the shared Paperless-ngx client, fetching the API index on first use.
+    """
+    if paperless_client is None:
+        open_client()
+    client = paperless_client
+    if client is None:
+        raise RuntimeError("Paperless client could not be opened")
+    if not client.is_initialized:
+        async with initialize_lock:
+            if not client.is_initialized:
+                await client.initialize()
+    return client
+
+
+def is_transient(exc: BaseException) -> bool:
+    """
+    Whether a failed request to Paperless-ngx is worth retrying.
+    Connection problems, timeouts, rate limiting and server errors are, anything else is not.
+    """
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return exc.status == 429 or exc.status >= 500
+    # Raised when a proxy answers with an error page instead of JSON
+    if isinstance(exc, BadJsonResponseError):
+        return True
+    return isinstance(exc, (aiohttp.ClientError, asyncio.TimeoutError))
 
 
 async def create_document(**kwargs) -> str:
@@ -26,37 +102,211 @@ async def create_document(**kwargs) -> str:
         archive_serial_number: str = The archive serial number.
         custom_fields: list[str] = Array of custom field IDs.
     """
-    paperless = spawn_paperless()
-    async with paperless:
-        draft = paperless.documents.draft(**kwargs)
-        new_id = await draft.save()
-        if type(new_id) is not str:
-            raise ValueError("ID string wasn't returned")
-        return new_id
+    paperless = await get_paperless()
+    draft = paperless.documents.draft(**kwargs)
+    new_id = await draft.save()
+    if type(new_id) is not str:
+        raise ValueError("ID string wasn't returned")
+    return new_id
+
+
+class SuffixedFilePayload(Payload):
+    """
+    Request body made of a file followed by a suffix, sent block by block.
+    Neither the file nor file + suffix is ever held in memory, the file is closed once sent.
+    """
+
+    def __init__(self, file: BinaryIO, suffix: bytes, **kwargs):
+        super().__init__(file, **kwargs)
+        file.seek(0, 2)
+        self._size = file.tell() + len(suffix)
+        file.seek(0)
+        self._suffix = suffix
+
+    async def write(self, writer):
+        file: BinaryIO = self._value
+        try:
+            while chunk := await asyncio.to_thread(file.read, DOCUMENT_CHUNK_SIZE):
+                await writer.write(chunk)
+            await writer.write(self._suffix)
+        finally:
+            file.close()
+
+    def decode(self, encoding: str = "utf-8", errors: str = "strict") -> str:
+        raise TypeError("Document content can't be decoded")
+
+
+async def upload_document(file: BinaryIO, suffix: bytes, title: str, **kwargs) -> str:
+    """
+    Upload a document to Paperless-ngx, streaming it from the given file with suffix appended.
+    Returns the ID of the consumption task.
+
+    Args:
+        correspondent: str = ID of the correspondent.
+        tags: str = ID of the tag.
+        Any other field of the create_document function.
+    """
+    form = aiohttp.FormData()
+    form.add_field("document", SuffixedFilePayload(file, suffix), filename=title)
+    form.add_field("title", title)
+    for name, value in kwargs.items():
+        form.add_field(name, str(value))
+    paperless = await get_paperless()
+    async with paperless.request("post", API_PATH["documents_post"], data=form) as res:
+        res.raise_for_status()
+        task_id = await res.json()
+    if type(task_id) is not str:
+        raise ValueError("ID string wasn't returned")
+    return task_id
+
+
+def task_outcome(task: Task) -> int:
+    """
+    Return the ID of the document a finished consumption task created, raising if it failed.
+    """
+    if task.status == TaskStatusType.FAILURE:
+        if task.result is not None:
+            if "duplicate" in task.result:
+                raise ValueError("Document rejected due to being a duplicate")
+    if task.status == TaskStatusType.SUCCESS:
+        if task.related_document is None:
+            logger.error(f"Task {task.task_id} succeeded without a document: {task}")
+            raise ValueError("Document wasn't created, but we received a success")
+        return task.related_document
+    logger.error(f"Task {task.task_id} failed: {task}")
+    raise ValueError("Document verification failed")
+
+
+class TaskPoller:
+    """
+    Waits on every pending consumption task at once.
+
+    Instead of polling each task on its own, one listing of the tasks endpoint is requested per round and
+    the futures of all tasks that finished are resolved. Rounds start fast and back off while nothing finishes.
+    Finished tasks are acknowledged, which keeps them out of the following listings.
+    Tasks still pending after timeout seconds (e.g. acknowledged by someone else, so never listed again) fail.
+    """
+
+    # Statuses Paperless-ngx has but pypaperless doesn't know (STARTED, RETRY) come out as UNKNOWN
+    PENDING = [TaskStatusType.UNKNOWN, TaskStatusType.PENDING]
+
+    def __init__(self, min_interval: float, max_interval: float, timeout: float):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.timeout = timeout
+        self._waiters: dict[str, list[asyncio.Future[int]]] = {}
+        self._deadlines: dict[str, float] = {}
+        self._wakeup = asyncio.Event()
+        self._runner: asyncio.Task | None = None
+
+    async def wait(self, task_id: str) -> int:
+        """Wait until the given task finishes, returning the ID of the created document."""
+        loop = asyncio.get_running_loop()
+        future: asyncio.Future[int] = loop.create_future()
+        self._waiters.setdefault(task_id, []).append(future)
+        self._deadlines[task_id] = loop.time() + self.timeout
+        self._wakeup.set()
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.create_task(self.run())
+        return await future
+
+    async def stop(self):
+        if self._runner is not None:
+            self._runner.cancel()
+            try:
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+            self._runner = None
+        for futures in self._waiters.values():
+            for future in futures:
+                future.cancel()
+        self._waiters.clear()
+        self._deadlines.clear()
+
+    async def run(self):
+        interval = self.min_interval
+        while self._waiters:
+            # Sleep until the interval passes or new tasks come in, which brings polling back to full speed
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=interval)
+                interval = self.min_interval
+                await asyncio.sleep(self.min_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                finished = await self.poll()
+            except Exception as e:
+                if not is_transient(e):
+                    logger.error(f"Polling consumption tasks failed: {e!r}")
+                    self.fail_all(e)
+                    return
+                logger.warning(f"Polling consumption tasks failed, backing off: {e!r}")
+                finished = 0
+            self.expire()
+            interval = self.min_interval if finished else min(self.max_interval, interval * 2)
+
+    async def poll(self) -> int:
+        """Run one polling round, returns how many tasks finished."""
+        paperless = await get_paperless()
+        data = await paperless.request_json("get", API_PATH["tasks"], params={"acknowledged": "false"})
+        finished: list[int] = []
+        for item in data:
+            task = Task.create_with_data(paperless, item, fetched=True)
+            if task.task_id not in self._waiters or task.status in self.PENDING:
+                continue
+            self._deadlines.pop(task.task_id, None)
+            for future in self._waiters.pop(task.task_id):
+                if future.done():
+                    continue
+                try:
+                    future.set_result(task_outcome(task))
+                except Exception as e:
+                    future.set_exception(e)
+            if task.id is not None:
+                finished.append(task.id)
+        if finished:
+            logger.debug(f"{len(finished)} consumption tasks finished, {len(self._waiters)} pending")
+            try:
+                await paperless.request_json("post", "/api/acknowledge_tasks/", json={"tasks": finished})
+            except Exception as e:
+                # Only costs larger listings later on
+                logger.warning(f"Could not acknowledge finished tasks: {e!r}")
+        return len(finished)
+
+    def expire(self):
+        """Fail the waiters of tasks past their deadline."""
+        now = asyncio.get_running_loop().time()
+        for task_id, deadline in list(self._deadlines.items()):
+            if deadline > now:
+                continue
+            del self._deadlines[task_id]
+            logger.error(f"Consumption task {task_id} still pending after {self.timeout}s")
+            # Not a transient error, so the upload isn't waited on all over again
+            error = ValueError(f"Consumption task {task_id} didn't finish in time")
+            for future in self._waiters.pop(task_id, []):
+                if not future.done():
+                    future.set_exception(error)
+
+    def fail_all(self, exc: BaseException):
+        for futures in self._waiters.values():
+            for future in futures:
+                if not future.done():
+                    future.set_exception(exc)
+        self._waiters.clear()
+        self._deadlines.clear()
+
+
+task_poller = TaskPoller(PAPERLESS_POLL_MIN_MS / 1000, PAPERLESS_POLL_MAX_MS / 1000, PAPERLESS_TASK_TIMEOUT)
 
 
 async def verify_document(task_id: str) -> int:
     """
     Verify a document was consumed successfully.
+    Waits on the shared task_poller, which checks all pending documents together.
     """
-
-    paperless = spawn_paperless()
-    async with paperless:
-        task = await paperless.tasks(task_id)
-        while task.status in [TaskStatusType.UNKNOWN, TaskStatusType.PENDING]:
-            await asyncio.sleep(1)
-            task = await paperless.tasks(task_id)
-        if task.status == TaskStatusType.FAILURE:
-            if task.result is not None:
-                if "duplicate" in task.result:
-                    raise ValueError("Document rejected due to being a duplicate")
-        if task.status == TaskStatusType.SUCCESS:
-            if task.related_document is None:
-                print(task)
-                raise ValueError("Document wasn't created, but we received a success")
-            return task.related_document
-        print(task)
-        raise ValueError("Document verification failed")
+    return await task_poller.wait(task_id)
 
 
 async def create_correspondent(**kwargs) -> int:
@@ -79,13 +329,12 @@ async def create_correspondent(**kwargs) -> int:
     if "is_insensitive" not in data:
         data["is_insensitive"] = False
 
-    paperless = spawn_paperless()
-    async with paperless:
-        draft = paperless.correspondents.draft(**data)
-        new_id = await draft.save()
-        if type(new_id) is not int:
-            raise ValueError("ID wasn't returned")
-        return new_id
+    paperless = await get_paperless()
+    draft = paperless.correspondents.draft(**data)
+    new_id = await draft.save()
+    if type(new_id) is not int:
+        raise ValueError("ID wasn't returned")
+    return new_id
 
 
 async def create_tag(**kwargs) -> int:
@@ -123,13 +372,26 @@ async def create_tag(**kwargs) -> int:
     if "is_inbox_tag" not in data:
         data["is_inbox_tag"] = False
 
-    paperless = spawn_paperless()
-    async with paperless:
-        draft = paperless.tags.draft(**kwargs)
-        new_id = await draft.save()
-        if type(new_id) is not int:
-            raise ValueError("ID wasn't returned")
-        return new_id
+    paperless = await get_paperless()
+    draft = paperless.tags.draft(**kwargs)
+    new_id = await draft.save()
+    if type(new_id) is not int:
+        raise ValueError("ID wasn't returned")
+    return new_id
+
+
+async def delete_document(document_id: int):
+    """
+    Delete a document from Paperless-ngx.
+
+    Args:
+        document_id: int = The ID of the document to delete.
+    """
+    paperless = await get_paperless()
+    async with paperless.request("delete", API_PATH["documents_single"].format(pk=document_id)) as res:
+        # Already gone is as good as deleted
+        if res.status != 404:
+            res.raise_for_status()
 
 
 async def download_document(document_id: int) -> tuple[bytes, str | None]:
@@ -139,11 +401,44 @@ async def download_document(document_id: int) -> tuple[bytes, str | None]:
     Args:
         document_id: str = The ID of the document to download.
     """
-    paperless = spawn_paperless()
-    async with paperless:
-        document = await paperless.documents.download(document_id)
-        content = document.content
-        if content is None:
-            raise ValueError("Document content is empty")
-        name = document.disposition_filename
-        return content, name
+    paperless = await get_paperless()
+    document = await paperless.documents.download(document_id)
+    content = document.content
+    if content is None:
+        raise ValueError("Document content is empty")
+    name = document.disposition_filename
+    return content, name
+
+
+async def stream_document(document_id: int, trim: int = 0) -> AsyncIterator[bytes]:
+    """
+    Stream the content of a document from Paperless-ngx,
+    leaving out its last trim bytes (e.g. a suffix added on upload).
+    Blocks are yielded as they arrive, trimming only holds back the last few bytes instead of copying the content.
+
+    Args:
+        document_id: int = The ID of the document to download.
+        trim: int = How many bytes to drop from the end.
+    """
+    paperless = await get_paperless()
+    path = API_PATH["documents_download"].format(pk=document_id)
+    async with paperless.request("get", path, params={"original": "false"}) as res:
+        res.raise_for_status()
+        held = b""
+        async for chunk in res.content.iter_chunked(DOCUMENT_CHUNK_SIZE):
+            if trim == 0:
+                yield chunk
+                continue
+            if len(chunk) < trim:
+                chunk = held + chunk
+                held = b""
+                if len(chunk) < trim:
+                    held = chunk
+                    continue
+            if held:
+                yield held
+            if len(chunk) > trim:
+                yield memoryview(chunk)[:-trim]
+            held = chunk[-trim:]
+        if len(held) < trim:
+            raise ValueError("Document content is shorter than expected")
@@ -103,3 +103,12 @@ def verify_manifest(manifest_hash: str, transaction_address: str) -> bool:
     receipt = blockChainService.get_transaction_receipt(transaction_address)
     storedHash = blockChainService.get_manifest_hash(receipt)
     return manifest_hash == storedHash
+
+
+# Signatures are sent XORed with this key, one translation maps every byte at once
+SIGNATURE_KEY = 0x54
+SIGNATURE_TABLE = bytes(byte ^ SIGNATURE_KEY for byte in range(256))
+
+
+def obfuscate_signature(signature: bytes) -> bytes:
+    return signature.translate(SIGNATURE_TABLE)